@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+"""
+Measures how long it takes to start the ddmq command-line interface, i.e. to
+import ddmq.cli, compared to starting an empty Python interpreter. Scripts
+that call ddmq many times pay this for every call, so it should stay small.
+
+Most of the import time is json, logging and argparse (and re, which they
+import), which every command needs. Their import time depends a lot on the
+machine and on how busy it is, so the budget is for what ddmq adds on top of
+them: the script also times importing just those standard modules, and the
+budget applies to the difference. The interpreters are started in turns, so
+load hits all of them alike.
+
+Measured baseline (Linux, Python 3.11, one CPU, three runs of the
+defaults): python startup 12-18 ms, the standard modules 8-15 ms on top of
+that, and ddmq.cli 8-9 ms on top of the standard modules. The whole import
+of ddmq.cli varied from 16 to 23 ms between those runs, and has measured up
+to 75 ms on a busier machine, which is why it has no budget of its own. The
+ddmq command imports ddmq.client first (about 14 ms with the startup), which
+is all a command forwarded to a helper process (ddmq serve) needs.
+
+The script exits with an error if the median time ddmq adds is over the
+budget, or if importing ddmq.cli pulls in any of the modules that should
+only be imported when they are needed. python -X importtime only counts the
+time spent running the modules, so it reports less than this script does.
+
+$ python benchmarks/import_time.py
+$ python benchmarks/import_time.py --budget 10 --runs 50
+$ python benchmarks/import_time.py --module ddmq.client
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# modules that should not be imported just to start the command-line interface
+lazy_modules = ['yaml', 'uuid', 'sqlite3', 'ctypes', 'lzma', 'bz2', 'zstandard', 'msgpack', 'orjson', 'ujson', 'pkg_resources', 'beautifultable', 'ddmq.segment', 'ddmq.sqlite', 'ddmq.janitor', 'ddmq.server', 'ddmq.aio', 'asyncio', 'base64', 'select', 'socket']
+
+# the standard modules every command needs, the import time of ddmq is measured on top of them
+standard_modules = ['json', 'logging', 'argparse']
+
+# the root of the repository, so the ddmq package in it is the one imported
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+
+def time_commands(codes, runs):
+    """
+    Time Python interpreters running pieces of code. The pieces are run in turns, so changes in the load of the machine affect them all alike
+
+    Args:
+        codes:  a list of the pieces of code to run
+        runs:   the number of times to run each of them
+
+    Returns:
+        a list of the median wall time of the runs of each piece, in seconds
+    """
+
+    env = dict(os.environ, PYTHONPATH=repo_root)
+    times = [[] for code in codes]
+    for i in range(runs):
+        for code, code_times in zip(codes, times):
+            started = time.time()
+            subprocess.check_call([sys.executable, '-c', code], env=env)
+            code_times.append(time.time() - started)
+
+    return [sorted(code_times)[len(code_times) // 2] for code_times in times]
+
+
+
+def imported_modules(module):
+    """
+    Get the lazily imported modules that are imported anyway when a module is imported
+
+    Args:
+        module:     name of the module to import
+
+    Returns:
+        a list of module names
+    """
+
+    code = "import sys, {}; print(' '.join(name for name in {!r} if name in sys.modules))".format(module, lazy_modules)
+    output = subprocess.check_output([sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=repo_root))
+    return output.decode('utf-8').split()
+
+
+
+def main():
+    """Run the benchmark"""
+
+    parser = argparse.ArgumentParser(description='Measure the import time of the ddmq command-line interface.')
+    parser.add_argument('-b', '--budget', help="the maximum median time importing the module adds to importing the standard modules every command needs, in milliseconds (default 15)", type=float, default=15)
+    parser.add_argument('-n', '--runs', help="the number of times to start the interpreter (default 20)", type=int, default=20)
+    parser.add_argument('-m', '--module', help="the module to import (default ddmq.cli)", type=str, default='ddmq.cli')
+    args = parser.parse_args()
+
+    # make sure the bytecode is compiled, so it isn't timed
+    time_commands(['import {}'.format(args.module)], 1)
+
+    baseline, standard, total = time_commands(['pass', 'import {}'.format(', '.join(standard_modules)), 'import {}'.format(args.module)], args.runs)
+    import_time = (total - standard) * 1000
+
+    print('python startup:   {:.1f} ms'.format(baseline * 1000))
+    print('import {}: {:.1f} ms'.format(', '.join(standard_modules), (standard - baseline) * 1000))
+    print('import {}: {:.1f} ms, {:.1f} ms more than the standard modules (budget {:.1f} ms)'.format(args.module, (total - baseline) * 1000, import_time, args.budget))
+
+    failed = False
+    if import_time > args.budget:
+        print('Import time is over budget, run python -X importtime -c "import {}" to see where the time goes.'.format(args.module))
+        failed = True
+
+    imported = imported_modules(args.module)
+    if imported:
+        print('Modules that should be imported lazily were imported: {}'.format(', '.join(imported)))
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,40 @@
-from .broker import broker
-from .message import message
+import sys
+import types
+import importlib
+
+# the classes the package exports, and the submodules they are defined in. They are imported the first time
+# they are used, so the ddmq command can send a command to a helper process without importing the broker (see client.py)
+exports = {'broker': 'broker', 'message': 'message', 'receipt': 'message'}
+
+
+class package(types.ModuleType):
+    """
+    The ddmq package, importing the classes it exports when they are first used
+    """
+
+    def __getattr__(self, name):
+        """Import an exported class the first time it is used"""
+
+        if name not in exports:
+            raise AttributeError("module '{}' has no attribute '{}'".format(self.__name__, name))
+        value = getattr(importlib.import_module('.' + exports[name], self.__name__), name)
+        types.ModuleType.__setattr__(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        """Keep the broker and message classes when their submodules, which have the same names, are imported"""
+
+        if name in exports and isinstance(value, types.ModuleType):
+            value = getattr(value, name)
+        types.ModuleType.__setattr__(self, name, value)
+
+
+# modules can only change class in python 3.5+, older ones import everything right away
+if sys.version_info >= (3, 5):
+    sys.modules[__name__].__class__ = package
+else:
+    from .broker import broker
+    from .message import message, receipt
 
 
 def get_bin_path():
@@ -0,0 +1,379 @@
+#! /usr/bin/env python
+"""
+Defines the AsyncBroker class, a wrapper around a broker object for asyncio
+programs. The broker works with files, and calling it directly would block
+the event loop while it lists folders and opens and renames files, so
+AsyncBroker runs its methods in a small pool of threads instead.
+
+Messages can be consumed as they arrive with subscribe. On Linux the event
+loop watches the queue folder with inotify, so waiting for messages costs no
+threads at all. The number of messages a subscriber has been given but not
+yet acked or nacked is limited by the prefetch count, so a slow consumer
+doesn't pull more messages out of the queue than it can handle before they
+expire.
+
+Needs Python 3.7 or later, so it is not imported by the ddmq package itself.
+
+>>> import asyncio
+>>> from ddmq.aio import AsyncBroker
+>>> async def main():
+...     async with AsyncBroker('../temp/ddmq', create=True, prefetch=10) as b:
+...         await b.publish('queue_name', 'Hello World!')
+...         async for msg in b.subscribe('queue_name', timeout=1):
+...             print(msg.message)
+...             await b.ack(msg)
+>>> asyncio.run(main())
+Hello World!
+
+"""
+
+# import standard modules
+import os
+import time
+import asyncio
+import functools
+import concurrent.futures
+import logging as log
+
+try:
+    from .broker import broker
+    from .message import message
+except (ValueError, ImportError):
+    from broker import broker
+    from message import message
+
+
+
+class AsyncBroker(object):
+    """
+    Class to use a broker object from asyncio code without blocking the event loop
+    """
+
+    def __init__(self, root, prefetch=10, workers=4, **options):
+        """
+        Initialize an async broker object. The broker object it wraps is created right away, which reads the root's config file
+
+        Args:
+            root:       path to the root folder, or a broker object to wrap
+            prefetch:   the maximum number of messages given out by subscribe that have not been acked or nacked yet
+            workers:    the number of threads running the broker's methods
+            options:    arguments for the broker object (create, verbose, debug, backend, codec)
+
+        Returns:
+            None
+        """
+
+        if prefetch < 1:
+            raise ValueError("The prefetch count has to be at least 1 (prefetch={}).".format(prefetch))
+
+        if isinstance(root, broker):
+            self.broker = root
+        else:
+            self.broker = broker(root, **options)
+
+        self.prefetch = prefetch
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        # the messages given out by subscribe and not yet acked or nacked, as (queue, file name)
+        self.unacked = set()
+
+        # the asyncio objects are created by the first coroutine using them, so they belong to the running loop
+        self.released = None
+
+        # futures of the subscribers waiting for each queue's watcher to become readable
+        self.waiters = {}
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *args):
+        # wait for the threads in another thread, so the event loop keeps running in the meantime
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+    def close(self):
+        """
+        Shut down the threads, after the method calls already started have finished. Blocks until they have, so use "async with" or run it in a thread from a coroutine
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self.executor.shutdown(wait=True)
+
+
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Run a blocking function in one of the broker's threads, e.g. a broker method that has no coroutine version here, or reading a blob
+
+        Args:
+            function:   the function to run
+            args:       positional arguments for the function
+            kwargs:     keyword arguments for the function
+
+        Returns:
+            what the function returns
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+
+
+    async def publish(self, queue, *args, **kwargs):
+        """
+        Publish a message to a queue, takes the same arguments as broker.publish
+        """
+        return await self.run(self.broker.publish, queue, *args, **kwargs)
+
+
+    async def publish_many(self, queue, messages, **kwargs):
+        """
+        Publish many messages to a queue, takes the same arguments as broker.publish_many. The messages are read in the broker's thread, so give a list rather than a generator doing I/O
+        """
+        return await self.run(self.broker.publish_many, queue, messages, **kwargs)
+
+
+    async def consume(self, queue, n=1, skip_cleaning=False):
+        """
+        Consume messages from a queue without waiting for them to arrive. Messages consumed this way don't count towards the prefetch count
+
+        Args:
+            queue:          name of the queue to consume from
+            n:              the number (int) of messages to consume
+            skip_cleaning:  if False, the client will first clean out any expired messages from the queue's work directory
+
+        Returns:
+            same as broker.consume, a single message object if n=1 or a list of messages
+        """
+        return await self.run(self.broker.consume, queue, n=n, skip_cleaning=skip_cleaning)
+
+
+    async def ack(self, queue, msg_files=None, requeue=False, skip_cleaning=False):
+        """
+        Positive acknowledgement of message(s), takes the same arguments as broker.ack. Frees the messages' places in the prefetch count, even if they could not be acked since they had already expired
+        """
+        try:
+            return await self.run(self.broker.ack, queue, msg_files, requeue=requeue, skip_cleaning=skip_cleaning)
+        finally:
+            await self.release(queue, msg_files)
+
+
+    async def nack(self, queue, msg_files=None, requeue=False, skip_cleaning=False):
+        """
+        Negative acknowledgement of message(s), takes the same arguments as broker.nack. Frees the messages' places in the prefetch count, even if they could not be nacked since they had already expired
+        """
+        try:
+            return await self.run(self.broker.nack, queue, msg_files, requeue=requeue, skip_cleaning=skip_cleaning)
+        finally:
+            await self.release(queue, msg_files)
+
+
+    async def clean(self, queue):
+        """
+        Clean out expired messages from a queue, same as broker.clean
+        """
+        return await self.run(self.broker.clean, queue)
+
+
+    async def purge(self, queue):
+        """
+        Remove all messages from a queue, same as broker.purge
+        """
+        return await self.run(self.broker.purge, queue)
+
+
+
+    async def release(self, queue, msg_files=None):
+        """
+        Free the places in the prefetch count taken by messages that have been acked or nacked, and wake up the subscribers waiting for them
+
+        Args:
+            queue:      name of the queue the files are in, or a message object
+            msg_files:  either a single file name or a list of file names
+
+        Returns:
+            None
+        """
+
+        if isinstance(queue, message):
+            msg_files = queue.filename
+            queue = queue.queue
+        if type(msg_files) != list:
+            msg_files = [msg_files]
+
+        before = len(self.unacked)
+        for msg_file in msg_files:
+            self.unacked.discard((queue, os.path.basename(str(msg_file))))
+
+        if len(self.unacked) < before:
+            async with self.get_released():
+                self.released.notify_all()
+
+
+    def get_released(self):
+        """
+        Get the condition subscribers wait on for places in the prefetch count, creating it the first time
+        """
+        if self.released is None:
+            self.released = asyncio.Condition()
+        return self.released
+
+
+
+    def get_watcher(self, queue):
+        """
+        Load a queue's settings, creating the queue if the broker is allowed to, and get the watcher for its folder. Blocking, so it is run in a broker thread
+        """
+
+        try:
+            self.broker.get_settings(queue)
+        except (FileNotFoundError, IOError):
+            if self.broker.create:
+                self.broker.create_queue(queue)
+            self.broker.get_settings(queue)
+        return self.broker.get_watcher(queue)
+
+
+    def watch_shards(self, queue, watcher):
+        """
+        Add the shard folders of a sharded queue to its watcher. Blocking, so it is run in a broker thread
+
+        Returns:
+            True if any shard was not watched before, so the queue should be checked again before waiting
+        """
+        new_shards = [watcher.add(os.path.join(self.broker.root, queue, shard)) for shard in self.broker.list_shards(queue)]
+        return any(new_shards)
+
+
+    async def wait_for_files(self, queue, watcher, timeout=None):
+        """
+        Wait until a file is written or moved into a queue's folder, without blocking the event loop. All subscribers of the queue share one reader on the watcher's inotify file descriptor. When inotify is not available, the folder is polled with an increasing delay instead
+
+        Args:
+            queue:      name of the queue
+            watcher:    the queue's folder_watcher object
+            timeout:    the maximum number of seconds to wait, None to wait forever
+
+        Returns:
+            True if something might have happened in the folder, False if the timeout was reached
+        """
+
+        fd = watcher.fileno()
+        if fd is None:
+            delay = watcher.next_delay()
+            if timeout is not None:
+                delay = min(delay, timeout)
+            await asyncio.sleep(max(delay, 0))
+            return True
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        # the first subscriber to wait starts reading the watcher
+        waiters = self.waiters.setdefault(queue, set())
+        if not waiters:
+            loop.add_reader(fd, self.wake, queue, watcher)
+        waiters.add(future)
+
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters.discard(future)
+            if not waiters:
+                loop.remove_reader(fd)
+
+
+    def wake(self, queue, watcher):
+        """
+        Called by the event loop when a queue's watcher is readable. Discards the events and wakes up all subscribers waiting for the queue
+        """
+
+        watcher.drain()
+        waiters = self.waiters.get(queue, set())
+        for future in waiters:
+            if not future.done():
+                future.set_result(True)
+
+        # stop reading until someone waits again, so the events don't pile up
+        waiters.clear()
+        asyncio.get_running_loop().remove_reader(watcher.fileno())
+
+
+
+    async def subscribe(self, queue, skip_cleaning=False, timeout=None):
+        """
+        Async generator that yields messages from a queue as they arrive. New messages are consumed in batches as places free up in the prefetch count, so ack or nack every message yielded (expired messages included). Messages that have been consumed but not yielded when the subscription ends are requeued
+
+        Args:
+            queue:          name of the queue to consume from
+            skip_cleaning:  if False, the client will first clean out any expired messages from the queue's work directory before each batch
+            timeout:        stop if no messages have arrived for this many seconds, None to wait forever
+
+        Returns:
+            an async generator of message objects
+        """
+
+        log.info('Subscribing to {}'.format(queue))
+
+        # the watcher has to exist before the first check, so no messages arriving in between are missed
+        watcher = await self.run(self.get_watcher, queue)
+
+        released = self.get_released()
+        pending = []
+        last_message = time.time()
+        try:
+            while True:
+
+                # wait for a place in the prefetch count
+                async with released:
+                    await released.wait_for(lambda: len(self.unacked) < self.prefetch)
+
+                messages = await self.run(self.broker.consume, queue, n=self.prefetch - len(self.unacked), skip_cleaning=skip_cleaning)
+                if messages:
+                    watcher.reset()
+                    last_message = time.time()
+
+                    # consume returns a single message when n=1
+                    pending = messages if type(messages) == list else [messages]
+                    while pending:
+                        msg = pending.pop(0)
+                        self.unacked.add((queue, os.path.basename(msg.filename)))
+                        yield msg
+                    continue
+
+                # messages in sharded queues are written to subfolders, watch any new ones and check again before waiting
+                if self.broker.is_sharded(queue):
+                    if await self.run(self.watch_shards, queue, watcher):
+                        continue
+
+                # calculate the time left to wait
+                remaining = None
+                if timeout is not None:
+                    remaining = last_message + timeout - time.time()
+                    if remaining <= 0:
+                        return
+
+                # if all subscribers are waiting nobody else cleans the queue, so wake up in time to clean it
+                if not skip_cleaning:
+                    cleaned, clean_wait = await self.run(self.broker.clean_expired, queue)
+                    if cleaned:
+                        continue
+                    if remaining is None or clean_wait < remaining:
+                        remaining = clean_wait
+
+                log.debug('Waiting for messages in {}'.format(queue))
+                await self.wait_for_files(queue, watcher, remaining)
+
+        finally:
+            # put back what the subscriber never got
+            if pending:
+                log.debug('Requeueing {} message(s) not given to the subscriber of {}'.format(len(pending), queue))
+                await self.run(self.broker.nack, queue, [msg.filename for msg in pending], requeue=True, skip_cleaning=True)
@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+"""
+Defines the blob class, a handle to the payload of a message that was too
+large to be stored in the message itself. When a queue's max_inline_bytes
+setting is set, the payloads of larger messages are written to a separate
+file in the queue's blobs folder, and the message only refers to it (a
+claim check). Consumed messages get a blob object as their message, which
+reads the payload from the file on demand, so consumers that only need the
+message's metadata never read it at all.
+
+>>> msg = b.consume('queue_name')
+>>> msg.message
+<blob ../temp/ddmq/queue_name/blobs/89723438b9d0403c91943f4ffaf8ba35.blob, 10485760 bytes>
+>>> with msg.message as payload:
+...     for chunk in payload:
+...         process(chunk)
+
+The blob file is removed when the message is acked, so read it before that.
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+
+# import standard modules
+import os
+
+# the number of bytes read at a time when iterating over a blob
+chunk_size = 1048576
+
+
+
+class blob(object):
+    """
+    Class to stream the payload of a message stored as a separate file
+    """
+
+    def __init__(self, path, info):
+        """
+        Initialize a handle to a blob file. The file is not opened until it is read
+
+        Args:
+            path:   path to the blob file
+            info:   the blob field of the message, a dict with the size of the payload and its type ('bytes' or 'str')
+
+        Returns:
+            None
+        """
+
+        self.path = path
+        self.size = info['size']
+        self.type = info['type']
+        self.handle = None
+
+
+    def read(self, size=-1):
+        """
+        Read from the blob file, starting where the last read stopped
+
+        Args:
+            size:   the maximum number of bytes to read, -1 to read the rest of the file
+
+        Returns:
+            the data read, as bytes
+        """
+
+        if self.handle is None:
+            self.handle = open(self.path, 'rb')
+        return self.handle.read(size)
+
+
+    def getvalue(self):
+        """
+        Read the whole payload, converted back to the type it was published as
+
+        Args:
+            None
+
+        Returns:
+            the payload, as bytes or str
+        """
+
+        with open(self.path, 'rb') as blob_handle:
+            data = blob_handle.read()
+
+        if self.type == 'str':
+            return data.decode('utf-8')
+        return data
+
+
+    def close(self):
+        """
+        Close the blob file, if it has been opened
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+    def __iter__(self):
+        """Iterate over the blob file in chunks of chunk_size bytes"""
+
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+    def __len__(self):
+        """The size of the payload in bytes"""
+        return self.size
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __repr__(self):
+        """Print the path and size of the blob"""
+        return '<blob {}, {} bytes>'.format(self.path, self.size)
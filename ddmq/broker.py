@@ -7,14 +7,23 @@ You define a broker by supplying at least a root directory, for example
 
 >>> b = ddmq.broker('../temp/ddmq', create=True)
 >>> print(b)
+backend = files
+backends = {}
+codec = None
+config_cache = {'../temp/ddmq/ddmq.yaml': ((1539702458123456789, 0, 1234567), {})}
 create = True
-default_settings = {'priority': 999, 'requeue': True, 'requeue_prio': 0, 'message_timeout': 600, 'cleaned': 0}
-global_settings = {'priority': 999, 'requeue': True, 'requeue_prio': 0, 'message_timeout': 600, 'cleaned': 0}
+default_settings = {'priority': 999, 'requeue': True, 'requeue_prio': 0, 'message_timeout': 600, 'index': False, 'padded_filenames': False, 'durability': 'none', 'shard_priority': 0, 'shard_time': 0, 'expiry_bucket': 0, 'clean_interval': 60, 'config_shadow': False, 'backend': 'files', 'codec': 'json', 'max_inline_bytes': 0, 'compression': 'none', 'compression_threshold': 1024}
+global_settings = {'priority': 999, 'requeue': True, 'requeue_prio': 0, 'message_timeout': 600, 'index': False, 'padded_filenames': False, 'durability': 'none', 'shard_priority': 0, 'shard_time': 0, 'expiry_bucket': 0, 'clean_interval': 60, 'config_shadow': False, 'backend': 'files', 'codec': 'json', 'max_inline_bytes': 0, 'compression': 'none', 'compression_threshold': 1024}
+indexes = {}
 queue_settings = {}
 root = ../temp/ddmq
+settings_checked = {}
+stats = {}
+watchers = {}
 
 
 >>> b.publish('queue_name', "Hello World!")
+blob = None
 filename = queue_name/999.1.ddmq89723438b9d0403c91943f4ffaf8ba35
 id = 89723438b9d0403c91943f4ffaf8ba35
 message = Hello World!
@@ -28,6 +37,7 @@ timeout = None
 
 
 >>> msg = b.consume('queue_name')
+blob = None
 filename = 1539702458.999.1.ddmq89723438b9d0403c91943f4ffaf8ba35
 id = 89723438b9d0403c91943f4ffaf8ba35
 message = Hello World!
@@ -56,26 +66,181 @@ except NameError:
 
 # import standard modules
 import os
-import uuid
 import json
 import time
 import fnmatch
 import logging as log
 import re
 import errno
+import binascii
+import importlib
+import itertools
 
-# import extra modules
-import yaml
+# import extra modules, yaml is imported when first needed (see get_yaml) to keep the command-line interface fast
+yaml = None
 try:
-    from .message import message
-except ValueError:
-    from message import message
+    from .message import message, receipt
+    from .index import queue_index
+    from .watcher import folder_watcher
+    from .blob import blob
+    from .codec import codecs, check_codec, encode, tagged_codec, map_raw, compressions, compress, decompress, is_compressed
+except (ValueError, ImportError):
+    from message import message, receipt
+    from index import queue_index
+    from watcher import folder_watcher
+    from blob import blob
+    from codec import codecs, check_codec, encode, tagged_codec, map_raw, compressions, compress, decompress, is_compressed
 
 # from IPython.core.debugger import Tracer
 # Tracer()()
 
 version = "0.9.14"
 
+# the number of digits used for priority and queue number in zero-padded file names
+priority_width = 10
+queue_number_width = 17
+
+# the minimum number of seconds between checks for changes in a queue's config files
+settings_check_interval = 1.0
+
+# suffix of the JSON shadow copies of config files, which are faster to load than the YAML. Must not match *.ddmq*
+config_shadow_suffix = '.json'
+
+# name of the lease file in a queue's work folder, its modification time is when the queue was last cleaned, which keeps this frequently changing state out of ddmq.yaml. Must not match *.ddmq*
+clean_lease = 'ddmq.clean'
+
+# raw encoded message files of at least this many bytes have their message mapped into memory instead of read, see codec.map_raw
+mmap_threshold = 65536
+
+# the clock used to measure the CPU time spent on compression
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+# prefix of the temporary files messages are written to before being renamed into place, must not match *.ddmq*
+tmp_prefix = '.tmp'
+
+# the valid durability levels when writing messages, in increasing order of safety
+durability_levels = ['none', 'file', 'dir']
+
+# names of the subfolders used when a queue is sharded. Waiting messages are sharded by priority band and publish time bucket, consumed messages by expiry time bucket
+shard_pattern = re.compile('^s\d+_\d+$')
+work_shard_pattern = re.compile('^e\d+$')
+
+# storage backends that can be used instead of one file per message (the default, 'files', is handled by the broker itself), as module and class names. They are imported when first used, see load_backend
+backends = {'segment': ('segment', 'segment_backend'), 'sqlite': ('sqlite', 'sqlite_backend')}
+
+# plain scalars in config files that mean something special to YAML, see parse_config
+yaml_true = ['true', 'True', 'TRUE']
+yaml_false = ['false', 'False', 'FALSE']
+yaml_null = ['null', 'Null', 'NULL']
+yaml_special = ['yes', 'Yes', 'YES', 'no', 'No', 'NO', 'on', 'On', 'ON', 'off', 'Off', 'OFF']
+config_line_pattern = re.compile('^([A-Za-z_][A-Za-z0-9_]*): (-?[1-9][0-9]*|0|[A-Za-z][A-Za-z0-9_]*)$')
+
+# fdatasync is not available on all systems
+try:
+    fdatasync = os.fdatasync
+except AttributeError:
+    fdatasync = os.fsync
+
+
+
+def get_yaml():
+    """
+    Import the yaml module the first time it is needed. Most commands never need it, since most config files can be read by parse_config
+
+    Args:
+        None
+
+    Returns:
+        the yaml module
+    """
+
+    global yaml
+    if yaml is None:
+        import yaml as yaml_module
+        yaml = yaml_module
+    return yaml
+
+
+
+def parse_config(text):
+    """
+    Parse a config file without the yaml module, if it only has the simple 'key: value' lines ddmq writes itself, with integers, booleans, null or plain words as values. Anything else is left to the yaml module
+
+    Args:
+        text:   the contents of the config file
+
+    Returns:
+        a dict with the settings, or None if the file has to be parsed by the yaml module
+    """
+
+    conf = {}
+    for line in text.splitlines():
+
+        # skip empty lines and comments
+        if not line.strip() or line.startswith('#'):
+            continue
+
+        match = config_line_pattern.match(line)
+        if not match:
+            return None
+
+        key, val = match.groups()
+        if key in yaml_true + yaml_false + yaml_null + yaml_special:
+            return None
+
+        if val in yaml_true:
+            conf[key] = True
+        elif val in yaml_false:
+            conf[key] = False
+        elif val in yaml_null:
+            conf[key] = None
+        elif val in yaml_special:
+            return None
+        elif val[0].isalpha():
+            conf[key] = val
+        else:
+            conf[key] = int(val)
+
+    return conf
+
+
+
+def load_backend(name):
+    """
+    Import the class of a storage backend. Backends are only imported when a queue using them is used, so e.g. sqlite3 is not imported by brokers that never need it
+
+    Args:
+        name:   name of the backend
+
+    Returns:
+        the backend class
+    """
+
+    module_name, class_name = backends[name]
+    if __package__:
+        module = importlib.import_module('.' + module_name, __package__)
+    else:
+        module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+
+def new_id():
+    """
+    Generate a random message id, 32 hex digits like uuid.uuid4().hex, without the cost of importing uuid
+
+    Args:
+        None
+
+    Returns:
+        the id, as str
+    """
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
 
 class DdmqError(Exception):
     """
@@ -103,7 +268,7 @@ class broker:
     Class to interact with messaging queues
     """
 
-    def __init__(self, root, create=False, verbose=False, debug=False):
+    def __init__(self, root, create=False, verbose=False, debug=False, backend=None, codec=None):
         """
         Initialize a broker object at a specified root directory. If the create flag is set to True it will create the directories needed if they are missing
 
@@ -112,6 +277,8 @@ class broker:
             create:     if True, all missing folders will be created without throwing errors
             verbose:    verbose logging to screen
             debug:      even more verbose logging to screen
+            backend:    the storage backend used for queues created by this broker object, 'files' (one file per message), 'segment' (append-only logs) or 'sqlite' (a SQLite database). Defaults to the backend setting in the root's ddmq.yaml. Existing queues always use the backend they were created with
+            codec:      the codec messages written by this broker object are encoded with, 'json', 'orjson', 'ujson', 'msgpack' or 'raw' (see codec.py). Defaults to the codec setting of each queue. Messages are decoded with the codec they were written with
 
         Returns:
             None
@@ -128,13 +295,31 @@ class broker:
 
         # settings
         self.default_settings = {  'message_timeout': 600, # the time in seconds after publishing a message expires
-                            'cleaned':0,            # epoch timestamp when a queue was last cleaned
+                            'clean_interval':60,    # the minimum number of seconds between cleanings of a queue, only one process gets to clean in each interval
+                            'config_shadow':False,  # True if a JSON copy of each ddmq.yaml file should be kept next to it, which is faster to load than the YAML. Only read from the root's ddmq.yaml
                             'priority':999,         # default message priority when published
                             'requeue':True,         # True if messages that are nacked are to be requeued, False will delete them 
                             'requeue_prio': 0,      # the priority requeued messages will have (0 = top priority)
+                            'index':False,          # True if a journal of the waiting messages should be kept, so consumers don't have to list and sort the queue folder
+                            'padded_filenames':False, # True if priority and queue number should be zero-padded in file names, so a plain string sort gives the right order
+                            'durability':'none',    # none = just rename written messages into place, file = also fdatasync the message file first, dir = also fsync the queue folder after the rename
+                            'shard_priority':0,     # if set, waiting messages are put in subfolders by priority band of this width
+                            'shard_time':0,         # if set, waiting messages are put in subfolders by time bucket of this many seconds, and consumed messages by expiry time bucket. The buckets of a priority band are listed together when consuming, so combine it with shard_priority
+                            'expiry_bucket':0,      # if set, consumed messages are put in subfolders by expiry time bucket of this many seconds, so cleaning only has to look at the buckets that have expired. Defaults to shard_time
+                            'backend':'files',      # how messages are stored, files = one file per message, segment = append-only logs (see segment.py), sqlite = a SQLite database (see sqlite.py)
+                            'max_inline_bytes':0,   # if set, message texts larger than this many bytes are stored as separate files in the queue's blobs folder, and consumers read them on demand (see blob.py)
+                            'compression':'none',   # compress messages before they are written, none, zlib, lzma or zstd (if the zstandard module is installed). Messages are always decompressed when read
+                            'compression_threshold':1024, # messages smaller than this many bytes (encoded) are not compressed
+                            'codec':'json',         # how messages are encoded, json, orjson, ujson, msgpack or raw (see codec.py). Not used by the segment backend, which always writes JSON lines
                                 }
         self.global_settings = {}
         self.queue_settings = {}
+        self.config_cache = {}
+        self.settings_checked = {}
+        self.indexes = {}
+        self.watchers = {}
+        self.stats = {}
+        self.backends = {}
         
         # make sure the root dir is initiated
         if self.check_dir(root, only_conf=True):
@@ -157,7 +342,7 @@ class broker:
                 if not os.path.isdir(root):
                     self.create_folder(root)
                 open(os.path.join(root, 'ddmq.yaml'), 'w').close()
-                open(os.path.join(root, 'ddmq.yaml.example'), 'w').write(yaml.dump(self.default_settings, default_flow_style=False))
+                open(os.path.join(root, 'ddmq.yaml.example'), 'w').write(get_yaml().dump(self.default_settings, default_flow_style=False))
 
             else:
                 if not os.path.isdir(root):
@@ -165,6 +350,15 @@ class broker:
                 else:
                     raise DdmqError("Root folder uninitiated!", "uninitiated")
 
+        # the backend new queues will be created with
+        self.backend = backend or self.global_settings['backend']
+        if self.backend != 'files' and self.backend not in backends:
+            raise ValueError("Unknown backend ({}). Valid backends are {}.".format(self.backend, ', '.join(['files'] + sorted(backends))))
+
+        # the codec messages are encoded with, if it should override the queues' settings
+        self.codec = codec
+        if self.codec:
+            check_codec(self.codec)
 
 
     def __repr__(self):
@@ -201,9 +395,28 @@ class broker:
 #     # #          #       #     #  #    ## #     # #     # 
  #####  #######    #       #    ### #     #  #####   #####  
                                                             
+    def get_config_key(self, path):
+        """
+        Get the key a config file is cached by, which changes whenever the file is changed or replaced
+                
+        Args:
+            path:   path to the config file
+
+        Returns:
+            a tuple with the modification time (in ns if available), size and inode of the file
+        """
+
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            # callers expect the same error as when opening a missing file
+            raise IOError(e.errno, e.strerror, path)
+        return (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size, stat.st_ino)
+
+
     def get_config_file(self, queue=''):
         """
-        Get the settings from the config file of a queue or the root dir
+        Get the settings from the config file of a queue or the root dir. The parsed file is cached, and only read again if a stat shows it has changed. If the file has a valid JSON shadow copy, that is read instead of the YAML
                 
         Args:
             queue:  if empty, returns the config file from the root folder. If a queue name, will get the config file for that queue
@@ -212,40 +425,145 @@ class broker:
             A dict containing all the settings specified in the config file
         """
 
-        log.debug('Reading config file {}'.format(os.path.join(self.root, queue, 'ddmq.yaml')))
+        config_path = os.path.join(self.root, queue, 'ddmq.yaml')
+        key = self.get_config_key(config_path)
+
+        try:
+            cached_key, conf = self.config_cache[config_path]
+            if cached_key == key:
+                return dict(conf)
+        except KeyError:
+            pass
+
+        conf = self.read_config_shadow(config_path, key)
+        if conf is None:
 
-        with open(os.path.join(self.root, queue, 'ddmq.yaml'), 'r') as settings_handle:
-            conf = yaml.load(settings_handle, Loader=yaml.SafeLoader)
-            if not conf:
-                return {}
-            return conf
+            log.debug('Reading config file {}'.format(config_path))
 
+            with open(config_path, 'r') as settings_handle:
+                text = settings_handle.read()
 
+            # most config files are simple enough to be read without the yaml module
+            conf = parse_config(text)
+            if conf is None:
+                conf = get_yaml().load(text, Loader=get_yaml().SafeLoader) or {}
 
+            # the root's config file decides if shadows are used, and could be the file just read
+            if self.use_config_shadow(queue, conf):
+                self.write_config_shadow(config_path, key, conf)
 
-    def get_settings(self, queue):
+        self.config_cache[config_path] = (key, conf)
+        return dict(conf)
+
+
+    def use_config_shadow(self, queue, conf):
         """
-        Get the settings for the specified queue. Will try to give a cached version first, and if it is the first time the settings are requested it will read the settings from the config file and store the result
+        Check if JSON shadow copies of the config files should be written. This is decided by the config_shadow setting in the root's config file only, since the queues' config files get all the default settings written to them when created
                 
         Args:
-            queue:  name of the queue to get settings for
+            queue:  name of the queue the config file belongs to, empty for the root
+            conf:   the settings in the config file
+
+        Returns:
+            True if shadows should be written
+        """
+
+        if not queue:
+            return conf.get('config_shadow', False)
+        return self.global_settings.get('config_shadow', False)
+
+
+    def read_config_shadow(self, config_path, key):
+        """
+        Read the JSON shadow copy of a config file, if it exists and was made from the current version of the config file
+                
+        Args:
+            config_path:    path to the config file
+            key:            the current cache key of the config file, see get_config_key
+
+        Returns:
+            A dict containing all the settings specified in the config file, or None if there is no valid shadow
+        """
+
+        try:
+            with open(config_path+config_shadow_suffix, 'r') as shadow_handle:
+                shadow = json.load(shadow_handle)
+        except (FileNotFoundError, IOError, OSError, ValueError):
+            return None
+
+        if shadow.get('key') != list(key):
+            return None
+        return shadow['settings']
+
+
+    def write_config_shadow(self, config_path, key, conf):
+        """
+        Write a JSON shadow copy of a config file, tagged with the cache key of the version it was made from
+                
+        Args:
+            config_path:    path to the config file
+            key:            the cache key of the config file, see get_config_key
+            conf:           the settings in the config file
 
         Returns:
             None
         """
-        
-        log.debug('Updating settings from config file {}'.format(os.path.join(self.root, queue, 'ddmq.yaml')))
 
+        shadow_path = config_path+config_shadow_suffix
+        tmp_path = '{}.{}.intermediate'.format(shadow_path, os.getpid())
         try:
+            with open(tmp_path, 'w') as shadow_handle:
+                json.dump({'key':list(key), 'settings':conf}, shadow_handle)
+            os.rename(tmp_path, shadow_path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            # the shadow is only an optimization
+            log.debug('Unable to write config shadow {}: {}'.format(shadow_path, e))
+
+
+
+
+    def get_settings(self, queue):
+        """
+        Get the settings for the specified queue. Will give a cached version if the config files of the queue and the root have not changed, which is checked at most once every settings_check_interval seconds
+                
+        Args:
+            queue:  name of the queue to get settings for
+
+        Returns:
+            a dict with the queue's settings
+        """
+
+        now = time.time()
+        if queue in self.queue_settings and self.settings_checked.get(queue, 0) > now - settings_check_interval:
             return self.queue_settings[queue]
-        except KeyError:
 
-            # must be the first time the queue settings are requested, fetch them from file and store for later
-            with open(os.path.join(self.root, queue, 'ddmq.yaml'), 'r') as fh:
-                queue_settings = yaml.load(fh, Loader=yaml.SafeLoader)
-                self.queue_settings[queue] = self.global_settings.copy()
-                self.queue_settings[queue].update(queue_settings)
-                return self.queue_settings[queue]
+        # the config files are only parsed again if they have changed
+        self.global_settings = self.default_settings.copy()
+        self.global_settings.update(self.get_config_file())
+        queue_settings = self.get_config_file(queue)
+
+        settings = self.global_settings.copy()
+        settings.update(queue_settings)
+
+        if settings['durability'] not in durability_levels:
+            raise ValueError("Unknown durability level in {} ({}). Valid levels are {}.".format(os.path.join(self.root, queue, 'ddmq.yaml'), settings['durability'], ', '.join(durability_levels)))
+
+        if settings['backend'] != 'files' and settings['backend'] not in backends:
+            raise ValueError("Unknown backend in {} ({}). Valid backends are {}.".format(os.path.join(self.root, queue, 'ddmq.yaml'), settings['backend'], ', '.join(['files'] + sorted(backends))))
+
+        if settings['compression'] not in compressions:
+            raise ValueError("Unknown compression in {} ({}). Valid compressions are {}.".format(os.path.join(self.root, queue, 'ddmq.yaml'), settings['compression'], ', '.join(compressions)))
+
+        if settings['codec'] not in codecs:
+            raise ValueError("Unknown codec in {} ({}). Valid codecs are {}.".format(os.path.join(self.root, queue, 'ddmq.yaml'), settings['codec'], ', '.join(codecs)))
+
+        # keep the same dict object if nothing has changed
+        if self.queue_settings.get(queue) != settings:
+            log.debug('Updating settings from config file {}'.format(os.path.join(self.root, queue, 'ddmq.yaml')))
+            self.queue_settings[queue] = settings
+        self.settings_checked[queue] = now
+
+        return self.queue_settings[queue]
 
 
 
@@ -272,11 +590,21 @@ class broker:
         # update and write the new
         with open(config_path+'.intermediate', 'w') as settings_handle:
             current_settings.update(package)
-            settings_handle.write(yaml.dump(current_settings, default_flow_style=False))
+            settings_handle.write(get_yaml().dump(current_settings, default_flow_style=False))
         
         # replace the old settings file with the new
         os.rename(config_path+'.intermediate', config_path)
 
+        # cache the new settings right away, and make sure the queue's (or all queues', for the root) settings are checked again
+        key = self.get_config_key(config_path)
+        self.config_cache[config_path] = (key, current_settings)
+        if self.use_config_shadow(queue, current_settings):
+            self.write_config_shadow(config_path, key, current_settings)
+        if queue:
+            self.settings_checked.pop(queue, None)
+        else:
+            self.settings_checked = {}
+
 
 
 
@@ -289,39 +617,55 @@ class broker:
 #     # #       #       #     # #    ##  #  #    ## #     # 
  #####  ####### ####### #     # #     # ### #     #  #####  
 
-    def clean(self, queue, force=False):
+    def clean(self, queue, force=False, since=None):
         """
-        Clean out expired message from a specified queue
+        Clean out expired message from a specified queue. Only one process per queue gets to clean in each clean interval, the others will skip it after a single stat call
         
         Args:
             queue:                  name of the queue to clean
+            force:                  if True, clean even if the queue was cleaned recently or another process is cleaning it
+            since:                  an epoch time, e.g. when a consumed message expired. If the queue has not been cleaned since then, clean it even if the clean interval has not passed
 
         Returns:
             True if everything goes according to plan, False if no cleaning was done
         """
 
-        # only proceede if enough time as passed since last cleaning, unless forced
-        if not force and (not self.queue_settings[queue]['cleaned'] < int(time.time())-60):
+        # load the queue's settings
+        self.get_settings(queue)
+
+        # only proceede if enough time as passed since last cleaning and no other process got there first, unless forced
+        if not self.take_clean_lease(queue, since) and not force:
             return False
         
         log.info('Cleaning {}'.format(queue))
+        now = int(time.time())
 
-        # load the queue's settings
-        self.get_settings(queue)
+        # let the queue's backend handle it, if it is not stored as files
+        backend = self.get_backend(queue)
+        if backend:
+            # the backend gives the work file names of the messages it removed, so their blobs can be removed too
+            self.remove_blobs(queue, backend.clean(queue))
+            messages = []
+
+        # only look in the expiry buckets that have expired, if used
+        elif self.get_expiry_bucket(queue):
+            messages = self.list_expired(queue, now)
 
         # list all files in queues work folder
-        # try:
-        messages = fnmatch.filter(os.listdir(os.path.join(self.root, queue, 'work')), '*.ddmq*')
+        else:
+            messages = self.list_messages(queue, work=True)
 
         # for each message file
-        for msg_filename in messages:
+        removed = []
+        for msg_relpath in messages:
 
             # handle messages that have expired
+            msg_filename = os.path.basename(msg_relpath)
             msg_expiry_time = int(msg_filename.split('.')[0])
-            if msg_expiry_time < int(time.time()):
+            if msg_expiry_time < now:
 
                 # construct the file path
-                msg_filepath = os.path.join(self.root, queue, 'work', msg_filename)
+                msg_filepath = os.path.join(self.root, queue, 'work', msg_relpath)
 
                 try:
                     # load the message from the file
@@ -331,27 +675,28 @@ class broker:
                     print("Warning: while cleaning, message file {} was missing. This could be due to another process operating on the queue at the same time. It should be pretty rare, so if it happens often it could be some other problem causing it.".format(msg_filepath))
                     continue
 
-                # requeue if it should be
-                if msg.requeue:
-
-                    # change priority to default value
-                    msg.priority = self.queue_settings[queue]['requeue_prio']
-
-                    # check if custom requeue prio is set
-                    if type(msg.requeue) == int:
-                        msg.priority = msg.requeue
+                try:
+                    # requeue if it should be, unless the requeue limit has been reached
+                    if msg.requeue and (not msg.requeue_limit or msg.requeue_counter < msg.requeue_limit):
+                        self.requeue_message(msg_filepath, msg)
+
+                    # otherwise delete the message file
+                    else:
+                        os.remove(msg_filepath)
+                        removed.append(msg_filename)
+                except (FileNotFoundError, IOError, OSError) as e:
+                    # the consumer could have acked it since the listdir was run
+                    print("Warning: while cleaning, message file {} was missing. This could be due to another process operating on the queue at the same time. It should be pretty rare, so if it happens often it could be some other problem causing it.".format(msg_filepath))
+                    continue
 
-                    # unless the requeue limit has been reached
-                    if not msg.requeue_limit or msg.requeue_counter < msg.requeue_limit:
-                        
-                        # requeue the message
-                        self.publish(queue=msg.queue, msg_text=msg.message, priority=msg.priority, requeue=msg.requeue, requeue_counter=msg.requeue_counter+1, requeue_limit=msg.requeue_limit, skip_cleaning=True)
+        # remove the blob files of the removed messages, if they have any
+        self.remove_blobs(queue, removed)
 
-                # then delete the old message file
-                os.remove(os.path.join(self.root, queue, 'work', msg_filename))
+        # remove shards and buckets that have been emptied
+        if not backend and (self.is_sharded(queue) or self.get_expiry_bucket(queue)):
+            self.remove_empty_shards(queue)
         
-        # update the timestamp for when the queue was last cleaned
-        self.update_settings_file(queue, {'cleaned':int(time.time())})
+        # the time the queue was last cleaned is kept by the clean lease, see last_cleaned
         return True
 
 
@@ -424,20 +769,24 @@ class broker:
             queue:  name of the queue to get messages from
 
         Returns:
-            returns 2 lists of file names. The first is the list of all messages still waiting in the queue and the second is a list of all the messages in the queue's work directory
+            returns 2 lists of file names (paths relative to the queue or work folder for sharded queues). The first is the list of all messages still waiting in the queue and the second is a list of all the messages in the queue's work directory
         """
 
         log.debug('Listing messages in queue {}'.format(queue))
+
+        backend = self.get_backend(queue)
+        if backend:
+            return backend.list(queue)
         
-        # list all files in queue folder
+        # list all files in queue folder, including shard subfolders
         # try:
-        messages = fnmatch.filter(os.listdir(os.path.join(self.root, queue)), '*.ddmq*')
+        messages = self.list_messages(queue)
         # except (FileNotFoundError, OSError) as e:
         #     messages = []
 
         # list all files in queue work folder
         # try:
-        work_messages = fnmatch.filter(os.listdir(os.path.join(self.root, queue, 'work')), '*.ddmq*')
+        work_messages = self.list_messages(queue, work=True)
         # except (FileNotFoundError, OSError) as e:
         #     # the work folder is not really needed to be able to publish messages, and a missing work folder will be handled by the consume function if needed
         #     work_messages = []
@@ -459,25 +808,49 @@ class broker:
         log.info('Deleting queue {}'.format(queue))
 
         # gee, don't want to mess this up, do we..
+        # remove the files of the queue's backend first, if it is not stored as files
+        backend = self.get_backend(queue)
+        if backend:
+            backend.delete(queue)
+
         # remove all ddmq files from the work folder if it exists
         try:
-            for msg in fnmatch.filter(os.listdir(os.path.join(self.root, queue, 'work')), '*.ddmq*'):
+            for msg in self.list_messages(queue, work=True):
                 os.remove(os.path.join(self.root, queue, 'work', msg))
-            # remove the work dir itself
+            # remove the work shards, the clean lease and the work dir itself
+            for shard in self.list_shards(queue, work=True):
+                os.rmdir(os.path.join(self.root, queue, 'work', shard))
+            for lease_file in [clean_lease, clean_lease+'.lock']:
+                if os.path.exists(os.path.join(self.root, queue, 'work', lease_file)):
+                    os.remove(os.path.join(self.root, queue, 'work', lease_file))
             os.rmdir(os.path.join(self.root, queue, 'work'))
         except (FileNotFoundError, OSError) as e:
             pass
 
-        # remove all ddmq files in the queue folder
-        for msg in fnmatch.filter(os.listdir(os.path.join(self.root, queue)), '*.ddmq*'):
-            os.remove(os.path.join(self.root, queue, msg))
+        # remove all ddmq files in the queue folder and its shards, and any temporary files left by publishers that crashed
+        for folder in [''] + self.list_shards(queue):
+            queue_files = os.listdir(os.path.join(self.root, queue, folder))
+            for msg in fnmatch.filter(queue_files, '*.ddmq*') + fnmatch.filter(queue_files, tmp_prefix+'*'):
+                os.remove(os.path.join(self.root, queue, folder, msg))
+            if folder:
+                os.rmdir(os.path.join(self.root, queue, folder))
         
-        # remove the queue settings file if existing
-        try:
-            os.remove(os.path.join(self.root, queue, 'ddmq.yaml'))
-            os.remove(os.path.join(self.root, queue, 'ddmq.yaml.intermediate'))
-        except (FileNotFoundError, OSError):
-            pass
+        # remove the blobs folder if existing
+        self.clear_blobs(queue, delete=True)
+
+        # remove the index journal if existing
+        self.get_index(queue).clear()
+        del self.indexes[queue]
+        self.queue_settings.pop(queue, None)
+
+        # remove the queue settings file and its shadow if existing
+        for config_file in ['ddmq.yaml', 'ddmq.yaml.intermediate', 'ddmq.yaml'+config_shadow_suffix]:
+            try:
+                os.remove(os.path.join(self.root, queue, config_file))
+            except (FileNotFoundError, OSError):
+                pass
+        self.config_cache.pop(os.path.join(self.root, queue, 'ddmq.yaml'), None)
+        self.settings_checked.pop(queue, None)
 
         try:
             os.rmdir(os.path.join(self.root, queue))
@@ -503,8 +876,16 @@ class broker:
         # create the folders a queue needs
         self.create_folder(os.path.join(self.root, queue))
         self.create_folder(os.path.join(self.root, queue, 'work'))
+
+        # the queue remembers which backend it was created with
+        settings = self.default_settings.copy()
+        settings['backend'] = self.backend
         with open(os.path.join(self.root, queue, 'ddmq.yaml'), 'w') as fh:
-                    fh.write(yaml.dump(self.default_settings, default_flow_style=False))
+                    fh.write(get_yaml().dump(settings, default_flow_style=False))
+
+        backend = self.get_backend(queue)
+        if backend:
+            backend.create_queue(queue)
         return True
 
 
@@ -537,16 +918,17 @@ class broker:
 
         # check if the path is a message object
         if path.__class__ == message:
+            msg = path
 
             # check if the message has been consumed already
-            match = re.search('^\d+\.\d+\.\d+\.ddmq[a-zA-Z0-9]+$', path.filename)
+            match = re.search('^\d+\.\d+\.\d+\.ddmq[a-zA-Z0-9]+$', msg.filename)
             if match:
-                path = os.path.join(self.root, path.queue, 'work', path.filename)
+                path = self.locate_work_message(msg.queue, msg.filename) or self.get_work_path(msg.queue, msg.filename)
 
             # check if the message has not yet been consumed
-            match = re.search('^\d+\.\d+\.ddmq[a-zA-Z0-9]+$', path.filename)
+            match = re.search('^\d+\.\d+\.ddmq[a-zA-Z0-9]+$', msg.filename)
             if match:
-                path = os.path.join(self.root, path.queue, 'work', path.filename)
+                path = os.path.join(self.root, msg.queue, self.get_shard(msg.queue, msg.filename), msg.filename)
 
 
         log.info('Deleting message {}'.format(path))
@@ -576,26 +958,96 @@ class broker:
 
         log.info('Purging {}'.format(queue))
 
+        # the blobs of all messages can go
+        self.clear_blobs(queue)
+
+        backend = self.get_backend(queue)
+        if backend:
+            return backend.purge(queue)
+
         # init
         removed = 0
         removed_work = 0
 
         # remove all ddmq files from the work folder if it exists
         try:
-            for msg in fnmatch.filter(os.listdir(os.path.join(self.root, queue, 'work')), '*.ddmq*'):
+            for msg in self.list_messages(queue, work=True):
                 os.remove(os.path.join(self.root, queue, 'work', msg))
                 removed_work += 1
         except (FileNotFoundError, OSError) as e:
             pass
 
-        # remove all ddmq files in the queue folder
-        for msg in fnmatch.filter(os.listdir(os.path.join(self.root, queue)), '*.ddmq*'):
-            os.remove(os.path.join(self.root, queue, msg))
-            removed += 1
+        # remove all ddmq files in the queue folder and its shards
+        for folder in [''] + self.list_shards(queue):
+            queue_files = os.listdir(os.path.join(self.root, queue, folder))
+            for msg in fnmatch.filter(queue_files, '*.ddmq*'):
+                os.remove(os.path.join(self.root, queue, folder, msg))
+                removed += 1
+
+            # and any temporary files left by publishers that crashed
+            for tmp_file in fnmatch.filter(queue_files, tmp_prefix+'*'):
+                try:
+                    os.remove(os.path.join(self.root, queue, folder, tmp_file))
+                except (FileNotFoundError, OSError):
+                    pass
+
+        self.remove_empty_shards(queue)
+
+        # the index will be rebuilt from the empty folder next time it is used
+        self.get_index(queue).clear()
         
         return removed, removed_work
 
 
+    def migrate_queue(self, queue, padded=True):
+        """
+        Rename all messages waiting in a queue to the zero-padded (or the old unpadded) naming scheme, and change the queue's settings to use it for new messages. The messages are also moved into the shard subfolders they belong in, if the queue's shard settings have changed. Messages in the work folder keep their names so they can still be acked by the consumers that hold them.
+        
+        Args:
+            queue:  name of the queue to migrate
+            padded: True to migrate to zero-padded file names, False to migrate back to unpadded file names
+
+        Returns:
+            the number of messages that were renamed
+        """
+
+        log.info('Migrating {} to {} file names'.format(queue, 'padded' if padded else 'unpadded'))
+
+        if self.get_backend(queue):
+            raise ValueError('Only queues using the files backend can be migrated ({} uses {})'.format(queue, self.get_settings(queue)['backend']))
+
+        # make new messages use the new naming scheme first
+        self.update_settings_file(queue, {'padded_filenames':padded})
+        self.queue_settings.pop(queue, None)
+        self.indexes.pop(queue, None)
+        self.get_settings(queue)
+
+        renamed = 0
+        for msg_relpath in self.list_messages(queue):
+
+            priority, queue_number, id = self.parse_filename(msg_relpath)
+
+            # unpadded queue numbers are written in microseconds too, for consistency
+            new_filename = self.get_filename(queue, priority, queue_number, id)
+            new_relpath = os.path.join(self.get_shard(queue, new_filename), new_filename)
+            if new_relpath == msg_relpath:
+                continue
+
+            try:
+                self.move_message(os.path.join(self.root, queue, msg_relpath), os.path.join(self.root, queue, new_relpath))
+            except (FileNotFoundError, OSError) as e:
+                # race conditions could cause files being consumed since the listdir was run
+                print("Warning: while migrating, message file {} was missing. This could be due to another process operating on the queue at the same time.".format(os.path.join(self.root, queue, msg_relpath)))
+                continue
+            renamed += 1
+
+        # the index is rebuilt from the renamed files next time it is used
+        self.get_index(queue).clear()
+        self.remove_empty_shards(queue)
+
+        return renamed
+
+
     def get_message(self, path):
         """
         Get a specified message
@@ -609,19 +1061,45 @@ class broker:
 
         log.debug('Fetching message {}'.format(path))
 
-        # load the message from the file
-        with open(path, 'r') as msg_handle:
-             return message.json2msg(json.load(msg_handle))
+        # load the message from the file, it is decoded when used
+        with open(path, 'rb') as msg_handle:
+             return self.read_message(msg_handle)
+
+
+
+    def read_message(self, msg_handle, queue=None):
+        """
+        Read a message from an open message file. Large messages written by the raw codec are mapped into memory instead of read, and their message is a memoryview of the file contents (see codec.map_raw). Compressed messages are decompressed
+        
+        Args:
+            msg_handle: the message file, opened in binary mode
+            queue:      name of the queue the message is in, if known, to count the decompression in its statistics
+
+        Returns:
+            a message object
+        """
+
+        if os.fstat(msg_handle.fileno()).st_size >= mmap_threshold:
+            head = msg_handle.read(1)
+            if not is_compressed(head) and tagged_codec(head) == 'raw':
+                return message.from_dict(map_raw(msg_handle.fileno()))
+            msg_handle.seek(0)
+
+        data = msg_handle.read()
+        if is_compressed(data):
+            data = self.decompress(queue, data)
+        return message.from_bytes(data)
 
 
 
 
     def requeue_message(self, path, msg=None):
         """
-        Requeue a specified message
+        Requeue a specified message. The message file is updated in place with the requeue priority and counter, and then renamed back into the queue folder under a new name, keeping its id
         
         Args:
-            path:   path to the message to requeue
+            path:   path to the message to requeue, assumed to be consumed and located in the work dir
+            msg:    the message object, if already loaded from the file
 
         Returns:
             True if everything goes according to plan
@@ -629,29 +1107,47 @@ class broker:
 
         log.debug('Requeuing message {}'.format(path))
 
-        
-
         # load the message from the file
         if not msg:
             msg = self.get_message(path)
 
         # load the queue's settings
-        self.get_settings(msg.queue)
-
-        # requeue if it should be
-
-        # change priority to default value
-        msg.priority = self.queue_settings[msg.queue]['requeue_prio']
-
-        # check if custom requeue prio is set
-        if type(msg.requeue) == int:
-            msg.priority = msg.requeue
+        queue = msg.queue
+        self.get_settings(queue)
 
-        # requeue the message
-        self.publish(queue=msg.queue, msg_text=msg.message, priority=msg.priority, requeue=msg.requeue, requeue_counter=msg.requeue_counter+1, requeue_limit=msg.requeue_limit, skip_cleaning=True)
+        # change the priority, queue number and file name, and count the requeue
+        package = self.requeue_package(queue, msg.to_dict())
 
-        # then delete the old message file, assumes the message is consumed and located in the work dir
-        os.remove(os.path.join(self.root, msg.queue, 'work', os.path.split(path)[-1]))
+        # rewrite the message file where it is, nobody else is supposed to touch it while it is in the work dir.
+        # messages written with a codec that has a header byte keep that codec, so e.g. bytes messages stay encodable
+        fd = os.open(path, os.O_RDWR)
+        try:
+            head = os.read(fd, 1)
+            if is_compressed(head):
+                head += os.read(fd, os.fstat(fd).st_size)
+            codec = tagged_codec(head) or self.get_codec(queue)
+            if codec != 'raw':
+                os.ftruncate(fd, 0)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, self.compress(queue, encode(package, codec)))
+                if self.queue_settings[queue]['durability'] != 'none':
+                    fdatasync(fd)
+        finally:
+            os.close(fd)
+
+        # raw encoded messages can be mapped into memory by whoever read them (see read_message), and truncating a mapped file crashes the reader, so it is replaced by a new file instead
+        if codec == 'raw':
+            self.write_message_file(queue, os.path.relpath(path, os.path.join(self.root, queue)), self.compress(queue, encode(package, codec)))
+
+        # and move it back into the queue
+        msg_path = os.path.join(self.get_shard(queue, package['filename']), package['filename'])
+        self.move_message(path, os.path.join(self.root, queue, msg_path))
+        if self.queue_settings[queue]['durability'] == 'dir':
+            self.sync_folder(os.path.dirname(os.path.join(self.root, queue, msg_path)))
+
+        # add the message to the queue's index if it is used
+        if self.queue_settings[queue]['index']:
+            self.get_index(queue).add([msg_path])
 
         return True
 
@@ -707,93 +1203,944 @@ class broker:
                 return True
 
 
-    def get_queue_number(self):
+    def is_sharded(self, queue):
         """
-        Generate the next incremental queue number for a specified queue (epoch time of creation without the decimal punctuation)
+        Check if a specified queue uses sharded subfolders
         
         Args:
-            None
+            queue:  name of the queue
 
         Returns:
-            a string that is the current timestamp, with the decimal punctuation removed
+            True if the queue is sharded
         """
-        
-        log.debug('Generating next queue number')
 
-        return str(time.time()).replace('.', '')
+        settings = self.get_settings(queue)
+        return bool(settings['shard_priority'] or settings['shard_time'])
 
 
-    def create_folder(self, path):
+    def get_shard(self, queue, filename):
         """
-        Create a folder at a specified path
+        Get the name of the subfolder a waiting message belongs in, based on its priority band and the time bucket it was published in
         
         Args:
-            path:   path to the directory to be created
+            queue:      name of the queue the message belongs to
+            filename:   the file name of the message
 
         Returns:
-            None
+            the name of the subfolder, or an empty string if the queue is not sharded
         """
-        
-        log.info('Creating folder: {}'.format(path))
 
-        # it's ok if the folder already exists
-        try:
-            os.mkdir(path)
-        except OSError as exc:
-            if exc.errno != errno.EEXIST:
-                raise
-            pass
+        settings = self.get_settings(queue)
+        if not (settings['shard_priority'] or settings['shard_time']):
+            return ''
 
+        priority, queue_number, id = self.parse_filename(filename)
+        return self.format_shard(settings, priority, queue_number)
 
 
+    def format_shard(self, settings, priority, queue_number):
+        """
+        Construct the name of the subfolder of a sharded queue a waiting message belongs in
+        
+        Args:
+            settings:       the settings of the queue
+            priority:       the priority of the message
+            queue_number:   the queue number of the message, as an int
 
+        Returns:
+            the name of the subfolder
+        """
 
-### #     # ####### ####### ######     #     #####  ####### 
- #  ##    #    #    #       #     #   # #   #     #    #    
- #  # #   #    #    #       #     #  #   #  #          #    
- #  #  #  #    #    #####   ######  #     # #          #    
- #  #   # #    #    #       #   #   ####### #          #    
- #  #    ##    #    #       #    #  #     # #     #    #    
-### #     #    #    ####### #     # #     #  #####     #    
+        band = 0
+        if settings['shard_priority']:
+            band = priority // settings['shard_priority'] * settings['shard_priority']
 
-    def publish(self, queue, msg_text=None, priority=None, skip_cleaning=True, requeue=True, requeue_prio=None, timeout=None, requeue_counter=0, requeue_limit=None):
+        bucket = 0
+        if settings['shard_time']:
+            bucket = queue_number // 1000000 // settings['shard_time'] * settings['shard_time']
+
+        return 's{:0{}d}_{:012d}'.format(band, priority_width, bucket)
+
+
+    def get_expiry_bucket(self, queue):
         """
-        Publish a message to a queue
+        Get the width in seconds of the expiry time buckets used for a specified queue's work folder
         
         Args:
-            queue:          name of the queue to publish to
-            msg_text:       the actual message
-            priority:       the priority of the message (default 999). Lower number means higher priority when processing
-            skip_cleaning:  if False, the client will first clean out any expired messages from the queue's work directory. If True, the client will just publish the message right away and not bother doing any cleaning first (faster).
-            requeue:        if True, the message will be requeud after it expires. If False it will just be deleted.
-            requeue_prio:   if set (int), the message will get this priority when requeued. Default is 0, meaning requeued messages will be put first in the queue.
-            timeout:        if set (int), will override the global and queue specific default setting for how many seconds a message expires after.
+            queue:  name of the queue
 
         Returns:
-            a copy of the message published
+            the bucket width, or 0 if the work folder is not bucketed
         """
 
-        log.info('Publishing message to {}'.format(queue))
+        settings = self.get_settings(queue)
+        return settings['expiry_bucket'] or settings['shard_time']
 
-        # load the queue's settings
-        try:
-            self.get_settings(queue)
-        except (FileNotFoundError, IOError):
-            # create the queue if asked to
-            if self.create:
-                self.create_queue(queue)
-            self.get_settings(queue)
 
-        # clean the queue unless asked not to
-        if not skip_cleaning:
-            self.clean(queue)
+    def get_work_path(self, queue, filename):
+        """
+        Get the path to a consumed message in the work folder. If the queue uses expiry buckets (or is sharded by time), consumed messages are put in subfolders by expiry time bucket
+        
+        Args:
+            queue:      name of the queue the message belongs to
+            filename:   the file name of the consumed message
 
-        # if no message is given, set it to an empty string
-        if not msg_text:
-            msg_text = ''
+        Returns:
+            the path to the message file
+        """
+
+        width = self.get_expiry_bucket(queue)
+        if not width:
+            return os.path.join(self.root, queue, 'work', filename)
+
+        bucket = int(filename.split('.')[0]) // width * width
+        return os.path.join(self.root, queue, 'work', 'e{:012d}'.format(bucket), filename)
+
+
+    def locate_work_message(self, queue, filename):
+        """
+        Find a consumed message in the work folder, looking in both the sharded and the flat layout in case the queue's settings changed while it was consumed
+        
+        Args:
+            queue:      name of the queue the message belongs to
+            filename:   the file name of the consumed message
+
+        Returns:
+            the path to the message file, or None if it does not exist
+        """
+
+        path = self.get_work_path(queue, filename)
+        if os.path.isfile(path):
+            return path
+
+        flat_path = os.path.join(self.root, queue, 'work', filename)
+        if flat_path != path and os.path.isfile(flat_path):
+            return flat_path
+
+        return None
+
+
+    def list_shards(self, queue, work=False):
+        """
+        List the shard subfolders of a queue, in the order they should be consumed (or expire)
+        
+        Args:
+            queue:  name of the queue
+            work:   if True, list the shards of the work folder instead
+
+        Returns:
+            a sorted list of subfolder names
+        """
+
+        if work:
+            return sorted(name for name in os.listdir(os.path.join(self.root, queue, 'work')) if work_shard_pattern.match(name))
+        return sorted(name for name in os.listdir(os.path.join(self.root, queue)) if shard_pattern.match(name))
+
+
+    def list_messages(self, queue, work=False):
+        """
+        List all message files in a queue (or its work folder), including the ones in shard subfolders
+        
+        Args:
+            queue:  name of the queue
+            work:   if True, list the messages in the work folder instead
+
+        Returns:
+            a list of paths to the message files, relative to the queue (or work) folder
+        """
+
+        folder = os.path.join(self.root, queue)
+        if work:
+            folder = os.path.join(folder, 'work')
+            pattern = work_shard_pattern
+        else:
+            pattern = shard_pattern
+
+        entries = os.listdir(folder)
+        messages = fnmatch.filter(entries, '*.ddmq*')
+        for shard in entries:
+            if pattern.match(shard):
+                try:
+                    messages += [os.path.join(shard, msg) for msg in fnmatch.filter(os.listdir(os.path.join(folder, shard)), '*.ddmq*')]
+                except (FileNotFoundError, OSError):
+                    # the shard could have been removed since the listdir was run
+                    pass
+        return messages
+
+
+    def list_expired(self, queue, now):
+        """
+        List the expired messages in a queue's work folder. The expiry buckets are checked in order, and the listing stops at the first bucket that starts after the given time, so messages that have not expired yet are not listed at all
+        
+        Args:
+            queue:  name of the queue
+            now:    the epoch time messages have to expire before
+
+        Returns:
+            a list of paths to the expired message files, relative to the work folder, bucket by bucket
+        """
+
+        folder = os.path.join(self.root, queue, 'work')
+        entries = os.listdir(folder)
+
+        # messages consumed before the queue used buckets
+        messages = fnmatch.filter(entries, '*.ddmq*')
+
+        for shard in sorted(name for name in entries if work_shard_pattern.match(name)):
+
+            # everything in this bucket and the following ones expires later
+            if int(shard[1:]) >= now:
+                break
+
+            try:
+                messages += [os.path.join(shard, msg) for msg in fnmatch.filter(os.listdir(os.path.join(folder, shard)), '*.ddmq*')]
+            except (FileNotFoundError, OSError):
+                # the shard could have been removed since the listdir was run
+                pass
+
+        # check the names too, the last bucket may be only partly expired and the bucket width could have changed
+        return [msg for msg in messages if int(os.path.basename(msg).split('.')[0]) < now]
+
+
+    def iter_messages(self, queue):
+        """
+        Generator that lists the messages waiting in a queue in the order they should be consumed. For sharded queues only one priority band at a time is listed, starting with the one with the highest priority. The time buckets of a band are listed together, since a newer bucket can hold messages with a higher priority (e.g. requeued ones), so with shard_time but no shard_priority the whole queue is listed.
+        
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            a generator of paths to the message files, relative to the queue folder
+        """
+
+        folder = os.path.join(self.root, queue)
+
+        # zero-padded file names can be sorted as they are
+        key = None
+        if not self.queue_settings[queue]['padded_filenames']:
+            key = self.sort_key
+
+        entries = os.listdir(folder)
+        for msg in sorted(fnmatch.filter(entries, '*.ddmq*'), key=key):
+            yield msg
+
+        # shard names start with the band, so the time buckets of a band are next to each other
+        shards = sorted(name for name in entries if shard_pattern.match(name))
+        for band, band_shards in itertools.groupby(shards, key=lambda shard: shard.split('_')[0]):
+            band_messages = []
+            for shard in band_shards:
+                try:
+                    shard_messages = fnmatch.filter(os.listdir(os.path.join(folder, shard)), '*.ddmq*')
+                except (FileNotFoundError, OSError):
+                    # the shard could have been removed since the listdir was run
+                    continue
+                band_messages += [(key(msg) if key else msg, os.path.join(shard, msg)) for msg in shard_messages]
+            for sort_value, msg in sorted(band_messages):
+                yield msg
+
+
+    def remove_empty_shards(self, queue):
+        """
+        Remove shard subfolders that are empty. Publishers recreate a shard if it is removed while they are writing to it.
+        
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            None
+        """
+
+        folders = [os.path.join(self.root, queue, shard) for shard in self.list_shards(queue)]
+        folders += [os.path.join(self.root, queue, 'work', shard) for shard in self.list_shards(queue, work=True)]
+        for folder in folders:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                # not empty
+                pass
+
+
+    def get_index(self, queue):
+        """
+        Get the index object for a specified queue, creating it the first time it is requested
+        
+        Args:
+            queue:  name of the queue to get the index for
+
+        Returns:
+            a queue_index object
+        """
+
+        try:
+            return self.indexes[queue]
+        except KeyError:
+            # zero-padded file names are already in the right order as strings
+            if self.get_settings(queue)['padded_filenames']:
+                self.indexes[queue] = queue_index(os.path.join(self.root, queue), lister=lambda: self.list_messages(queue))
+            else:
+                self.indexes[queue] = queue_index(os.path.join(self.root, queue), key=self.sort_key, lister=lambda: self.list_messages(queue))
+            return self.indexes[queue]
+
+
+    def write_message_file(self, queue, filename, data):
+        """
+        Write a message file atomically, by first writing it to a hidden temporary file in the queue folder and then renaming it into place. Consumers will never see a half-written message. If the queue's durability setting is 'file' or 'dir' the data is synced to disk before the rename, syncing the queue folder itself is left to the caller.
+        
+        Args:
+            queue:      name of the queue the message belongs to
+            filename:   the path to the message file, relative to the queue folder
+            data:       the contents of the message file, as bytes
+
+        Returns:
+            None
+        """
+
+        msg_dir, msg_filename = os.path.split(os.path.join(self.root, queue, filename))
+        tmp_path = os.path.join(msg_dir, '{}{}'.format(tmp_prefix, msg_filename.split('.ddmq')[-1]))
+
+        # the queue folder itself is never created here, only missing shard folders
+        folder = None if msg_dir == os.path.join(self.root, queue) else msg_dir
+        self.write_atomic(os.path.join(msg_dir, msg_filename), tmp_path, data, self.queue_settings[queue]['durability'] != 'none', folder)
+
+
+    def write_atomic(self, path, tmp_path, data, sync=False, folder=None):
+        """
+        Write a file atomically, through a temporary file that is renamed into place. Used by write_message_file, and directly by publish_many which works out the paths for a whole batch at once
+        
+        Args:
+            path:       the path to write the file to
+            tmp_path:   the path to the temporary file, in the same folder
+            data:       the contents of the file, as bytes
+            sync:       if True, the data is synced to disk before the rename
+            folder:     the folder to create if it is missing, or None if it must already exist
+
+        Returns:
+            None
+        """
+
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        except OSError as e:
+            # the shard folder is missing, create it and try again
+            if e.errno != errno.ENOENT or folder is None:
+                raise
+            self.create_folder(folder)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+        try:
+            os.write(fd, data)
+            if sync:
+                fdatasync(fd)
+        except:
+            os.close(fd)
+            os.remove(tmp_path)
+            raise
+        os.close(fd)
+
+        os.rename(tmp_path, path)
+
+
+    def sync_folder(self, path):
+        """
+        Flush a folder's entries to disk, so renames into it survive a crash. Does nothing on systems where folders can't be opened.
+        
+        Args:
+            path:   path to the folder to sync
+
+        Returns:
+            None
+        """
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+    def take_clean_lease(self, queue, since=None):
+        """
+        Try to become the process that cleans a specified queue in the current clean interval. The lease is the modification time of the lease file in the queue's work folder, and taking it is guarded by a lock file created with O_EXCL so only one process can succeed
+        
+        Args:
+            queue:  name of the queue
+            since:  an epoch time. If given, the lease can be taken if the queue has not been cleaned since then, even if the clean interval has not passed
+
+        Returns:
+            True if the lease was taken and the queue should be cleaned, False if it was cleaned recently or another process is taking the lease
+        """
+
+        lease_path = os.path.join(self.root, queue, 'work', clean_lease)
+        interval = self.get_settings(queue)['clean_interval']
+
+        # the lease has to be older than this to be taken
+        now = time.time()
+        threshold = now - interval
+        if since is not None:
+            threshold = max(threshold, since)
+
+        # the common case, someone has cleaned the queue recently
+        try:
+            if os.stat(lease_path).st_mtime > threshold:
+                return False
+        except (FileNotFoundError, OSError):
+            pass
+
+        lock_path = lease_path+'.lock'
+        try:
+            os.close(os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+            # remove the lock if it was left by a process that crashed while holding it
+            try:
+                if os.stat(lock_path).st_mtime < now - interval:
+                    os.remove(lock_path)
+            except (FileNotFoundError, OSError):
+                pass
+            return False
+
+        try:
+            # check again, another process could have renewed the lease before we got the lock
+            try:
+                if os.stat(lease_path).st_mtime > threshold:
+                    return False
+            except (FileNotFoundError, OSError):
+                open(lease_path, 'a').close()
+
+            os.utime(lease_path, None)
+            return True
+        finally:
+            os.remove(lock_path)
+
+
+    def last_cleaned(self, queue):
+        """
+        Get the time a specified queue was last cleaned, by any process. Older versions kept this as the 'cleaned' setting in the queue's ddmq.yaml
+        
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            the epoch time of the last cleaning, or 0 if the queue has never been cleaned
+        """
+
+        try:
+            return int(os.stat(os.path.join(self.root, queue, 'work', clean_lease)).st_mtime)
+        except (FileNotFoundError, OSError):
+            return 0
+
+
+    def next_expiry(self, queue):
+        """
+        Get the earliest expiry time of the messages consumed from a specified queue and not yet acked. With expiry buckets, only the buckets up to the first one that is not empty are listed
+        
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            an epoch time, which can be in the past if the message has not been cleaned yet, or None if there are no consumed messages
+        """
+
+        # let the queue's backend find it, if it is not stored as files
+        backend = self.get_backend(queue)
+        if backend:
+            return backend.next_expiry(queue)
+
+        folder = os.path.join(self.root, queue, 'work')
+        try:
+            entries = os.listdir(folder)
+        except (FileNotFoundError, OSError):
+            return None
+
+        # messages consumed before the queue used buckets, then the buckets in order
+        expiries = [int(msg.split('.')[0]) for msg in fnmatch.filter(entries, '*.ddmq*')]
+        for shard in sorted(name for name in entries if work_shard_pattern.match(name)):
+
+            # the buckets that follow start later than the messages already found
+            if expiries and int(shard[1:]) > min(expiries):
+                break
+
+            try:
+                shard_expiries = [int(msg.split('.')[0]) for msg in fnmatch.filter(os.listdir(os.path.join(folder, shard)), '*.ddmq*')]
+            except (FileNotFoundError, OSError):
+                # the shard could have been removed since the listdir was run
+                continue
+            if shard_expiries:
+                expiries += shard_expiries
+                break
+
+        if not expiries:
+            return None
+        return min(expiries)
+
+
+    def clean_expired(self, queue):
+        """
+        Clean a specified queue if a consumed message has expired since it was last cleaned, and get the time until it should be cleaned next. Used by consumers waiting for messages, since nobody else might be cleaning the queue while they wait
+        
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            a tuple of True if the queue was cleaned, and the number of seconds until the clean interval has passed or the next consumed message expires (at least a second, in case the queue could not be cleaned, e.g. since another process is cleaning it)
+        """
+
+        # clean compares whole seconds, so a message can be cleaned the second after it expires
+        expiry = self.next_expiry(queue)
+        if expiry is not None and expiry + 1 <= time.time() and self.clean(queue, since=expiry + 1):
+            return True, 0
+
+        wake = self.last_cleaned(queue) + self.get_settings(queue)['clean_interval']
+        if expiry is not None and expiry + 1 > time.time():
+            wake = min(wake, expiry + 1)
+
+        return False, max(wake - time.time(), 1)
+
+
+    def get_backend(self, queue):
+        """
+        Get the backend object that stores a specified queue's messages, creating it the first time it is requested
+        
+        Args:
+            queue:  name of the queue to get the backend for
+
+        Returns:
+            the backend object, or None if the queue stores one file per message (handled by the broker itself)
+        """
+
+        name = self.get_settings(queue)['backend']
+        if name == 'files':
+            return None
+
+        try:
+            return self.backends[name]
+        except KeyError:
+            self.backends[name] = load_backend(name)(self)
+            return self.backends[name]
+
+
+    def get_codec(self, queue):
+        """
+        Get the name of the codec messages written to a specified queue are encoded with
+        
+        Args:
+            queue:  name of the queue to get the codec for
+
+        Returns:
+            the name of the codec (see codec.py)
+        """
+        return self.codec or self.get_settings(queue)['codec']
+
+
+    def get_blob_path(self, queue, msg_id):
+        """
+        Get the path to the blob file holding a message's text, if it is too large to be stored in the message itself
+        
+        Args:
+            queue:  name of the queue
+            msg_id: id of the message
+
+        Returns:
+            the path to the blob file
+        """
+        return os.path.join(self.root, queue, 'blobs', '{}.blob'.format(msg_id))
+
+
+    def spill_package(self, queue, package):
+        """
+        Store the text of a message to be published in a separate blob file, if it is larger than the queue's max_inline_bytes setting. Only bytes and str messages are stored as blobs
+        
+        Args:
+            queue:      name of the queue, whose settings must be loaded
+            package:    a dict with the fields of the message
+
+        Returns:
+            the package, or a copy of it refering to the blob file instead of containing the message text
+        """
+
+        max_inline_bytes = self.queue_settings[queue]['max_inline_bytes']
+        payload = package['message']
+        if not max_inline_bytes or not payload:
+            return package
+
+        if isinstance(payload, type(u'')):
+            payload_type = 'str'
+            payload = payload.encode('utf-8')
+        elif isinstance(payload, (bytes, bytearray, memoryview)):
+            payload_type = 'bytes'
+        else:
+            return package
+
+        if len(payload) <= max_inline_bytes:
+            return package
+
+        # write the blob before the message, so it is there as soon as the message can be consumed
+        blob_path = self.get_blob_path(queue, package['id'])
+        self.write_message_file(queue, os.path.relpath(blob_path, os.path.join(self.root, queue)), payload)
+        if self.queue_settings[queue]['durability'] == 'dir':
+            self.sync_folder(os.path.dirname(blob_path))
+
+        package = dict(package)
+        package['message'] = None
+        package['blob'] = {'size':len(payload), 'type':payload_type}
+        return package
+
+
+    def remove_blobs(self, queue, msg_files):
+        """
+        Remove the blob files of messages that have been acked or removed, if they have any
+        
+        Args:
+            queue:      name of the queue
+            msg_files:  a list of file names (or paths) of the messages
+
+        Returns:
+            None
+        """
+
+        # most queues never store any blobs
+        if not os.path.isdir(os.path.join(self.root, queue, 'blobs')):
+            return
+
+        for msg_file in msg_files:
+            try:
+                os.remove(self.get_blob_path(queue, msg_file.split('.ddmq')[-1]))
+            except (FileNotFoundError, OSError):
+                pass
+
+
+    def clear_blobs(self, queue, delete=False):
+        """
+        Remove all blob files of a queue
+        
+        Args:
+            queue:  name of the queue
+            delete: if True, remove the blobs folder as well
+
+        Returns:
+            None
+        """
+
+        blob_dir = os.path.join(self.root, queue, 'blobs')
+        try:
+            blob_files = os.listdir(blob_dir)
+        except (FileNotFoundError, OSError):
+            return
+
+        for blob_file in blob_files:
+            try:
+                os.remove(os.path.join(blob_dir, blob_file))
+            except (FileNotFoundError, OSError):
+                pass
+
+        if delete:
+            os.rmdir(blob_dir)
+
+
+    def compress(self, queue, data):
+        """
+        Compress an encoded message according to the queue's compression settings, counting the bytes saved and the CPU time spent in the queue's statistics. Messages below the threshold, or that don't get smaller, are left uncompressed
+        
+        Args:
+            queue:  name of the queue, whose settings must be loaded
+            data:   the encoded message, as bytes
+
+        Returns:
+            the message to write, compressed or not
+        """
+
+        settings = self.queue_settings[queue]
+        if settings['compression'] == 'none' or len(data) < settings['compression_threshold']:
+            return data
+
+        started = process_time()
+        compressed = compress(data, settings['compression'])
+        self.count(queue, 'compress_time', process_time() - started)
+
+        if len(compressed) >= len(data):
+            self.count(queue, 'incompressible')
+            return data
+
+        self.count(queue, 'compressed')
+        self.count(queue, 'compressed_bytes_in', len(data))
+        self.count(queue, 'compressed_bytes_out', len(compressed))
+        return compressed
+
+
+    def decompress(self, queue, data):
+        """
+        Decompress a compressed message, counting the CPU time spent in the queue's statistics
+        
+        Args:
+            queue:  name of the queue, or None if it is not known (nothing is counted then)
+            data:   the compressed message, as bytes
+
+        Returns:
+            the encoded message
+        """
+
+        started = process_time()
+        data = decompress(data)
+        if queue is not None:
+            self.count(queue, 'decompress_time', process_time() - started)
+            self.count(queue, 'decompressed')
+        return data
+
+
+    def get_watcher(self, queue):
+        """
+        Get the watcher object for a specified queue's folder, creating it the first time it is requested
+        
+        Args:
+            queue:  name of the queue to get the watcher for
+
+        Returns:
+            a folder_watcher object
+        """
+
+        try:
+            return self.watchers[queue]
+        except KeyError:
+            backend = self.get_backend(queue)
+            self.watchers[queue] = folder_watcher(os.path.join(self.root, queue), subfolders=self.is_sharded(queue), modify=backend is not None and backend.watch_modify)
+            return self.watchers[queue]
+
+
+    def count(self, queue, key, n=1):
+        """
+        Increase a counter in the statistics kept for a specified queue by this broker object
+        
+        Args:
+            queue:  name of the queue
+            key:    name of the counter
+            n:      the number to increase the counter by
+
+        Returns:
+            None
+        """
+
+        queue_stats = self.stats.setdefault(queue, {})
+        queue_stats[key] = queue_stats.get(key, 0) + n
+
+
+    def get_stats(self, queue):
+        """
+        Get the statistics kept for a specified queue by this broker object. The counters are:
+
+            contention:             the number of times a consume lost the race for a message to another process (useful when sizing consumer pools)
+            stale_index:            the number of messages in the queue's index that had already been consumed by another process, when the index setting is used
+            compressed:             the number of messages compressed when written
+            compressed_bytes_in:    the size of those messages before compression
+            compressed_bytes_out:   the size of those messages after compression
+            compression_ratio:      compressed_bytes_in / compressed_bytes_out, if any messages have been compressed
+            compress_time:          the CPU time spent compressing messages, in seconds
+            incompressible:         the number of messages that were not written compressed because they didn't get any smaller
+            decompressed:           the number of messages decompressed when consumed
+            decompress_time:        the CPU time spent decompressing messages, in seconds
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            a dict with the counters, missing counters are 0
+        """
+
+        queue_stats = dict(self.stats.get(queue, {}))
+        if queue_stats.get('compressed_bytes_out'):
+            queue_stats['compression_ratio'] = queue_stats['compressed_bytes_in'] / queue_stats['compressed_bytes_out']
+        return queue_stats
+
+
+    def get_queue_number(self, padded=False):
+        """
+        Generate the next incremental queue number for a specified queue (epoch time of creation without the decimal punctuation)
+        
+        Args:
+            padded: if True, the queue number will be the current time in microseconds, zero-padded to a fixed width
+
+        Returns:
+            a string that is the current timestamp, with the decimal punctuation removed
+        """
+        
+        log.debug('Generating next queue number')
+
+        if padded:
+            return '{:0{}d}'.format(int(time.time() * 1000000), queue_number_width)
+
+        return str(time.time()).replace('.', '')
+
+
+    def get_filename(self, queue, priority, queue_number, id):
+        """
+        Construct the file name of a message waiting in a queue, using the naming scheme of the queue
+        
+        Args:
+            queue:          name of the queue the message belongs to
+            priority:       the priority of the message
+            queue_number:   the queue number of the message
+            id:             the id of the message
+
+        Returns:
+            the file name of the message
+        """
+
+        if self.get_settings(queue)['padded_filenames']:
+
+            # make sure the priority fits in the padding
+            if priority >= 10**priority_width:
+                raise ValueError('Priority too large for zero-padded file names (priority={}, max {} digits)'.format(priority, priority_width))
+
+            return '{:0{}d}.{:0>{}}.ddmq{}'.format(priority, priority_width, queue_number, queue_number_width, id)
+
+        return '{}.{}.ddmq{}'.format(priority, queue_number, id)
+
+
+    def parse_filename(self, filename):
+        """
+        Split a message file name into its parts. Works for both waiting and consumed messages, in both naming schemes
+        
+        Args:
+            filename:   the file name of the message
+
+        Returns:
+            a tuple with the priority (int), queue number (int, in microseconds) and id of the message
+        """
+
+        parts = os.path.basename(filename).split('.')
+
+        # consumed messages have the expiry time prepended
+        if len(parts) == 4:
+            parts = parts[1:]
+
+        priority, queue_number, id = parts
+        queue_number = queue_number.lstrip('0') or '0'
+
+        # queue numbers are epoch time with a varying number of decimals, the first 10 digits being whole seconds
+        if len(queue_number) > 10:
+            queue_number = int(queue_number[:10]) * 1000000 + int(queue_number[10:16].ljust(6, '0'))
+        else:
+            queue_number = int(queue_number)
+
+        return int(priority), queue_number, id[4:]
+
+
+    def sort_key(self, filename):
+        """
+        Key function that sorts message file names numerically by priority and queue number, used for queues that do not have zero-padded file names
+        
+        Args:
+            filename:   the file name of the message
+
+        Returns:
+            a tuple to sort by
+        """
+
+        return self.parse_filename(filename)
+
+
+    def requeue_package(self, queue, package):
+        """
+        Create the requeued version of a consumed message, with the requeue priority, a new queue number and an increased requeue counter
+        
+        Args:
+            queue:      name of the queue the message belongs to
+            package:    a dict with the fields of the consumed message
+
+        Returns:
+            a dict with the fields of the message to put back in the queue
+        """
+
+        package = dict(package)
+
+        # change priority to default value, unless a custom requeue prio is set
+        package['priority'] = self.get_settings(queue)['requeue_prio']
+        if type(package['requeue']) == int:
+            package['priority'] = package['requeue']
+
+        package['requeue_counter'] += 1
+        package['queue_number'] = self.get_queue_number(padded=self.queue_settings[queue]['padded_filenames'])
+        package['filename'] = self.get_filename(queue, package['priority'], package['queue_number'], package['id'])
+        return package
+
+
+    def create_folder(self, path):
+        """
+        Create a folder at a specified path
+        
+        Args:
+            path:   path to the directory to be created
+
+        Returns:
+            None
+        """
+        
+        log.info('Creating folder: {}'.format(path))
+
+        # it's ok if the folder already exists
+        try:
+            os.mkdir(path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            pass
+
+
+
+
+
+### #     # ####### ####### ######     #     #####  ####### 
+ #  ##    #    #    #       #     #   # #   #     #    #    
+ #  # #   #    #    #       #     #  #   #  #          #    
+ #  #  #  #    #    #####   ######  #     # #          #    
+ #  #   # #    #    #       #   #   ####### #          #    
+ #  #    ##    #    #       #    #  #     # #     #    #    
+### #     #    #    ####### #     # #     #  #####     #    
+
+    def publish(self, queue, msg_text=None, priority=None, skip_cleaning=True, requeue=True, requeue_prio=None, timeout=None, requeue_counter=0, requeue_limit=None):
+        """
+        Publish a message to a queue
+        
+        Args:
+            queue:          name of the queue to publish to
+            msg_text:       the actual message. Can be bytes if the queue's codec is msgpack or raw
+            priority:       the priority of the message (default 999). Lower number means higher priority when processing
+            skip_cleaning:  if False, the client will first clean out any expired messages from the queue's work directory. If True, the client will just publish the message right away and not bother doing any cleaning first (faster).
+            requeue:        if True, the message will be requeud after it expires. If False it will just be deleted.
+            requeue_prio:   if set (int), the message will get this priority when requeued. Default is 0, meaning requeued messages will be put first in the queue.
+            timeout:        if set (int), will override the global and queue specific default setting for how many seconds a message expires after.
+
+        Returns:
+            a copy of the message published
+        """
+
+        log.info('Publishing message to {}'.format(queue))
+
+        # load the queue's settings
+        try:
+            self.get_settings(queue)
+        except (FileNotFoundError, IOError):
+            # create the queue if asked to
+            if self.create:
+                self.create_queue(queue)
+            self.get_settings(queue)
+
+        # clean the queue unless asked not to
+        if not skip_cleaning:
+            self.clean(queue)
+
+        # if no message is given, set it to an empty string
+        if not msg_text:
+            msg_text = ''
 
         # check if priority is not set
-        if not priority:
+        if priority is None:
             priority = self.queue_settings[queue]['priority']
         # if it is set, make sure it't not negative
         else:
@@ -808,23 +2155,192 @@ class broker:
         msg = message(message=msg_text, queue=queue, priority=priority, requeue=requeue, timeout=timeout, requeue_counter=requeue_counter, requeue_limit=requeue_limit)
 
         # get the next queue number
-        msg.queue_number = self.get_queue_number()
+        msg.queue_number = self.get_queue_number(padded=self.queue_settings[queue]['padded_filenames'])
 
         # generate message id
-        msg.id = uuid.uuid4().hex
-        msg.filename = os.path.join('{}.{}.ddmq{}'.format(msg.priority, msg.queue_number, msg.id))
+        msg.id = new_id()
+        msg.filename = self.get_filename(queue, msg.priority, msg.queue_number, msg.id)
+
+        # store large message texts separately, if the queue is set to
+        package = self.spill_package(queue, msg.to_dict())
+        msg.blob = package['blob']
+
+        # let the queue's backend store it, if it is not stored as files
+        backend = self.get_backend(queue)
+        if backend:
+            backend.publish(queue, [package])
+            return msg
 
         # write the message to file
-        msg_filepath = os.path.join(self.root, queue, msg.filename)
-        with open(msg_filepath, 'w') as message_file:
-            message_file.write(msg.msg2json())
+        msg_path = os.path.join(self.get_shard(queue, msg.filename), msg.filename)
+        self.write_message_file(queue, msg_path, self.compress(queue, encode(package, self.get_codec(queue))))
+        if self.queue_settings[queue]['durability'] == 'dir':
+            self.sync_folder(os.path.dirname(os.path.join(self.root, queue, msg_path)))
+
+        # add the message to the queue's index if it is used
+        if self.queue_settings[queue]['index']:
+            self.get_index(queue).add([msg_path])
 
         return msg
 
 
 
 
-    def consume(self, queue, n=1, skip_cleaning=False, path=None):
+    def publish_many(self, queue, messages, skip_cleaning=True, **defaults):
+        """
+        Publish many messages to a queue. The queue's settings are only looked up once, and the ids and queue numbers for the messages are generated in bulk, which makes it much faster than calling publish for each message
+        
+        Args:
+            queue:          name of the queue to publish to
+            messages:       an iterable (e.g. a generator) of messages. Each message is either the message text itself, or a dict with the same arguments as publish takes (msg_text, priority, requeue, requeue_prio, timeout, requeue_counter, requeue_limit) to override the defaults for that message
+            skip_cleaning:  if False, the client will first clean out any expired messages from the queue's work directory
+            defaults:       default values for the arguments publish takes, used for all messages that don't override them
+
+        Returns:
+            a list of receipts (queue, id, filename) for the published messages
+        """
+
+        log.info('Publishing messages to {}'.format(queue))
+
+        # load the queue's settings
+        try:
+            self.get_settings(queue)
+        except (FileNotFoundError, IOError):
+            # create the queue if asked to
+            if self.create:
+                self.create_queue(queue)
+            self.get_settings(queue)
+        settings = self.queue_settings[queue]
+
+        # clean the queue unless asked not to
+        if not skip_cleaning:
+            self.clean(queue)
+
+        # resolve the default values once
+        base = {'msg_text':None, 'priority':None, 'requeue':True, 'requeue_prio':None, 'timeout':None, 'requeue_counter':0, 'requeue_limit':None}
+        unknown = set(defaults) - set(base)
+        if unknown:
+            raise TypeError('Unknown publish argument(s): {}'.format(', '.join(sorted(unknown))))
+        base.update(defaults)
+
+        # the ids share a random prefix and get a running number as suffix, and the queue numbers count up from the current time
+        id_prefix = new_id()[:24]
+        queue_number = int(time.time() * 1000000)
+        padded = settings['padded_filenames']
+        queue_dir = os.path.join(self.root, queue)
+        backend = self.get_backend(queue)
+        codec = self.get_codec(queue)
+        sync = settings['durability'] != 'none'
+        sharded = settings['shard_priority'] or settings['shard_time']
+
+        # the file names are formatted here instead of by get_filename, to not look up the settings for each message
+        if padded:
+            filename_format = '{:0%dd}.{}.ddmq{}' % priority_width
+        else:
+            filename_format = '{}.{}.ddmq{}'
+
+        # the folder, temporary path prefix and relative path prefix of each shard, worked out the first time it is used
+        folders = {}
+
+        receipts = []
+        pending_index = []
+        pending_packages = []
+        for i, msg in enumerate(messages):
+
+            # apply the per-message options over the defaults
+            if type(msg) is dict:
+                unknown = set(msg) - set(base)
+                if unknown:
+                    raise TypeError('Unknown publish argument(s) in message {}: {}'.format(i, ', '.join(sorted(unknown))))
+                options = dict(base, **msg)
+            else:
+                options = dict(base, msg_text=msg)
+
+            priority = options['priority']
+            if priority is None:
+                priority = settings['priority']
+            elif priority < 0:
+                raise ValueError('Warning, priority set to less than 0 (priority={}). Negative numbers will be sorted in the wrong order when working with messages.'.format(priority))
+
+            requeue = options['requeue']
+            if options['requeue_prio']:
+                requeue = options['requeue_prio']
+
+            # start over with a new prefix if the running number would overflow
+            if i and i % 0xffffffff == 0:
+                id_prefix = new_id()[:24]
+            msg_id = '{}{:08x}'.format(id_prefix, i % 0xffffffff)
+
+            if padded:
+                if priority >= 10**priority_width:
+                    raise ValueError('Priority too large for zero-padded file names (priority={}, max {} digits)'.format(priority, priority_width))
+                msg_queue_number = '{:0{}d}'.format(queue_number + i, queue_number_width)
+            else:
+                msg_queue_number = str(queue_number + i)
+            filename = filename_format.format(priority, msg_queue_number, msg_id)
+
+            # same fields as a message object
+            package = { 'timeout':options['timeout'],
+                        'blob':None,
+                        'message':options['msg_text'] or '',
+                        'queue':queue,
+                        'id':msg_id,
+                        'priority':priority,
+                        'queue_number':msg_queue_number,
+                        'filename':filename,
+                        'requeue':requeue,
+                        'requeue_counter':options['requeue_counter'],
+                        'requeue_limit':options['requeue_limit'],
+                        }
+
+            receipts.append(receipt(queue, msg_id, filename))
+            package = self.spill_package(queue, package)
+
+            # let the queue's backend store them in chunks, if it is not stored as files
+            if backend:
+                pending_packages.append(package)
+                if len(pending_packages) >= 1000:
+                    backend.publish(queue, pending_packages)
+                    pending_packages = []
+                continue
+
+            shard = self.format_shard(settings, priority, queue_number + i) if sharded else ''
+            try:
+                folder, tmp_path_prefix, rel_prefix = folders[shard]
+            except KeyError:
+                folder = os.path.join(queue_dir, shard, '')
+                tmp_path_prefix = folder + tmp_prefix
+                rel_prefix = os.path.join(shard, '') if shard else ''
+                folders[shard] = (folder, tmp_path_prefix, rel_prefix)
+
+            # write the message to file
+            msg_path = rel_prefix + filename
+            self.write_atomic(folder + filename, tmp_path_prefix + msg_id, self.compress(queue, encode(package, codec)), sync, folder if shard else None)
+
+            # add the messages to the queue's index in chunks
+            if settings['index']:
+                pending_index.append(msg_path)
+                if len(pending_index) >= 1000:
+                    self.get_index(queue).add(pending_index)
+                    pending_index = []
+
+        # the folders only need to be synced once for the whole batch
+        if settings['durability'] == 'dir':
+            for folder, tmp_path_prefix, rel_prefix in folders.values():
+                self.sync_folder(folder)
+
+        if pending_index:
+            self.get_index(queue).add(pending_index)
+
+        if pending_packages:
+            backend.publish(queue, pending_packages)
+
+        return receipts
+
+
+
+
+    def consume(self, queue, n=1, skip_cleaning=False, path=None, block=False, timeout=None):
         """
         Consume 1 (or more) messages from a specified queue. The consumed messages will be moved to the queues work folder and have the expiry epoch time prepended to the file name.
         
@@ -833,11 +2349,17 @@ class broker:
             n:              the number (int) of messages to consume
             skip_cleaning:  if False, the client will first clean out any expired messages from the queue's work directory. If True, the client will just consume the message(s) right away and not bother doing any cleaning first (faster)
             path:           specified path to message file to consume, instead of fetching the next message in line
+            block:          if True, wait for messages to arrive if the queue is empty. Uses inotify on Linux, and polling with an increasing delay elsewhere
+            timeout:        the maximum number of seconds to wait when blocking, None to wait forever
 
         Returns:
             a single message object if n=1 (default), or a list of the messages that were fetched if n > 1
         """
 
+        # wait for messages if asked to
+        if block:
+            return self.consume_blocking(queue, n=n, skip_cleaning=skip_cleaning, path=path, timeout=timeout)
+
         log.info('Consuming {} message(s) from {}'.format(n, queue))
 
         # load the queue's settings
@@ -859,48 +2381,59 @@ class broker:
 
         # init
         restored_messages = []
+        backend = self.get_backend(queue)
+        from_index = False
+
+        # let the queue's backend fetch the messages, if it is not stored as files
+        if backend:
+            if path:
+                raise ValueError('Consuming a specified message file is only supported by the files backend')
+            restored_messages = backend.consume(queue, n)
+            msg_files = []
         
         # fetch a specified message if asked to
-        if path:
+        elif path:
             msg_files = [path]
         
+        # pop messages from the head of the queue's index if it is used
+        elif self.queue_settings[queue]['index']:
+            msg_files = self.get_index(queue).iter_head()
+            from_index = True
+
         else:
-            # list all ddmq files in queue folder
-            try:
-                msg_files = sorted(fnmatch.filter(os.listdir(os.path.join(self.root, queue)), '*.ddmq*'))[:n]
-            except (FileNotFoundError, OSError) as e:
+            # list all ddmq files in queue folder in the order they should be consumed.
+            # the whole list is kept, so messages lost to other consumers can be replaced by the next ones in line
+            if not os.path.isdir(os.path.join(self.root, queue)):
                 raise FileNotFoundError("Unable to read from the queue folder: {}".format(os.path.join(self.root, queue)))
+            msg_files = self.iter_messages(queue)
         
         
-        for msg_filename in msg_files:
-
-            # construct the path to the file
-            msg_filepath = os.path.join(self.root, queue, msg_filename)
-
-            try:
-                # Tracer()()
-                # load the message from the file
-                with open(msg_filepath, 'r') as msg_handle:
-                    msg = message.json2msg(json.load(msg_handle))
-            except (FileNotFoundError, IOError) as e:
-                # race conditions could cause files being removed since the listdir was run
-                print("Warning: while consuming, the message file {} was missing. This could be due to another process operating on the queue at the same time. It should be pretty rare, so if it happens often it could be some other problem causing it.".format(msg_filepath))
+        for msg_relpath in msg_files:
+
+            # construct the path to the file, messages in sharded queues are in subfolders
+            msg_filepath = os.path.join(self.root, queue, msg_relpath)
+            msg_filename = os.path.basename(msg_relpath)
+
+            # claim the message, only one consumer can succeed, the others will move on to the next message in line
+            msg = self.claim_message(queue, msg_filepath, msg_filename)
+            if msg is None:
+                # another process got there first. The index of this broker object only learns about that when the file is gone,
+                # which is usually long after the race was lost, so those are counted separately
+                self.count(queue, 'stale_index' if from_index else 'contention')
                 continue
-            
-            # create the new path to the file in the work folder
-            if msg.timeout:
-                message_timeout = int(time.time()) + msg.timeout
-            else:    
-                message_timeout = int(time.time()) + self.queue_settings[queue]['message_timeout']
-
-            # move to the work folder, adding the message expiry time to the file name
-            msg_work_path = os.path.join(self.root, queue, 'work', '{}.{}'.format(message_timeout, msg_filename))
-            os.rename(msg_filepath, msg_work_path)
-            msg.filename = os.path.split(msg_work_path)[1]
 
             # save msg
             restored_messages.append(msg)
 
+            # the index will keep yielding file names until told to stop
+            if len(restored_messages) >= n:
+                break
+
+
+        # give messages stored as blobs a handle to read them with
+        for msg in restored_messages:
+            if msg.blob:
+                msg.message = blob(self.get_blob_path(queue, msg.id), msg.blob)
 
         # return depending on how many messages are collected
         if len(restored_messages) == 0:
@@ -915,6 +2448,156 @@ class broker:
             return restored_messages
 
 
+    def claim_message(self, queue, msg_filepath, msg_filename):
+        """
+        Claim a waiting message, by moving it to the work folder with its expiry time prepended to the file name. The message is read before it is moved, so its timeout is known and it is moved straight to the expiry bucket it belongs in. The file can still be read through the open handle after it has been moved
+        
+        Args:
+            queue:          name of the queue the message is in
+            msg_filepath:   path to the message file
+            msg_filename:   the file name of the message
+
+        Returns:
+            the message object, or None if another process claimed it first
+        """
+
+        try:
+            msg_handle = open(msg_filepath, 'rb')
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        # only the timeout and blob fields are decoded here, the rest is decoded when it is used
+        with msg_handle:
+            msg = self.read_message(msg_handle, queue)
+        msg.decode_header()
+
+        expiry = int(time.time()) + (msg.timeout or self.queue_settings[queue]['message_timeout'])
+        msg_work_path = self.get_work_path(queue, '{}.{}'.format(expiry, msg_filename))
+        try:
+            self.move_message(msg_filepath, msg_work_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        msg.filename = os.path.basename(msg_work_path)
+        return msg
+
+
+    def move_message(self, path, new_path):
+        """
+        Move a message file, creating the shard subfolder it is moved to if needed
+        
+        Args:
+            path:       current path to the message file
+            new_path:   path to move it to
+
+        Returns:
+            None
+        """
+
+        try:
+            os.rename(path, new_path)
+        except OSError as e:
+            # the source is missing, or the shard subfolder is
+            if e.errno != errno.ENOENT or not os.path.exists(path):
+                raise
+            self.create_folder(os.path.dirname(new_path))
+            os.rename(path, new_path)
+
+
+    def consume_blocking(self, queue, n=1, skip_cleaning=False, path=None, timeout=None):
+        """
+        Consume 1 (or more) messages from a specified queue, waiting for them to arrive if the queue is empty. Called by consume when block=True.
+        
+        Args:
+            queue:          name of the queue to consume from
+            n:              the number (int) of messages to consume
+            skip_cleaning:  if False, the client will first clean out any expired messages from the queue's work directory
+            path:           specified path to message file to consume, instead of fetching the next message in line
+            timeout:        the maximum number of seconds to wait, None to wait forever
+
+        Returns:
+            same as consume, None if the timeout was reached without any messages arriving
+        """
+
+        # the watcher has to exist before the first check, so no messages arriving in between are missed
+        try:
+            self.get_settings(queue)
+        except (FileNotFoundError, IOError):
+            # create the queue if asked to
+            if self.create:
+                self.create_queue(queue)
+            self.get_settings(queue)
+        watcher = self.get_watcher(queue)
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+
+            messages = self.consume(queue, n=n, skip_cleaning=skip_cleaning, path=path)
+            if messages:
+                watcher.reset()
+                return messages
+
+            # messages in sharded queues are written to subfolders, watch any new ones and check again before waiting
+            if self.is_sharded(queue):
+                new_shards = [watcher.add(os.path.join(self.root, queue, shard)) for shard in self.list_shards(queue)]
+                if any(new_shards):
+                    continue
+
+            # calculate the time left to wait
+            remaining = None
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+
+            # if all consumers are waiting nobody else cleans the queue, so wake up in time to clean it
+            if not skip_cleaning:
+                cleaned, clean_wait = self.clean_expired(queue)
+                if cleaned:
+                    continue
+                if remaining is None or clean_wait < remaining:
+                    remaining = clean_wait
+
+            log.debug('Waiting for messages in {}'.format(queue))
+            watcher.wait(remaining)
+
+
+    def listen(self, queue, n=1, skip_cleaning=False, timeout=None):
+        """
+        Generator that yields messages from a specified queue as they arrive, blocking while the queue is empty
+        
+        Args:
+            queue:          name of the queue to consume from
+            n:              the number (int) of messages to consume at a time. They will still be yielded one by one
+            skip_cleaning:  if False, the client will first clean out any expired messages from the queue's work directory
+            timeout:        stop if no messages have arrived for this many seconds, None to wait forever
+
+        Returns:
+            a generator of message objects
+        """
+
+        log.info('Listening to {}'.format(queue))
+
+        while True:
+
+            messages = self.consume(queue, n=n, skip_cleaning=skip_cleaning, block=True, timeout=timeout)
+            if not messages:
+                return
+
+            # consume returns a single message when n=1
+            if type(messages) != list:
+                messages = [messages]
+
+            for msg in messages:
+                yield msg
+
+
     def nack(self, queue, msg_files=None, requeue=False, skip_cleaning=False):
         """
         Negative acknowledgement of message(s)
@@ -947,15 +2630,23 @@ class broker:
         if type(msg_files) != list:
             msg_files = [msg_files]
 
+        # let the queue's backend handle it, if it is not stored as files
+        backend = self.get_backend(queue)
+        if backend:
+            nacked = backend.requeue(queue, msg_files, requeue)
+            if requeue is False:
+                self.remove_blobs(queue, nacked)
+            return nacked
+
         # for each message to process
         nacked = []
+        removed = []
         for msg_file in msg_files:
 
-            msg_path = os.path.join(self.root, queue, 'work', msg_file)
-
             # check if the file exists
-            if not os.path.isfile(msg_path):
-                print("Warning: message file missing, {}".format(msg_path))
+            msg_path = self.locate_work_message(queue, msg_file)
+            if not msg_path:
+                print("Warning: message file missing, {}".format(os.path.join(self.root, queue, 'work', msg_file)))
                 continue
                 
             # let the options in this function call override the ones in the message
@@ -981,13 +2672,17 @@ class broker:
             else:
                 # assumes the message is consumed and located in the work dir
                 try:
-                    os.remove(os.path.join(self.root, queue, 'work', msg_file))
+                    os.remove(msg_path)
                 except (FileNotFoundError, OSError) as e:
                     # race conditions could cause files being removed since the listdir was run
                     print("Warning: while nacking, message file {} was missing. This could be due to another process operating on the queue at the same time. It should be pretty rare, so if it happens often it could be some other problem causing it.".format(msg_path))
                     continue
+                removed.append(msg_file)
             
             nacked.append(msg_file)
+
+        # remove the blob files of the removed messages, if they have any
+        self.remove_blobs(queue, removed)
         
         return nacked
 
@@ -1026,16 +2721,24 @@ class broker:
         if type(msg_files) != list:
             msg_files = [msg_files]
 
+        # let the queue's backend handle it, if it is not stored as files
+        backend = self.get_backend(queue)
+        if backend:
+            if requeue:
+                return backend.requeue(queue, msg_files)
+            acked = backend.ack(queue, msg_files)
+            self.remove_blobs(queue, acked)
+            return acked
+
         # for each message to process
         acked = []
+        removed = []
         for msg_file in msg_files:
 
-            # construct the path to the message file
-            msg_path = os.path.join(self.root, queue, 'work', msg_file)
-
-            # check if the file exists
-            if not os.path.isfile(msg_path):
-                print("Warning: message file missing, {}".format(msg_path))
+            # find the message file, and check if it exists
+            msg_path = self.locate_work_message(queue, msg_file)
+            if not msg_path:
+                print("Warning: message file missing, {}".format(os.path.join(self.root, queue, 'work', msg_file)))
                 continue
 
             # if it should be requeued
@@ -1046,13 +2749,17 @@ class broker:
             else:
                 # assumes the message is consumed and located in the work dir
                 try:
-                    os.remove(os.path.join(self.root, queue, 'work', msg_file))
+                    os.remove(msg_path)
                 except (FileNotFoundError, OSError) as e:
                     # race conditions could cause files being removed since the listdir was run
                     print("Warning: while acking, message file {} was missing. This could be due to another process operating on the queue at the same time. It should be pretty rare, so if it happens often it could be some other problem causing it.".format(msg_path))
                     continue
+                removed.append(msg_file)
             
             acked.append(msg_file)
+
+        # remove the blob files of the removed messages, if they have any
+        self.remove_blobs(queue, removed)
         
         return acked
 
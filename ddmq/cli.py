@@ -17,6 +17,10 @@ try:
     FileNotFoundError
 except NameError:
     FileNotFoundError = IOError
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 
 # import standard modules
@@ -27,44 +31,41 @@ import argparse
 import logging as log
 import re
 import errno
+import traceback
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
-# import extra modules
-import yaml
-# from ddmq import broker
-# from ddmq import message
-
-from broker import broker
-from broker import message
+# import the broker, which imports yaml only if a config file needs it (see broker.get_yaml)
+try:
+    from .broker import broker, message, DdmqError, get_yaml
+    from .blob import blob
+    from .client import run_forwarded
+except (ValueError, ImportError):
+    from broker import broker, message, DdmqError, get_yaml
+    from blob import blob
+    from client import run_forwarded
 
 version = "0.9.14"
 
+# the maximum number of lines read from stdin before they are published or acked together
+stdin_batch_size = 1000
 
+# set when running as a helper process (ddmq serve), so commands are not forwarded to another helper
+serving = False
 
+# broker objects are kept for the rest of the process, so the commands run by a helper process or in a JSON batch share them and their caches
+brokers = {}
 
-class DdmqError(Exception):
-    """
-    Helper class to raise custom errors
-    """
-    def __init__(self, message, error):
-        """
-        Initialize a DdmqError object
-
-        Args:
-            message:    error message
-            error:      error code
-
-        Returns:
-            None
-        """
-        self.message = message
-        self.error = error
-
-
-
-
-
+# the sub-commands, by name, see register
+commands = {}
 
+# options that JSON packaged commands can give as a list instead of a comma-separated str, see split_list
+json_list_options = ['msg_files']
 
+# shown when ddmq json can't parse its input
+json_example = {'command':'publish', 'root':'/tmp/ddmq', 'queue':'queue_name', 'message':'Hello World!', 'priority':1, 'f':True}
 
 
 
@@ -81,7 +82,7 @@ class DdmqError(Exception):
 
 
 
-def create_broker(root, create=False, verbose=False, debug=False):
+def create_broker(root, create=False, verbose=False, debug=False, backend=None):
     """
     Helper function to create broker objects, printing correct error messages if failed
     
@@ -90,14 +91,22 @@ def create_broker(root, create=False, verbose=False, debug=False):
         create:     True if missing folders should be created
         verbose:    verbose progress reporting
         debug:      even more verbose progress reporting
+        backend:    the storage backend for queues created by the broker, None for the root's default
 
     Returns:
         a broker object
     """
 
+    # reuse the broker object from an earlier command in this process, unless its root has been deleted since
+    key = (os.path.abspath(root), create, verbose, debug, backend)
+    if key in brokers:
+        if os.path.isfile(os.path.join(brokers[key].root, 'ddmq.yaml')):
+            return brokers[key]
+        del brokers[key]
+
     # create a broker object
     try:
-        brokerObj = broker(root=root, create=create, verbose=verbose, debug=debug)
+        brokerObj = broker(root=root, create=create, verbose=verbose, debug=debug, backend=backend)
     except OSError as e:
         
         # if the ddmq.yaml file is missing
@@ -114,12 +123,254 @@ def create_broker(root, create=False, verbose=False, debug=False):
         elif e.error == 'missing':
             sys.exit("The specified root directory ({}) does not exist. Please run the same command with the (-f) force flag to try to create and initiate directories as needed.".format(root))
 
+    brokers[key] = brokerObj
     return brokerObj
 
 
 
 
+def register(name):
+    """
+    Decorator that adds a function to the sub-commands, under the given name
+
+    Args:
+        name:   the name of the sub-command on the command-line
+
+    Returns:
+        the decorator
+    """
+
+    def decorator(function):
+        commands[name] = function
+        return function
+    return decorator
+
+
+
+
+
+def parse_args(parser, args=None):
+    """
+    Parse the arguments of a sub-command, either from the command-line or from the options of a command packaged as a JSON object. Options not given in the JSON object get the same default values as on the command-line
+    
+    Args:
+        parser: the sub-command's argument parser
+        args:   a dict with the options of a JSON packaged command, named as the parser's destinations (e.g. root, queue, skip_cleaning). None to parse the command-line
+
+    Returns:
+        an args object
+    """
+
+    if args is None:
+        # now that we're inside a subcommand, ignore the first two arguments
+        return parser.parse_args(sys.argv[2:])
+
+    options = dict(args)
+    parsed = argparse.Namespace()
+    for action in parser._actions:
+        if action.dest == 'help':
+            continue
+
+        # null is the same as leaving the option out
+        value = options.pop(action.dest, None)
+        if value is not None:
+            setattr(parsed, action.dest, convert_option(parser, action, value))
+        elif action.required or (not action.option_strings and action.nargs is None):
+            parser.error("the option {} is required".format(action.dest))
+        else:
+            setattr(parsed, action.dest, action.default)
+
+    if options:
+        parser.error("unknown option(s): {}".format(', '.join(sorted(options))))
+
+    return parsed
+
+
+
+def convert_option(parser, action, value):
+    """
+    Check and convert the value of an option given in a JSON packaged command the way argparse does on the command-line, applying the option's type and checking its choices. Exits with a usage error if the value is not valid
+
+    Args:
+        parser: the sub-command's argument parser
+        action: the argparse action of the option
+        value:  the value from the JSON object, not None
+
+    Returns:
+        the converted value
+    """
+
+    # flags, e.g. -f
+    if action.nargs == 0:
+        if type(value) != bool:
+            parser.error("argument {}: expected true or false, got {}".format(action.dest, json.dumps(value)))
+        return value
+
+    if type(value) == list and action.dest not in json_list_options:
+        parser.error("argument {}: expected a single value, got a list".format(action.dest))
+
+    converted = []
+    for item in (value if type(value) == list else [value]):
+
+        # the command-line only gives strs, so numbers are converted from their string form
+        if isinstance(item, (bool, dict, list)) or item is None:
+            parser.error("argument {}: invalid value: {}".format(action.dest, json.dumps(item)))
+        if not isinstance(item, string_types):
+            item = str(item)
+
+        if action.type is not None:
+            try:
+                item = action.type(item)
+            except (ValueError, TypeError, argparse.ArgumentTypeError):
+                parser.error("argument {}: invalid {} value: {}".format(action.dest, getattr(action.type, '__name__', 'type'), json.dumps(item)))
+
+        if action.choices is not None and item not in action.choices:
+            parser.error("argument {}: invalid choice: {} (choose from {})".format(action.dest, json.dumps(item), ', '.join(str(choice) for choice in action.choices)))
+
+        converted.append(item)
+
+    if type(value) == list:
+        return converted
+    return converted[0]
+
+
+
+
+def json_default(obj):
+    """
+    Convert the message texts the json module can't serialize when printing messages as JSON. Bytes messages are base64 encoded, and messages stored as blobs are given as the path to their blob file
+
+    Args:
+        obj:    the object the json module couldn't serialize
+
+    Returns:
+        a str to serialize instead
+    """
+
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        # only needed for bytes messages, so it isn't imported just to start the command-line interface
+        import base64
+        return base64.b64encode(bytes(obj)).decode('ascii')
+    if isinstance(obj, blob):
+        return obj.path
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+
+
+def split_list(value):
+    """
+    Split a comma-separated command-line argument into a list. JSON packaged commands can give a list directly
+
+    Args:
+        value:  the comma-separated str, or a list
+
+    Returns:
+        a list
+    """
+
+    if type(value) == list:
+        return value
+    return value.split(',')
+
+
+
+
+
+def read_batches(stream, size=stdin_batch_size):
+    """
+    Generator that reads lines from a stream (e.g. stdin) and yields them in batches, so they can be published or acked together. A batch is yielded when it is full, or when no more input is ready, so lines coming slowly through a pipe are not held back waiting for the batch to fill up. Empty lines are skipped
+
+    Args:
+        stream: the file object to read from
+        size:   the maximum number of lines in a batch
+
+    Returns:
+        a generator of lists of lines, without the line breaks
+    """
+
+    # only needed when reading from stdin, so it isn't imported just to start the command-line interface
+    import select
+
+    batch = []
+    for line in iter(stream.readline, ''):
+        line = line.rstrip('\r\n')
+        if line:
+            batch.append(line)
+
+        if len(batch) >= size:
+            yield batch
+            batch = []
+            continue
+
+        # send off what has been read so far if the next line would have to be waited for
+        if batch:
+            try:
+                ready = select.select([stream], [], [], 0)[0]
+            except (OSError, ValueError, select.error):
+                # e.g. pipes on Windows
+                ready = False
+            if not ready:
+                yield batch
+                batch = []
+
+    if batch:
+        yield batch
+
+
+
+
+
+def read_receipts(stream):
+    """
+    Generator that reads the file names of consumed messages from a stream, in batches. Each line is either a file name, or a message printed as JSON by ddmq consume (--format json or ndjson), in which case its filename field is used
+
+    Args:
+        stream: the file object to read from
+
+    Returns:
+        a generator of lists of file names
+    """
+
+    for lines in read_batches(stream):
+        msg_files = []
+        for line in lines:
+            if line.lstrip().startswith('{'):
+                try:
+                    line = json.loads(line)['filename']
+                except (ValueError, KeyError, TypeError):
+                    sys.exit("Error: unable to read the file name from the line {}".format(line))
+            msg_files.append(line.strip())
+        yield msg_files
+
+
+
+
+
+def print_message(msg, format):
+    """
+    Print a message in the requested format
+
+    Args:
+        msg:    the message object
+        format: the output format (plain, json, ndjson, yaml)
+
+    Returns:
+        None
+    """
+
+    if format in ['json', 'ndjson']:
+        print(json.dumps(msg.to_dict(), separators=(',', ':') if format == 'ndjson' else None, default=json_default))
+    elif format == 'plain':
+        print(str(msg))
+    elif format == 'yaml':
+        print(get_yaml().dump(msg.to_dict()).rstrip())
+
+
 
+
+
+@register('view')
 def view(args=None):
     """
     Handle the command-line sub-command view
@@ -127,29 +378,27 @@ def view(args=None):
     ddmq view [-hfnvd] [--format <plain|json|yaml>] <root> [queue1,queue2,...,queueN]
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
     """
 
-    if not args:
-        parser = argparse.ArgumentParser(
-            description='View available queues and number of messages.',
-            usage='''ddmq view [-hfnvd] [--format <plain|json|yaml>] <root> [queue1,queue2,...,queueN]'''
-    )
-        # add available options for this sub-command
-        parser.add_argument('root', help="the message queue's root folder", type=str)
-        parser.add_argument('queue', nargs='?', help="name of specific queue(s) to view", type=str)
-        parser.add_argument('-f', action='store_true', help="create the root folder if needed")
-        parser.add_argument('-n', action='store_true', help="only print the name of queues (faster)")
-        parser.add_argument('--format', nargs='?', help="specify output format (plain, json, yaml)", default='default', type=str)
-        parser.add_argument('-v', action='store_true', help="verbose mode")
-        parser.add_argument('-d', action='store_true', help="debug mode")
+    parser = argparse.ArgumentParser(
+        description='View available queues and number of messages.',
+        usage='''ddmq view [-hfnvd] [--format <plain|json|yaml>] <root> [queue1,queue2,...,queueN]'''
+)
+    # add available options for this sub-command
+    parser.add_argument('root', help="the message queue's root folder", type=str)
+    parser.add_argument('queue', nargs='?', help="name of specific queue(s) to view", type=str)
+    parser.add_argument('-f', action='store_true', help="create the root folder if needed")
+    parser.add_argument('-n', action='store_true', help="only print the name of queues (faster)")
+    parser.add_argument('--format', nargs='?', help="specify output format (plain, json, yaml)", default='default', type=str)
+    parser.add_argument('-v', action='store_true', help="verbose mode")
+    parser.add_argument('-d', action='store_true', help="debug mode")
 
 
-        # now that we're inside a subcommand, ignore the first two arguments
-        args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
     
     # create a broker object
     brokerObj = create_broker(root=args.root, create=args.f, verbose=args.v, debug=args.d)
@@ -197,7 +446,7 @@ def view(args=None):
         return
 
     elif print_format == 'yaml':
-        print(yaml.dump(queues).rstrip()) # remove the newline, hopefully not important
+        print(get_yaml().dump(queues).rstrip()) # remove the newline, hopefully not important
         return
 
     else:
@@ -256,36 +505,37 @@ def view(args=None):
 
 
 
+@register('create')
 def create(args=None):
     """
     Handle the command-line sub-command create
     Usage:
-    ddmq create [-hfvds] <root> <queue1>[,<queue2>,...,<queueN>]
+    ddmq create [-hfvds] [-b <backend>] <root> <queue1>[,<queue2>,...,<queueN>]
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
     """
     parser = argparse.ArgumentParser(
         description='Create queue(s).',
-        usage='''ddmq create [-hfvds] <root> <queue1>[,<queue2>,...,<queueN>]'''
+        usage='''ddmq create [-hfvds] [-b <backend>] <root> <queue1>[,<queue2>,...,<queueN>]'''
 )
     # add available options for this sub-command
     parser.add_argument('root', help="the message queue's root folder", type=str)
     parser.add_argument('queue', help="comma-separated names of specific queue(s) to create", type=str)
+    parser.add_argument('-b', '--backend', help="how the messages are stored, files (one file per message), segment (append-only logs) or sqlite (a SQLite database). Defaults to the backend setting in the root's ddmq.yaml", type=str, choices=['files', 'segment', 'sqlite'])
     parser.add_argument('-f', action='store_true', help="create the root folder if needed")
     parser.add_argument('-v', action='store_true', help="verbose mode")
     parser.add_argument('-d', action='store_true', help="debug mode")
     parser.add_argument('-s', action='store_true', help="silent mode")
 
 
-    # now that we're inside a subcommand, ignore the first two arguments
-    args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
     
     # create a broker object
-    brokerObj = create_broker(root=args.root, create=args.f, verbose=args.v, debug=args.d)
+    brokerObj = create_broker(root=args.root, create=args.f, verbose=args.v, debug=args.d, backend=args.backend)
 
     # readability
     queues = args.queue
@@ -328,6 +578,7 @@ def create(args=None):
         print('Created {} new queues'.format(created_queues))
 
 
+@register('delete')
 def delete(args=None):
     """
     Handle the command-line sub-command delete
@@ -335,7 +586,7 @@ def delete(args=None):
     ddmq delete [-hfvds] <root> <queue1>[,<queue2>,...,<queueN>]
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
@@ -353,8 +604,7 @@ def delete(args=None):
     parser.add_argument('-s', action='store_true', help="silent mode")
 
 
-    # now that we're inside a subcommand, ignore the first two arguments
-    args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
 
     # create a broker object
     brokerObj = create_broker(root=args.root, create=args.f, verbose=args.v, debug=args.d)
@@ -395,26 +645,31 @@ def delete(args=None):
 
 
 
+@register('publish')
 def publish(args=None):
     """
     Handle the command-line sub-command publish
     Usage:
     ddmq publish [options] <root> <queue> \"<message>\"
+    ddmq publish [options] --stdin [--format <plain|ndjson>] <root> <queue>
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
     """
     parser = argparse.ArgumentParser(
         description='Publish message to a queue.',
-        usage='''ddmq publish [options] <root> <queue> "<message>"'''
+        usage='''ddmq publish [options] <root> <queue> "<message>"
+       ddmq publish [options] --stdin [--format <plain|ndjson>] <root> <queue>'''
 )
     # add available options for this sub-command
     parser.add_argument('root', help="the message queue's root folder", type=str)
     parser.add_argument('queue', help="name of queue to publish to", type=str)
-    parser.add_argument('message', help="message text within quotes", type=str)
+    parser.add_argument('message', nargs='?', help="message text within quotes", type=str)
+    parser.add_argument('--stdin', action='store_true', help="publish the messages read from stdin, one per line, instead of a single message")
+    parser.add_argument('--format', nargs='?', help="format of the lines read with --stdin. plain (default) = each line is a message text, ndjson = each line is a JSON value, which is the message itself unless it is an object with a message field, in which case the other fields are options for that message (priority, timeout, requeue, requeue_prio, requeue_limit)", default='plain', type=str)
     parser.add_argument('-f', action='store_true', help="create the root folder and queue if needed")
     parser.add_argument('-p', '--priority', nargs='?', help="define priority of the message (lower number = higer priority)", type=int)
     parser.add_argument('-t', '--timeout', nargs='?', help="define timeout of the message in seconds", type=int)
@@ -427,8 +682,14 @@ def publish(args=None):
     parser.add_argument('-s', action='store_true', help="silent mode")
 
 
-    # now that we're inside a subcommand, ignore the first two arguments
-    args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
+
+    if args.stdin == (args.message is not None):
+        parser.error("give either a message or --stdin")
+    if args.stdin:
+        refuse_if_serving('--stdin')
+    if args.format not in ['plain', 'ndjson']:
+        parser.error("unknown format, {}. Valid formats are plain and ndjson.".format(args.format))
 
     # create a broker object
     brokerObj = create_broker(root=args.root, create=args.f, verbose=args.v, debug=args.d)
@@ -460,6 +721,13 @@ def publish(args=None):
     if args.requeue_prio:
         requeue = True
 
+    # publish all messages from stdin in batches
+    if args.stdin:
+        published = publish_stdin(brokerObj, args, requeue)
+        if not args.s:
+            print("Published {} message(s) to {}".format(published, args.queue))
+        return
+
     # call the publish function with the given arguments
     try:
         msg = brokerObj.publish(queue=args.queue, msg_text=args.message, priority=args.priority, skip_cleaning=args.skip_cleaning, requeue=requeue, requeue_prio=args.requeue_prio, timeout=args.timeout, requeue_limit=args.requeue_limit)
@@ -474,43 +742,116 @@ def publish(args=None):
 
 
 
+def publish_stdin(brokerObj, args, requeue):
+    """
+    Publish the messages read from stdin by ddmq publish --stdin, in batches, using the broker's publish_many
+
+    Args:
+        brokerObj:  the broker object to publish with
+        args:       the parsed command-line arguments of ddmq publish
+        requeue:    the requeue option given on the command-line
+
+    Returns:
+        the number of messages published
+    """
+
+    # the options given on the command-line are the defaults for all messages
+    defaults = {'priority':args.priority, 'timeout':args.timeout, 'requeue':requeue, 'requeue_prio':args.requeue_prio, 'requeue_limit':args.requeue_limit}
+
+    published = 0
+    skip_cleaning = args.skip_cleaning
+    for lines in read_batches(sys.stdin):
+
+        messages = lines
+        if args.format == 'ndjson':
+            messages = []
+            for line in lines:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    sys.exit("Error: unable to load the JSON object ({})".format(line))
+
+                # objects with a message field carry the message and its options, anything else is the message itself
+                if type(msg) is dict and 'message' in msg:
+                    msg['msg_text'] = msg.pop('message')
+                    unknown = set(msg) - set(defaults) - set(['msg_text'])
+                    if unknown:
+                        sys.exit("Error: unknown message option(s) {} ({})".format(', '.join(sorted(unknown)), line))
+                else:
+                    msg = {'msg_text':msg}
+                messages.append(msg)
+
+        try:
+            published += len(brokerObj.publish_many(args.queue, messages, skip_cleaning=skip_cleaning, **defaults))
+        except IOError:
+            sys.exit("Unable to write to the specified queue directory ({}).".format(os.path.join(args.root, args.queue)))
+        except (TypeError, ValueError) as e:
+            sys.exit("Error: {}".format(e))
+
+        # the queue only has to be cleaned once
+        skip_cleaning = True
+
+    return published
+
+
+
+
+
+@register('consume')
 def consume(args=None):
     """
     Handle the command-line sub-command consume
     Usage:
-    ddmq consume [-hfnCvd] [--format <plain|json|yaml>] <root> <queue>
+    ddmq consume [-hfnCvd] [--follow [-t <seconds>]] [--format <plain|json|ndjson|yaml>] <root> <queue>
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
     """
     parser = argparse.ArgumentParser(
         description='Consume message(s) from a queue.',
-        usage='''ddmq consume [-hfnCvd] [--format <plain|json|yaml>] <root> <queue>'''
+        usage='''ddmq consume [-hfnCvd] [--follow [-t <seconds>]] [--format <plain|json|ndjson|yaml>] <root> <queue>'''
 )
     # add available options for this sub-command
     parser.add_argument('root', help="the message queue's root folder")
     parser.add_argument('queue', help="name of queue to consume from")
     parser.add_argument('-f', action='store_true', help="create the root folder and queue if needed")
-    parser.add_argument('-n', nargs='?', help="the number of messages that will be consumed", type=int)
-    parser.add_argument('--format', nargs='?', help="specify output format (plain, json, yaml)", default='json', type=str)
+    parser.add_argument('-n', nargs='?', help="the number of messages that will be consumed (at a time, with --follow)", type=int)
+    parser.add_argument('--format', nargs='?', help="specify output format (plain, json, ndjson, yaml). Bytes messages are printed base64 encoded in the JSON formats", default='json', type=str)
+    parser.add_argument('--follow', action='store_true', help="keep consuming and printing messages as they arrive, until interrupted")
+    parser.add_argument('-t', '--timeout', nargs='?', help="with --follow, stop if no messages have arrived for this many seconds", type=float)
     parser.add_argument('-C', '--skip-cleaning', action='store_true', help="set to consume the message from the queue without doing cleaning of the queue first")
     parser.add_argument('-v', action='store_true', help="verbose mode")
     parser.add_argument('-d', action='store_true', help="debug mode")
 
 
-    # now that we're inside a subcommand, ignore the first two arguments
-    args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
 
     if args.format:
-        if args.format not in ['plain', 'json', 'yaml']:
-            raise ValueError("Unknown format, {}. Valid formats are plain, json and yaml.")
+        if args.format not in ['plain', 'json', 'ndjson', 'yaml']:
+            raise ValueError("Unknown format, {}. Valid formats are plain, json, ndjson and yaml.".format(args.format))
 
     # create a broker object
     brokerObj = create_broker(root=args.root, create=args.f, verbose=args.v, debug=args.d)
 
+    # print the messages as they arrive, flushing each one so the next process in a pipe gets it right away
+    if args.follow:
+        refuse_if_serving('--follow')
+        try:
+            for msg in brokerObj.listen(args.queue, n=args.n or 1, skip_cleaning=args.skip_cleaning, timeout=args.timeout):
+                print_message(msg, args.format)
+                sys.stdout.flush()
+        except IOError as e:
+            # the process reading the output has exited
+            if e.errno == errno.EPIPE:
+                return
+            sys.exit("Unable to read/write to the specified queue directory ({}).".format(os.path.join(args.root, args.queue)))
+        except KeyboardInterrupt:
+            pass
+        return
+
     # consume the messages
     try:
         messages = brokerObj.consume(queue=args.queue, n=args.n, skip_cleaning=args.skip_cleaning)
@@ -522,121 +863,153 @@ def consume(args=None):
         print("No more messages in {}".format(args.queue))
         return
 
+    # consume returns a single message when n=1
+    if type(messages) != list:
+        messages = [messages]
+
     # print the messages in requested format
     for msg in messages:
-
-        if args.format == 'json':
-            print(json.dumps(msg.__dict__))
-        elif args.format == 'plain':
-            print(str(msg))
-        elif args.format == 'yaml':
-            print(yaml.dump(msg.__dict__).rstrip())
-        else:
-            # should not happen
-            print(json.dumps(msg))
+        print_message(msg, args.format)
 
 
 
 
 
+@register('ack')
 def ack(args=None):
     """
     Handle the command-line sub-command ack
     Usage:
     ddmq ack [-hCrvd] <root> <queue> <message file1>[,<message file2>,..,<message fileN>]
+    ddmq ack [-hCrvd] --stdin <root> <queue>
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
     """
     parser = argparse.ArgumentParser(
         description='Positively acknowledge message(s) from a queue.',
-        usage='''ddmq ack [-hCrvd] <root> <queue> <message file1>[,<message file2>,..,<message fileN>]'''
+        usage='''ddmq ack [-hCrvd] <root> <queue> <message file1>[,<message file2>,..,<message fileN>]
+       ddmq ack [-hCrvd] --stdin <root> <queue>'''
 )
     # add available options for this sub-command
     parser.add_argument('root', help="the message queue's root folder")
     parser.add_argument('queue', help="name of the queue the messages are in")
-    parser.add_argument('msg_files', help="comma-separated names of file names of the messages to acknowledge")
-    parser.add_argument('-C', '--skip-cleaning', action='store_false', help="set to ack the message without doing cleaning of the queue first")
+    parser.add_argument('msg_files', nargs='?', help="comma-separated names of file names of the messages to acknowledge")
+    parser.add_argument('--stdin', action='store_true', help="ack the messages named on stdin as they are read, one per line. Each line is a file name, or a message printed as JSON by ddmq consume")
+    parser.add_argument('-C', '--skip-cleaning', action='store_true', help="set to ack the message without doing cleaning of the queue first")
     parser.add_argument('-r', '--requeue',action='store_true', help="force requeue of the messages")
     parser.add_argument('-v', action='store_true', help="verbose mode")
     parser.add_argument('-d', action='store_true', help="debug mode")
 
 
-    # now that we're inside a subcommand, ignore the first two arguments
-    args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
+
+    if args.stdin == (args.msg_files is not None):
+        parser.error("give either the message file names or --stdin")
+    if args.stdin:
+        refuse_if_serving('--stdin')
 
     # create a broker object
     brokerObj = create_broker(root=args.root, verbose=args.v, debug=args.d)
 
     # make the files to a list
-    msg_files = args.msg_files.split(',')
+    if args.stdin:
+        batches = read_receipts(sys.stdin)
+    else:
+        batches = [split_list(args.msg_files)]
 
-    # send the messages to acknowledgement
-    acked = brokerObj.ack(args.queue, msg_files, requeue=args.requeue, clean=args.skip_cleaning)
-    for msg_file in acked:
-        print('acked {}'.format(os.path.join(brokerObj.root, args.queue, 'work', msg_file)))
-    
-    # print failed acked
-    for msg_file in msg_files:
-        if msg_file not in acked:
-            print('failed ack {}'.format(os.path.join(brokerObj.root, args.queue, 'work', msg_file)))
+    skip_cleaning = args.skip_cleaning
+    for msg_files in batches:
+
+        # send the messages to acknowledgement
+        acked = brokerObj.ack(args.queue, msg_files, requeue=args.requeue, skip_cleaning=skip_cleaning)
+        for msg_file in acked:
+            print('acked {}'.format(os.path.join(brokerObj.root, args.queue, 'work', msg_file)))
+
+        # print failed acked
+        for msg_file in msg_files:
+            if msg_file not in acked:
+                print('failed ack {}'.format(os.path.join(brokerObj.root, args.queue, 'work', msg_file)))
+        sys.stdout.flush()
+
+        # the queue only has to be cleaned once
+        skip_cleaning = True
 
 
 
 
+
+@register('nack')
 def nack(args=None):
     """
     Handle the command-line sub-command nack
     Usage:
     ddmq nack [-hCrvd] <root> <queue> <message file1>[,<message file2>,..,<message fileN>]
+    ddmq nack [-hCrvd] --stdin <root> <queue>
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
     """
     parser = argparse.ArgumentParser(
         description='Negatively acknowledge message(s) from a queue.',
-        usage='''ddmq nack [-hCrvd] <root> <queue> <message file1>[,<message file2>,..,<message fileN>]'''
+        usage='''ddmq nack [-hCrvd] <root> <queue> <message file1>[,<message file2>,..,<message fileN>]
+       ddmq nack [-hCrvd] --stdin <root> <queue>'''
 )
     # add available options for this sub-command
     parser.add_argument('root', help="the message queue's root folder")
     parser.add_argument('queue', help="name of the queue the messages are in")
-    parser.add_argument('msg_files', help="comma-separated names of file names of the messages to acknowledge")
-    parser.add_argument('-C', '--skip-cleaning', action='store_false', help="set to nack the message without doing cleaning of the queue first")
+    parser.add_argument('msg_files', nargs='?', help="comma-separated names of file names of the messages to acknowledge")
+    parser.add_argument('--stdin', action='store_true', help="nack the messages named on stdin as they are read, one per line. Each line is a file name, or a message printed as JSON by ddmq consume")
+    parser.add_argument('-C', '--skip-cleaning', action='store_true', help="set to nack the message without doing cleaning of the queue first")
     parser.add_argument('-r', '--requeue',action='store_true', help="force requeue of the messages")
     parser.add_argument('-v', action='store_true', help="verbose mode")
     parser.add_argument('-d', action='store_true', help="debug mode")
 
 
-    # now that we're inside a subcommand, ignore the first two arguments
-    args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
+
+    if args.stdin == (args.msg_files is not None):
+        parser.error("give either the message file names or --stdin")
+    if args.stdin:
+        refuse_if_serving('--stdin')
 
     # create a broker object
     brokerObj = create_broker(root=args.root, verbose=args.v, debug=args.d)
 
     # make the files to a list
-    msg_files = args.msg_files.split(',')
+    if args.stdin:
+        batches = read_receipts(sys.stdin)
+    else:
+        batches = [split_list(args.msg_files)]
 
-    # send the messages to acknowledgement
-    nacked = brokerObj.nack(args.queue, msg_files, requeue=args.requeue, clean=args.skip_cleaning)
-    for msg_file in nacked:
-        print('nacked {}'.format(os.path.join(brokerObj.root, args.queue, 'work', msg_file)))
-    
-    # print failed acked
-    for msg_file in msg_files:
-        if msg_file not in nacked:
-            print('failed nack {}'.format(os.path.join(brokerObj.root, args.queue, 'work', msg_file)))
+    skip_cleaning = args.skip_cleaning
+    for msg_files in batches:
 
+        # send the messages to acknowledgement
+        nacked = brokerObj.nack(args.queue, msg_files, requeue=args.requeue, skip_cleaning=skip_cleaning)
+        for msg_file in nacked:
+            print('nacked {}'.format(os.path.join(brokerObj.root, args.queue, 'work', msg_file)))
 
+        # print failed nacked
+        for msg_file in msg_files:
+            if msg_file not in nacked:
+                print('failed nack {}'.format(os.path.join(brokerObj.root, args.queue, 'work', msg_file)))
+        sys.stdout.flush()
 
+        # the queue only has to be cleaned once
+        skip_cleaning = True
 
 
 
+
+
+@register('del_msg')
 def del_msg(args=None):
     """
     Handle the command-line sub-command del_msg
@@ -644,7 +1017,7 @@ def del_msg(args=None):
     ddmq del_msg [-hCvds] <root> <queue> <message file1>[,<message file2>,..,<message fileN>]
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
@@ -657,14 +1030,13 @@ def del_msg(args=None):
     parser.add_argument('root', help="the message queue's root folder")
     parser.add_argument('queue', help="name of the queue the messages are in")
     parser.add_argument('msg_files', help="comma-separated names of file names of the messages to acknowledge")
-    parser.add_argument('-C', '--skip-cleaning', action='store_false', help="set to nack the message without doing cleaning of the queue first")
+    parser.add_argument('-C', '--skip-cleaning', action='store_true', help="set to nack the message without doing cleaning of the queue first")
     parser.add_argument('-v', action='store_true', help="verbose mode")
     parser.add_argument('-d', action='store_true', help="debug mode")
     parser.add_argument('-s', action='store_true', help="silent mode")
 
 
-    # now that we're inside a subcommand, ignore the first two arguments
-    args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
 
     # create a broker object
     brokerObj = create_broker(root=args.root, verbose=args.v, debug=args.d)
@@ -675,7 +1047,7 @@ def del_msg(args=None):
 
     # send the messages to deletion
     deleted_msgs = 0
-    for msg_file in args.msg_files.split(','):
+    for msg_file in split_list(args.msg_files):
 
         # from IPython.core.debugger import Tracer
         # Tracer()()
@@ -686,12 +1058,12 @@ def del_msg(args=None):
         # is the filename of a consumed message?
         match = re.search('^\d+\.\d+\.\d+\.ddmq[a-zA-Z0-9]+$', msg_filename)
         if match:
-            msg_filename = os.path.join(args.root, queue, 'work', msg_filename)
+            msg_filename = brokerObj.locate_work_message(queue, msg_filename) or os.path.join(args.root, queue, 'work', msg_filename)
         
         # is the filename of a not yet consumed message?
         match = re.search('^\d+\.\d+\.ddmq[a-zA-Z0-9]+$', msg_filename)
         if match:
-            msg_filename = os.path.join(args.root, queue, msg_filename)
+            msg_filename = os.path.join(args.root, queue, brokerObj.get_shard(queue, msg_filename), msg_filename)
 
         # make sure the file exists
         if not os.path.isfile(msg_filename):
@@ -712,6 +1084,7 @@ def del_msg(args=None):
 
 
 
+@register('purge')
 def purge(args=None):
     """
     Handle the command-line sub-command purge
@@ -719,7 +1092,7 @@ def purge(args=None):
     ddmq purge [-hfvds] <root> <queue1>[,<queue2>,...,<queueN>]
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
@@ -737,8 +1110,7 @@ def purge(args=None):
     parser.add_argument('-s', action='store_true', help="silent mode")
 
 
-    # now that we're inside a subcommand, ignore the first two arguments
-    args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
 
     # create a broker object
     brokerObj = create_broker(root=args.root, create=args.f, verbose=args.v, debug=args.d)
@@ -785,6 +1157,7 @@ def purge(args=None):
 
 
 
+@register('clean')
 def clean(args=None):
     """
     Handle the command-line sub-command clean
@@ -792,7 +1165,7 @@ def clean(args=None):
     ddmq clean [-hfvds] <root> <queue1>[,<queue2>,...,<queueN>]
     
     Args:
-        args:   a pre-made args object, in the case of json being parsed from the command-line
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
@@ -810,8 +1183,7 @@ def clean(args=None):
     parser.add_argument('-s', action='store_true', help="silent mode")
 
 
-    # now that we're inside a subcommand, ignore the first two arguments
-    args = parser.parse_args(sys.argv[2:])
+    args = parse_args(parser, args)
 
     # create a broker object
     brokerObj = create_broker(root=args.root, create=args.f, verbose=args.v, debug=args.d)
@@ -857,64 +1229,362 @@ def clean(args=None):
 
 
 
+@register('migrate')
+def migrate(args=None):
+    """
+    Handle the command-line sub-command migrate
+    Usage:
+    ddmq migrate [-hfvds] [--unpadded] <root> <queue1>[,<queue2>,...,<queueN>]
+    
+    Args:
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(
+        description='Migrate queue(s) to zero-padded message file names, and move messages into the shard subfolders set in the queue settings.',
+        usage='''ddmq migrate [-hfvds] [--unpadded] <root> <queue1>[,<queue2>,...,<queueN>]'''
+)
+    # add available options for this sub-command
+    parser.add_argument('root', help="the message queue's root folder", type=str)
+    parser.add_argument('queue', help="comma-separated names of specific queue(s) to migrate", type=str)
+    parser.add_argument('--unpadded', action='store_true', help="migrate back to unpadded file names")
+    parser.add_argument('-f', action='store_true', help="create the root folder if needed")
+    parser.add_argument('-v', action='store_true', help="verbose mode")
+    parser.add_argument('-d', action='store_true', help="debug mode")
+    parser.add_argument('-s', action='store_true', help="silent mode")
+
+
+    args = parse_args(parser, args)
+
+    # create a broker object
+    brokerObj = create_broker(root=args.root, create=args.f, verbose=args.v, debug=args.d)
+
+    # readability
+    queues = args.queue
+    silent = args.s
+
+    log.info('Migrating queue(s): {}'.format(', '.join(queues.split(','))))
+
+    # get existing queue names
+    existing_queues = brokerObj.list_queues()
+
+    # migrate the queues
+    migrated_queues = 0
+    for queue in queues.split(','):
 
+        # skip names with weird characters in them
+        if not bool(re.match('^[a-zA-Z0-9_-]+$', queue)):
+            if not silent:
+                print("Skipping {}, invalid name".format(queue))
+                continue
 
+        # if it doesn't exists
+        if queue not in existing_queues:
+            if not silent:
+                print("Queue does not exist: {}".format(os.path.join(brokerObj.root, queue)))
 
-def json_payload():
+        else:
+            try:
+                # migrate the queue
+                renamed = brokerObj.migrate_queue(queue, padded=not args.unpadded)
+                if not silent:
+                    print("Migrated queue: {}\t({} messages renamed)".format(queue, renamed))
+                migrated_queues += 1
+            except OSError:
+                print("Error: could not read/write to the queue directory ({})".format(os.path.join(brokerObj.root, queue)))
+    
+    if not silent and migrated_queues>1:
+        print('Migrated {} queues'.format(migrated_queues))
+
+
+
+
+
+
+
+@register('janitor')
+def janitor(args=None):
     """
-    Handle the command-line sub-command json
+    Handle the command-line sub-command janitor
     Usage:
-    ddmq json \'<json object>\'
+    ddmq janitor [-hvds] [-t <threads>] [--stats <path>] [--poll] [--force] <root>
     
     Args:
-        None
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
     Returns:
         None
     """
+    parser = argparse.ArgumentParser(
+        description='Keep all queues in the root folder clean, running until interrupted. With a janitor running, clients can publish and consume with skip_cleaning=True.',
+        usage='''ddmq janitor [-hvds] [-t <threads>] [--stats <path>] [--poll] [--force] <root>'''
+)
+    # add available options for this sub-command
+    parser.add_argument('root', help="the message queue's root folder", type=str)
+    parser.add_argument('-t', '--threads', help="the number of queues that can be cleaned at the same time (default 4)", type=int, default=4)
+    parser.add_argument('--stats', help="write statistics for each queue to this file (JSON) after each cleaning", type=str)
+    parser.add_argument('--poll', action='store_true', help="don't use inotify to watch the work folders")
+    parser.add_argument('--force', action='store_true', help="clean the queues when they are due, even if another process has cleaned them recently or is cleaning them")
+    parser.add_argument('-v', action='store_true', help="verbose mode")
+    parser.add_argument('-d', action='store_true', help="debug mode")
+    parser.add_argument('-s', action='store_true', help="silent mode")
+
+
+    args = parse_args(parser, args)
+    refuse_if_serving('janitor')
+
+    # create a broker object
+    brokerObj = create_broker(root=args.root, verbose=args.v, debug=args.d)
+
+    # only needed by this command
+    try:
+        from .janitor import janitor as janitor_daemon
+    except (ValueError, ImportError):
+        from janitor import janitor as janitor_daemon
+    janitorObj = janitor_daemon(brokerObj, threads=args.threads, stats_path=args.stats, poll=args.poll, force=args.force)
+
+    if not args.s:
+        print("Janitor running in {}, press Ctrl-C to stop".format(brokerObj.root))
+
+    try:
+        janitorObj.run()
+    except KeyboardInterrupt:
+        janitorObj.stop()
+
+    if not args.s:
+        print("Janitor stopped")
+
+
+
+
+
+
+@register('serve')
+def serve(args=None):
+    """
+    Handle the command-line sub-command serve
+    Usage:
+    ddmq serve [-hvds] [--socket <path>]
     
+    Args:
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
+
+    Returns:
+        None
+    """
     parser = argparse.ArgumentParser(
-        description='Purge queue(s).',
-        usage='''ddmq json \'<json object>\''''
-        )
-    parser.add_argument('json_payload', help="the json object, within single quotes", type=str)
-    args = parser.parse_args(sys.argv[2:])
-
-    # initiate the options with default values
-    options = { 'cmd':None,
-                'root':None,
-                'queue':None,
-                'message':None,
-                'f':False,
-                'v':False,
-                'd':False,
-                'n':False,
-                'format':'plain',
-                's':False,
-                'priority':None,
-                'timeout':None,
-                'requeue':False,
-                'requeue_prio':None,
-                'skip_cleaning':False,
-                }
+        description='Run a helper process that runs the commands of other ddmq command-line calls, keeping its broker objects, settings and indexes between them, until interrupted. ddmq sends its commands to the helper when the DDMQ_SOCKET environment variable is set to the socket, and runs them itself if no helper is running.',
+        usage='''ddmq serve [-hvds] [--socket <path>]'''
+)
+    # add available options for this sub-command
+    parser.add_argument('--socket', help="path to the Unix socket to listen on (default $DDMQ_SOCKET)", type=str, default=os.environ.get('DDMQ_SOCKET'))
+    parser.add_argument('-v', action='store_true', help="verbose mode")
+    parser.add_argument('-d', action='store_true', help="debug mode")
+    parser.add_argument('-s', action='store_true', help="silent mode")
+
+
+    args = parse_args(parser, args)
+    refuse_if_serving('serve')
+
+    if not args.socket:
+        parser.error("give the path to the socket with --socket, or set DDMQ_SOCKET")
+
+    # only needed by this command
+    try:
+        from .server import server
+    except (ValueError, ImportError):
+        from server import server
+
+    # the commands are run in this process from now on
+    global serving
+    serving = True
+
+    if args.d:
+        log.basicConfig(format="%(levelname)s:\t%(message)s", level=log.DEBUG)
+    elif args.v:
+        log.basicConfig(format="%(levelname)s:\t%(message)s", level=log.INFO)
 
     try:
-        # read the payload
-        payload = json.loads(args.json_payload)
-    except ValueError:
-        sys.exit("Error: unable to load the JSON object (wrong format or missing single quotes?)\n\nExample of structure and all the options that can be set:\n\n'{}'".format(json.dumps(options)))
+        serverObj = server(args.socket, run_captured)
+    except OSError as e:
+        sys.exit("Error: {}".format(e.strerror))
+
+    if not args.s:
+        print("Helper running on {}, press Ctrl-C to stop".format(serverObj.path))
+        sys.stdout.flush()
+
+    try:
+        serverObj.run()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        sys.exit("Error: {} ({})".format(e.strerror, args.socket))
+
+    if not args.s:
+        print("Helper stopped")
+
+
+
+
+
+def run_captured(argv):
+    """
+    Run a command the way main does, capturing what it prints instead of printing it. Used by the helper process to run the commands sent to it
+
+    Args:
+        argv:   the command-line arguments, without the program name
+
+    Returns:
+        a tuple of the command's exit status and what it printed to stdout and stderr. The status is None if the command has to be run by the client, see refuse_if_serving
+    """
+
+    saved = sys.argv, sys.stdout, sys.stderr
+    sys.argv = ['ddmq'] + list(argv)
+    sys.stdout = StringIO()
+    sys.stderr = StringIO()
+    try:
+        main()
+        status = 0
+    except DdmqError as e:
+        # refused by refuse_if_serving before anything was done, so the client runs the command itself
+        if e.error != 'not_forwarded':
+            traceback.print_exc()
+            status = 1
+        else:
+            status = None
+    except SystemExit as e:
+        # sys.exit with a message prints it and exits with status 1
+        status = e.code
+        if status is None:
+            status = 0
+        elif not isinstance(status, int):
+            print(status, file=sys.stderr)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        stdout, stderr = sys.stdout.getvalue(), sys.stderr.getvalue()
+        sys.argv, sys.stdout, sys.stderr = saved
+
+    return status, stdout, stderr
+
+
+
 
+
+def refuse_if_serving(option):
+    """
+    Stop a command that reads from stdin or runs until interrupted if it is being run by a helper process (ddmq serve), which runs one command at a time with no stdin of its own. Called as soon as the command's arguments have been parsed, before it has done anything, so the client can run the command itself
+
+    Args:
+        option:     the option or command that can't be run by the helper, for the logs
+
+    Returns:
+        None, raises a DdmqError with the error code not_forwarded when serving
+    """
+
+    if serving:
+        log.debug('Not running {} in the helper'.format(option))
+        raise DdmqError("{} can't be run by the ddmq helper".format(option), 'not_forwarded')
+
+
+
+
+
+@register('json')
+def json_payload(args=None):
+    """
+    Handle the command-line sub-command json
+    Usage:
+    ddmq json \'<json object or array>\'
+    ddmq json --stdin
     
+    Args:
+        args:   a dict with the options of a JSON packaged command (see parse_args), None to parse the command-line
 
-    # apply the payload over the defaults
-    options.update(payload)
+    Returns:
+        None
+    """
+    
+    parser = argparse.ArgumentParser(
+        description='Run command(s) packaged as JSON objects. Give a single object, an array of objects, or use --stdin to read one object (or array) per line. All commands are run in this process, sharing broker objects, and the first one that fails stops the rest.',
+        usage='''ddmq json \'<json object or array>\'
+       ddmq json --stdin'''
+        )
+    parser.add_argument('json_payload', nargs='?', help="the json object or array, within single quotes", type=str)
+    parser.add_argument('--stdin', action='store_true', help="read the commands from stdin, one JSON object or array per line")
+    args = parse_args(parser, args)
+
+    if args.stdin == (args.json_payload is not None):
+        parser.error("give either a JSON object or array, or --stdin")
+    if args.stdin:
+        refuse_if_serving('--stdin')
+
+    # read the commands
+    if args.stdin:
+        payloads = (line for lines in read_batches(sys.stdin) for line in lines)
+    else:
+        payloads = [args.json_payload]
+
+    n = 0
+    for payload in payloads:
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            sys.exit("Error: unable to load the JSON object (wrong format or missing single quotes?)\n\nExample of structure, where the options are named as the command's long options:\n\n'{}'".format(json.dumps(json_example)))
+
+        if type(payload) != list:
+            payload = [payload]
+
+        # a helper refuses the whole batch before running any of it, since only one payload is read without --stdin
+        for options in payload:
+            if type(options) == dict and (options.get('command', options.get('cmd')) in ['janitor', 'serve'] or options.get('follow') or options.get('stdin')):
+                refuse_if_serving(options.get('command', options.get('cmd')))
+
+        for options in payload:
+            n += 1
+            run_json_command(options, n)
+            sys.stdout.flush()
 
-    # transfer the options to the args object
-    for key,val in options.items():
-        vars(args)[key] = val
 
-    # use dispatch pattern to invoke method with same name
-    eval(args.command)(args=args)
+
+
+
+def run_json_command(options, n=1):
+    """
+    Run a command packaged as a JSON object
+
+    Args:
+        options:    a dict with the name of the command (command) and its options
+        n:          the number of the command in the batch, used in error messages
+
+    Returns:
+        None
+    """
+
+    if type(options) != dict:
+        sys.exit("Error: command {} is not a JSON object".format(n))
+
+    # cmd is accepted for older payloads
+    options = dict(options)
+    name = options.pop('command', None) or options.pop('cmd', None)
+    if name not in commands or name == 'json':
+        sys.exit("Error: unknown command in command {} ({}). Valid commands are {}.".format(n, name, ', '.join(sorted(set(commands) - set(['json'])))))
+
+    try:
+        commands[name](args=options)
+    except DdmqError as e:
+        # the commands before it in the batch have already been run, so it can't be left to the client
+        if e.error == 'not_forwarded' and n > 1:
+            sys.exit("Error: command {} ({}) can't be run by the ddmq helper".format(n, name))
+        raise
+    except SystemExit as e:
+        if e.code:
+            print("Error: command {} ({}) failed, stopping".format(n, name), file=sys.stderr)
+        raise
 
 
 
@@ -936,8 +1606,8 @@ def json_payload():
 #     # #     #  #  #    ## 
 #     # #     # ### #     # 
 
-def main():
-    """Run the queue in a command-line mode
+def main(forward=True):
+    """Run the queue in a command-line mode. Commands are sent to a running helper process if there is one, unless forward is False (the ddmq command has already tried, see client.main)
 
 Usage:    
 ddmq <command> [<args>]
@@ -953,6 +1623,9 @@ nack      Negativly acknowledge a message (possibly requeue)
 del_msg   Delete the specified message
 purge     Purge all messages from queue
 clean     Clean out expired messages from queue
+migrate   Rename messages to zero-padded file names and current shards
+janitor   Keep all queues clean in the background
+serve     Run a helper process that runs the commands of other ddmq calls
 json      Run a command packaged as a JSON object
 
 For more info about the commands, run
@@ -973,6 +1646,9 @@ nack      Negativly acknowledge a message (possibly requeue)
 del_msg   Delete the specified message
 purge     Purge all messages from queue
 clean     Clean out expired messages from queue
+migrate   Rename messages to zero-padded file names and current shards
+janitor   Keep all queues clean in the background
+serve     Run a helper process that runs the commands of other ddmq calls
 json      Run a command packaged as a JSON object
 
 For more info about the commands, run
@@ -1001,18 +1677,18 @@ https://github.com/ddmq/ddmq
         exit(1)
 
     # check if there is no command given
-    elif args.command not in ['view', 'create', 'delete', 'publish', 'consume', 'ack', 'nack', 'del_msg', 'purge', 'clean', 'json']:
+    elif args.command not in commands:
         print("Unrecognized command: {}".format(args.command))
         parser.print_help()
         exit(1)
 
 
-    # rename the json command to avoid name conflict with the json module
-    if args.command == 'json':
-        args.command = 'json_payload'
+    # let a running helper process run the command, if there is one
+    if forward and not serving:
+        run_forwarded(sys.argv[1:])
 
-    # use dispatch pattern to invoke method with same name
-    eval(args.command)()
+    # run the sub-command
+    commands[args.command]()
 
 # run as command-line tool
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+#! /usr/bin/env python
+"""
+Defines the entry point of the ddmq command, and the functions used to send
+commands to a running helper process (ddmq serve, see server.py).
+
+When the DDMQ_SOCKET environment variable is set, main sends the command to
+the helper before the command-line interface and the broker are imported,
+so a forwarded command only pays for starting Python and importing the few
+standard modules needed here. If no helper is running, or it refuses the
+command, the command-line interface (cli.py) is imported and runs it.
+
+$ export DDMQ_SOCKET=/tmp/ddmq.sock
+$ ddmq publish /tmp/ddmq queue_name "Hello World!"
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+
+# import standard modules, only the ones needed to forward a command.
+# socket is imported when a command is forwarded, since it imports select and the command-line interface imports this module too
+import os
+import sys
+import json
+import errno
+
+# the commands a running helper process (ddmq serve) can run, unless they read from stdin or run until interrupted
+forwarded_commands = ['view', 'create', 'delete', 'publish', 'consume', 'ack', 'nack', 'del_msg', 'purge', 'clean', 'migrate', 'json']
+
+
+
+def forward(path, argv, cwd=None):
+    """
+    Send a command to a running helper process and wait for it to finish
+
+    Args:
+        path:   path to the helper's socket
+        argv:   the command-line arguments of the command, without the program name
+        cwd:    the working directory relative paths in the arguments are relative to, None for the current one
+
+    Returns:
+        a tuple of the command's exit status (None if the helper refused to run it) and what it printed to stdout and stderr, or None if there is no helper running
+    """
+
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    # nothing has been sent if the connection fails, so the caller can safely run the command itself
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        client.close()
+        return None
+
+    # from here on the command may have been run, so errors are raised instead of falling back
+    try:
+        request = {'argv':list(argv), 'cwd':cwd or os.getcwd()}
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        client.shutdown(socket.SHUT_WR)
+
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+
+    try:
+        response = json.loads(b''.join(chunks).decode('utf-8'))
+        return response['status'], response['stdout'], response['stderr']
+    except (ValueError, KeyError, TypeError):
+        raise IOError(errno.EPROTO, "Invalid response from the ddmq helper", path)
+
+
+
+def is_running(path):
+    """
+    Check if a helper is listening on a socket
+
+    Args:
+        path:   path to the socket
+
+    Returns:
+        True if a connection could be made
+    """
+
+    import socket
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        probe.close()
+
+
+
+def run_forwarded(argv):
+    """
+    Send a command to a running helper process to run, if the DDMQ_SOCKET environment variable is set. Commands that read from stdin or run until interrupted are run by this process instead, either since they are spotted here or since the helper refuses them once it has parsed their arguments
+
+    Args:
+        argv:   the command-line arguments, without the program name
+
+    Returns:
+        None if the command should be run by this process, otherwise exits with the helper's exit status once the command has finished
+    """
+
+    socket_path = os.environ.get('DDMQ_SOCKET')
+    if not socket_path or not argv or argv[0] not in forwarded_commands:
+        return None
+    # saves a round trip for the common cases, the helper checks the parsed arguments
+    if '--stdin' in argv or '--follow' in argv:
+        return None
+
+    try:
+        result = forward(socket_path, argv)
+    except (IOError, OSError):
+        sys.exit("Error: lost the connection to the ddmq helper ({}) while it was running the command, so it may or may not have been run.".format(socket_path))
+
+    # no helper running
+    if result is None:
+        return None
+
+    # the helper refused to run the command
+    status, stdout, stderr = result
+    if status is None:
+        return None
+
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(status)
+
+
+
+def main():
+    """
+    Run the ddmq command. The command is sent to a running helper process if there is one, otherwise the command-line interface is imported to run it
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    run_forwarded(sys.argv[1:])
+
+    # not forwarded, so the command-line interface and the broker are needed after all
+    try:
+        from .cli import main as cli_main
+    except (ValueError, ImportError):
+        from cli import main as cli_main
+    cli_main(forward=False)
+
+# run as command-line tool
+if __name__ == "__main__":
+    main()
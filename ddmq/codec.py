@@ -0,0 +1,470 @@
+#! /usr/bin/env python
+"""
+Defines the codecs used to encode messages before they are written to a
+message file (or a queue's SQLite database), and to decode them again.
+
+The codec is chosen with the codec setting in ddmq.yaml, or the codec
+argument of a broker object, and can be one of
+
+    json        the standard library's json module (the default)
+    orjson      the orjson module, if installed. Writes plain JSON, just faster
+    ujson       the ujson module, if installed. Writes plain JSON, just faster
+    msgpack     the msgpack module, if installed. Binary, and can carry bytes messages as they are
+    raw         the message's fields as a JSON header, followed by the message itself as raw bytes
+
+Encoded messages can also be compressed, with the compression setting in
+ddmq.yaml, using zlib, lzma or zstd (if the zstandard module is installed).
+Compressed messages start with a header byte telling which compression was
+used, followed by the compressed message, and are decompressed by decode().
+
+The JSON codecs write plain JSON objects, which always start with '{', just
+like the message files written by earlier versions of ddmq. The other codecs
+start their output with a header byte telling which codec was used, so
+messages written with different codecs can be mixed in the same queue and
+decode() never has to be told which codec to use.
+
+>>> data = encode({'message': b'\\x00\\x01', 'queue': 'queue_name'}, 'raw')
+>>> decode(data)
+{'queue': 'queue_name', 'message': b'\\x00\\x01'}
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+
+# import standard modules
+import io
+import re
+import json
+import mmap
+import struct
+import importlib
+
+# optional modules, the codecs and compressions using them are only available if they are installed.
+# they are imported the first time they are needed, see get_module, so using ddmq doesn't pay for the ones it doesn't use
+modules = {}
+
+# header bytes of the codecs that don't write plain JSON. Must not be '{' or whitespace
+msgpack_tag = b'M'
+raw_tag = b'R'
+
+# header bytes of compressed messages, by compression
+compression_tags = {'zlib': b'Z', 'lzma': b'L', 'zstd': b'S'}
+compression_names = dict((tag, name) for name, tag in compression_tags.items())
+
+# the raw codec's JSON header is preceded by its length, as a 4 byte unsigned int
+raw_header = struct.Struct('>I')
+
+# a key of a JSON object and the colon after it, see decode_header
+json_key = re.compile(r'\s*"([^"\\]*)"\s*:\s*')
+json_separator = re.compile(r'\s*,')
+
+# how much of the start of a JSON encoded message decode_header looks at
+json_header_size = 1024
+
+# the names of all codecs, the ones that are not installed will raise an error when used
+codecs = ['json', 'orjson', 'ujson', 'msgpack', 'raw']
+
+# the modules needed by the optional codecs
+codec_modules = {'orjson': 'orjson', 'ujson': 'ujson', 'msgpack': 'msgpack'}
+
+# the names of all compressions, and the modules they need
+compressions = ['none', 'zlib', 'lzma', 'zstd']
+compression_modules = {'zlib': 'zlib', 'lzma': 'lzma', 'zstd': 'zstandard'}
+
+
+
+def get_module(name):
+    """
+    Import an optional module the first time it is needed
+
+    Args:
+        name:   name of the module
+
+    Returns:
+        the module, or None if it is not installed
+    """
+
+    try:
+        return modules[name]
+    except KeyError:
+        try:
+            modules[name] = importlib.import_module(name)
+        except ImportError:
+            modules[name] = None
+        return modules[name]
+
+
+
+def available_codecs():
+    """
+    Get the names of the codecs that can be used with the modules installed
+
+    Args:
+        None
+
+    Returns:
+        a list of codec names
+    """
+    return [name for name in codecs if name not in codec_modules or get_module(codec_modules[name]) is not None]
+
+
+
+def check_codec(name):
+    """
+    Make sure a codec exists and can be used
+
+    Args:
+        name:   name of the codec
+
+    Returns:
+        None
+    """
+
+    if name not in codecs:
+        raise ValueError("Unknown codec ({}). Valid codecs are {}.".format(name, ', '.join(codecs)))
+    if name in codec_modules and get_module(codec_modules[name]) is None:
+        raise ImportError("The {0} codec needs the {0} module, which is not installed.".format(name))
+
+
+
+def encode(package, name='json'):
+    """
+    Encode the fields of a message
+
+    Args:
+        package:    a dict with the fields of the message
+        name:       name of the codec to use
+
+    Returns:
+        the encoded message, as bytes
+    """
+
+    if name == 'json':
+        return json.dumps(package).encode('utf-8')
+
+    if name == 'raw':
+        return encode_raw(package)
+
+    check_codec(name)
+
+    if name == 'orjson':
+        return get_module('orjson').dumps(package)
+
+    if name == 'ujson':
+        return get_module('ujson').dumps(package, ensure_ascii=False).encode('utf-8')
+
+    return msgpack_tag + get_module('msgpack').packb(package, use_bin_type=True)
+
+
+
+def encode_raw(package):
+    """
+    Encode a message with the raw codec. The message itself is stored after the header as it is if it is bytes (or another bytes-like object), as UTF-8 if it is a str, and as JSON otherwise
+
+    Args:
+        package:    a dict with the fields of the message
+
+    Returns:
+        the encoded message, as bytes
+    """
+
+    header = dict(package)
+    payload = header.pop('message', None)
+
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        header['message_type'] = 'bytes'
+    elif isinstance(payload, type(u'')):
+        header['message_type'] = 'str'
+        payload = payload.encode('utf-8')
+    else:
+        header['message_type'] = 'json'
+        payload = json.dumps(payload).encode('utf-8')
+
+    header = json.dumps(header).encode('utf-8')
+    return b''.join([raw_tag, raw_header.pack(len(header)), header, payload])
+
+
+
+def check_compression(name):
+    """
+    Make sure a compression exists and can be used
+
+    Args:
+        name:   name of the compression
+
+    Returns:
+        None
+    """
+
+    if name not in compressions:
+        raise ValueError("Unknown compression ({}). Valid compressions are {}.".format(name, ', '.join(compressions)))
+    if name in compression_modules and get_module(compression_modules[name]) is None:
+        raise ImportError("The {} compression needs the {} module, which is not installed.".format(name, compression_modules[name]))
+
+
+
+def compress(data, name):
+    """
+    Compress an encoded message
+
+    Args:
+        data:   the encoded message, as bytes
+        name:   name of the compression to use
+
+    Returns:
+        the compressed message, starting with the compression's header byte
+    """
+
+    check_compression(name)
+
+    if name == 'zlib':
+        return compression_tags[name] + get_module('zlib').compress(data)
+    if name == 'lzma':
+        return compression_tags[name] + get_module('lzma').compress(data)
+    if name == 'zstd':
+        return compression_tags[name] + get_module('zstandard').ZstdCompressor().compress(data)
+    return data
+
+
+
+def is_compressed(data):
+    """
+    Check if an encoded message is compressed
+
+    Args:
+        data:   the encoded message, or at least its first byte
+
+    Returns:
+        True if the message is compressed
+    """
+    return data[:1] in compression_names
+
+
+
+def decompress(data):
+    """
+    Decompress an encoded message, if it is compressed
+
+    Args:
+        data:   the encoded message, as bytes or str (JSON only)
+
+    Returns:
+        the encoded message, uncompressed
+    """
+
+    name = compression_names.get(data[:1])
+    if name is None:
+        return data
+
+    check_compression(name)
+    if name == 'zlib':
+        return get_module('zlib').decompress(data[1:])
+    if name == 'lzma':
+        return get_module('lzma').decompress(data[1:])
+    return get_module('zstandard').ZstdDecompressor().decompress(data[1:])
+
+
+
+def tagged_codec(data):
+    """
+    Get the codec a message was encoded with, if it was one that writes a header byte
+
+    Args:
+        data:   the encoded message, or at least its first byte. Compressed messages have to be complete
+
+    Returns:
+        the name of the codec, or None if the message is JSON
+    """
+
+    tag = decompress(data)[:1] if is_compressed(data) else data[:1]
+    if tag == msgpack_tag:
+        return 'msgpack'
+    if tag == raw_tag:
+        return 'raw'
+    return None
+
+
+
+def decode(data):
+    """
+    Decode a message encoded by any of the codecs, telling them apart by the first byte. Compressed messages are decompressed first
+
+    Args:
+        data:   the encoded message, as bytes or str (JSON only)
+
+    Returns:
+        a dict with the fields of the message
+    """
+
+    tag = data[:1]
+    if tag in compression_names:
+        data = decompress(data)
+        tag = data[:1]
+
+    if tag == msgpack_tag:
+        check_codec('msgpack')
+        return get_module('msgpack').unpackb(data[1:], raw=False)
+
+    if tag == raw_tag:
+        return decode_raw(data)
+
+    return decode_json(data)
+
+
+
+def decode_header(data, names):
+    """
+    Decode only some of the fields of a message, without decoding the message itself. This only works if the fields come first in the encoded message, which they do in messages encoded from message.to_dict (see message.header_fields). The message text of raw encoded messages is always skipped
+
+    Args:
+        data:   the encoded message, as bytes or str (JSON only)
+        names:  the names of the fields to decode
+
+    Returns:
+        a dict with the fields, or None if they could not be decoded on their own (e.g. in messages written by earlier versions of ddmq) and the whole message has to be decoded instead
+    """
+
+    tag = data[:1]
+    if tag in compression_names:
+        data = decompress(data)
+        tag = data[:1]
+
+    if tag == raw_tag:
+        header_end = 1 + raw_header.size + raw_header.unpack_from(data, 1)[0]
+        package = json.loads(data[1 + raw_header.size:header_end].decode('utf-8'))
+        return dict((name, package.get(name)) for name in names)
+
+    package = {}
+    if tag == msgpack_tag:
+        check_codec('msgpack')
+        stream = io.BytesIO(data)
+        stream.seek(1)
+        msgpack = get_module('msgpack')
+        unpacker = msgpack.Unpacker(stream, raw=False)
+        try:
+            if unpacker.read_map_header() < len(names):
+                return None
+            while len(package) < len(names):
+                name = unpacker.unpack()
+                if name not in names:
+                    return None
+                package[name] = unpacker.unpack()
+        except (ValueError, msgpack.UnpackException):
+            return None
+        return package
+
+    # only the start of a JSON encoded message is decoded, the values are read with the json module one at a time
+    if isinstance(data, bytes):
+        data = data[:json_header_size].decode('utf-8', 'ignore')
+    decoder = json.JSONDecoder()
+    pos = data.find('{') + 1
+    if not pos:
+        return None
+    try:
+        while len(package) < len(names):
+            key = json_key.match(data, pos)
+            if not key or key.group(1) not in names:
+                return None
+            package[key.group(1)], pos = decoder.raw_decode(data, key.end())
+            if len(package) < len(names):
+                separator = json_separator.match(data, pos)
+                if not separator:
+                    return None
+                pos = separator.end()
+    except ValueError:
+        return None
+    return package
+
+
+
+def decode_json(data):
+    """
+    Decode a JSON encoded message, using the fastest JSON module installed
+
+    Args:
+        data:   the encoded message, as bytes or str
+
+    Returns:
+        a dict with the fields of the message
+    """
+
+    orjson = get_module('orjson')
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # e.g. NaN, which the json module writes but orjson doesn't accept
+            pass
+
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+
+def decode_raw(data):
+    """
+    Decode a message encoded by the raw codec
+
+    Args:
+        data:   the encoded message, as bytes
+
+    Returns:
+        a dict with the fields of the message
+    """
+
+    header_end = 1 + raw_header.size + raw_header.unpack_from(data, 1)[0]
+    package = json.loads(data[1 + raw_header.size:header_end].decode('utf-8'))
+
+    package['message'] = decode_payload(data[header_end:], package.pop('message_type', 'bytes'))
+    return package
+
+
+
+def decode_payload(payload, message_type):
+    """
+    Convert the message stored after the header of a raw encoded message back to the type it was published as
+
+    Args:
+        payload:        the message, as bytes
+        message_type:   the message_type field of the header, 'bytes', 'str' or 'json'
+
+    Returns:
+        the message
+    """
+
+    if message_type == 'str':
+        return payload.decode('utf-8')
+    if message_type == 'json':
+        return json.loads(payload.decode('utf-8'))
+    return payload
+
+
+
+def map_raw(fileno):
+    """
+    Decode a message file written by the raw codec without reading the message itself. The file is mapped into memory and a bytes message is given as a memoryview of the part of the map after the header, so it is only read from disk as it is used, and never copied unless asked for (e.g. with tobytes()). The map stays valid after the file has been renamed or removed
+
+    Args:
+        fileno: file descriptor of the message file, opened for reading
+
+    Returns:
+        a dict with the fields of the message
+    """
+
+    data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    header_end = 1 + raw_header.size + raw_header.unpack_from(data, 1)[0]
+    package = json.loads(data[1 + raw_header.size:header_end].decode('utf-8'))
+
+    # only bytes messages are left in the map, the others are converted as usual
+    message_type = package.pop('message_type', 'bytes')
+    if message_type != 'bytes':
+        package['message'] = decode_payload(data[header_end:], message_type)
+        data.close()
+        return package
+
+    package['message'] = memoryview(data)[header_end:]
+    return package
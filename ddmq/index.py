@@ -0,0 +1,300 @@
+#! /usr/bin/env python
+"""
+Defines the queue_index class which keeps track of the messages waiting in a
+queue without having to list and sort the whole queue folder on every consume.
+The index is an append-only journal file (ddmq.index) kept next to the queue's
+ddmq.yaml file. Publishers append the file name of each new message to the
+journal, and consumers read the journal incrementally into a heap so the head
+of the queue can be found in O(log N).
+
+The journal is only a hint, the message files themselves are still the truth.
+A consumer that pops a file name that has already been consumed by someone else
+will just move on to the next one, and if the journal is missing, corrupted or
+has grown much larger than the queue it will be rebuilt from the queue folder.
+
+>>> idx = queue_index('../temp/ddmq/queue_name')
+>>> idx.add(['999.15397024581234.ddmq89723438b9d0403c91943f4ffaf8ba35'])
+>>> next(idx.iter_head())
+'999.15397024581234.ddmq89723438b9d0403c91943f4ffaf8ba35'
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+try:
+    FileNotFoundError
+except NameError:
+    FileNotFoundError = IOError
+
+
+# import standard modules
+import os
+import re
+import heapq
+import fnmatch
+import errno
+import logging as log
+
+
+
+class queue_index:
+    """
+    Class to keep a heap of the messages waiting in a queue, backed by a journal file
+    """
+
+    # pattern a line in the journal has to match to be considered valid, optionally prefixed by a shard subfolder
+    line_pattern = re.compile('^(s\d+_\d+[/\\\\])?\d+\.\d+\.ddmq[a-zA-Z0-9]+$')
+
+    # the minimum number of journal lines to read before the journal is compacted
+    min_compact_lines = 10000
+
+
+    def __init__(self, path, key=None, filename='ddmq.index', lister=None):
+        """
+        Initialize an index for the queue located at the specified path
+
+        Args:
+            path:       path to the queue folder
+            key:        function used to sort the message file names, defaults to plain string order
+            filename:   name of the journal file inside the queue folder
+            lister:     function returning the paths of all messages in the queue, relative to the queue folder. Defaults to listing the queue folder itself
+
+        Returns:
+            None
+        """
+
+        log.debug('Initializing index for {}'.format(path))
+
+        self.path = path
+        self.journal = os.path.join(path, filename)
+        self.key = key
+        self.lister = lister
+        self.heap = []
+        self.offset = 0
+        self.inode = None
+        self.lines = 0
+        self.compact_at = self.min_compact_lines
+
+
+    def __len__(self):
+        """
+        Get the number of file names currently in the heap (some of them could already have been consumed by other processes)
+        """
+        return len(self.heap)
+
+
+    def entry(self, filename):
+        """
+        Create a heap entry from a message file name
+        """
+        if self.key:
+            return (self.key(filename), filename)
+        return (filename, filename)
+
+
+    def list_folder(self):
+        """
+        List all message files waiting in the queue folder
+
+        Args:
+            None
+
+        Returns:
+            a list of message file names
+        """
+        if self.lister:
+            return self.lister()
+        return fnmatch.filter(os.listdir(self.path), '*.ddmq*')
+
+
+
+    def add(self, filenames):
+        """
+        Append message file names to the journal. The journal is only appended to if it exists, otherwise it will be built from the queue folder the next time it is read
+
+        Args:
+            filenames:  a list of message file names to add
+
+        Returns:
+            None
+        """
+
+        if not filenames:
+            return
+
+        # write all names in a single call so concurrent appends don't interleave
+        data = ''.join('{}\n'.format(filename) for filename in filenames).encode('utf-8')
+
+        try:
+            fd = os.open(self.journal, os.O_WRONLY | os.O_APPEND)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+        try:
+            os.write(fd, data)
+
+            # if the journal was replaced by a rebuild while writing, the names could have been written after the rebuild copied the old journal's last lines, so write them to the new journal as well. Names written twice are harmless
+            replaced = os.fstat(fd).st_ino != os.stat(self.journal).st_ino
+        except (FileNotFoundError, OSError):
+            replaced = False
+        finally:
+            os.close(fd)
+
+        if replaced:
+            self.add(filenames)
+
+
+
+    def rebuild(self):
+        """
+        Rebuild the journal and heap from the message files in the queue folder
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        log.info('Rebuilding index {}'.format(self.journal))
+
+        # keep the old journal open, so the names publishers append to it while the folder is listed can be copied to the new one
+        try:
+            old_journal = open(self.journal, 'rb')
+            old_journal.seek(0, os.SEEK_END)
+        except (FileNotFoundError, IOError, OSError):
+            old_journal = None
+
+        try:
+            filenames = self.list_folder()
+            self.heap = sorted(self.entry(filename) for filename in filenames)
+
+            # write the sorted names to a new journal and replace the old one
+            data = ''.join('{}\n'.format(entry[1]) for entry in self.heap).encode('utf-8')
+            intermediate = '{}.intermediate.{}'.format(self.journal, os.getpid())
+            with open(intermediate, 'wb') as journal_handle:
+                journal_handle.write(data)
+            os.rename(intermediate, self.journal)
+
+            # copy what was appended to the old journal since it was opened. Later appends see that the journal was replaced and write to the new one themselves (see add)
+            if old_journal is not None:
+                appended = old_journal.read()
+                appended = appended[:appended.rfind(b'\n') + 1].decode('utf-8').splitlines()
+                self.add([line for line in appended if self.line_pattern.match(line)])
+        finally:
+            if old_journal is not None:
+                old_journal.close()
+
+        stat = os.stat(self.journal)
+        self.inode = stat.st_ino
+        self.offset = len(data)
+        self.lines = len(self.heap)
+
+        # compact again when the journal has grown to twice the size of the current queue
+        self.compact_at = max(self.min_compact_lines, 2 * len(self.heap))
+
+
+
+    def refresh(self):
+        """
+        Read any new lines appended to the journal since the last time it was read. The journal will be rebuilt if it is missing, replaced, corrupted or too large
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        try:
+            stat = os.stat(self.journal)
+        except (FileNotFoundError, OSError):
+            return self.rebuild()
+
+        # start over if the journal has been replaced or truncated by another process
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            log.debug('Index journal {} replaced, reloading'.format(self.journal))
+            self.heap = []
+            self.offset = 0
+            self.lines = 0
+            self.inode = stat.st_ino
+
+        # nothing new
+        if stat.st_size == self.offset:
+            return
+
+        with open(self.journal, 'rb') as journal_handle:
+            journal_handle.seek(self.offset)
+            data = journal_handle.read(stat.st_size - self.offset)
+
+        # only use complete lines, a line could be in the middle of being written
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            if not self.line_pattern.match(line):
+                log.warning('Corrupted line in index journal {}, rebuilding'.format(self.journal))
+                return self.rebuild()
+            heapq.heappush(self.heap, self.entry(line))
+            self.lines += 1
+        self.offset += end
+
+        # compact the journal if it has grown too large
+        if self.lines > self.compact_at:
+            self.rebuild()
+
+
+
+    def iter_head(self):
+        """
+        Generator that pops file names from the head of the queue, in priority order. When the heap runs empty the queue folder is checked, and if it is not empty the index is considered stale and rebuilt
+
+        Args:
+            None
+
+        Returns:
+            a generator of message file names
+        """
+
+        self.refresh()
+        rebuilt = False
+        while True:
+
+            if not self.heap:
+
+                # check for new lines, then fall back to the queue folder itself
+                self.refresh()
+                if not self.heap and not rebuilt:
+                    rebuilt = True
+                    if self.list_folder():
+                        self.rebuild()
+
+                if not self.heap:
+                    return
+
+            yield heapq.heappop(self.heap)[1]
+
+
+    def clear(self):
+        """
+        Remove the journal and empty the heap
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        log.debug('Clearing index {}'.format(self.journal))
+
+        self.heap = []
+        self.offset = 0
+        self.lines = 0
+        self.inode = None
+        for path in [self.journal, '{}.intermediate.{}'.format(self.journal, os.getpid())]:
+            try:
+                os.remove(path)
+            except (FileNotFoundError, OSError):
+                pass
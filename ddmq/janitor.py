@@ -0,0 +1,369 @@
+#! /usr/bin/env python
+"""
+Defines the janitor class which keeps all queues in a root directory clean
+from a single long-lived process, so clients can publish and consume with
+skip_cleaning=True and never pay for the cleaning themselves.
+
+Each queue is cleaned on its own schedule, when its clean interval has passed
+since it was last cleaned (by anyone, see broker.take_clean_lease), or earlier
+if a consumed message is about to expire. The queues' work folders are
+watched so new consumed messages are noticed right away, and the cleaning
+itself runs in a pool of threads so a large queue doesn't hold up the others.
+The janitor takes the clean lease like any other cleaner, so a queue someone
+else has just cleaned, or is cleaning, is skipped unless it is forced to.
+
+>>> b = ddmq.broker('../temp/ddmq')
+>>> j = janitor(b, threads=4, stats_path='../temp/janitor.json')
+>>> j.run()    # runs until stopped with j.stop() or Ctrl-C
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+try:
+    FileNotFoundError
+except NameError:
+    FileNotFoundError = IOError
+
+
+# import standard modules
+import os
+import json
+import time
+import select
+import threading
+import logging as log
+from multiprocessing.pool import ThreadPool
+
+try:
+    from .watcher import folder_watcher
+except (ValueError, ImportError):
+    from watcher import folder_watcher
+
+# how often to look for new or deleted queues, in seconds
+refresh_interval = 10
+
+# the shortest time between two cleanings of the same queue, in seconds
+min_clean_gap = 1
+
+# the longest time to sleep between checks of the schedule, in seconds
+max_sleep = 1
+
+
+
+class janitor:
+    """
+    Class to clean the queues of a root directory in the background
+    """
+
+    def __init__(self, broker, threads=4, stats_path=None, poll=False, force=False):
+        """
+        Initialize a janitor for the queues of a broker object
+
+        Args:
+            broker:     the broker object to clean the queues of
+            threads:    the number of queues that can be cleaned at the same time
+            stats_path: if set, the janitor's statistics are written to this file (JSON) after each cleaning
+            poll:       if True, don't watch the work folders with inotify even if it is available
+            force:      if True, clean the queues when they are due even if another process has cleaned them recently or is cleaning them
+
+        Returns:
+            None
+        """
+
+        log.debug('Initializing janitor for {}'.format(broker.root))
+
+        self.broker = broker
+        self.threads = threads
+        self.stats_path = stats_path
+        self.poll = poll
+        self.force = force
+
+        self.schedule = {}
+        self.running = set()
+        self.changed = set()
+        self.checked = {}
+        self.attempted = {}
+        self.expiries = {}
+        self.watchers = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.pool = None
+
+        # broker objects are not thread-safe, so each thread in the pool cleans with its own, see get_thread_broker
+        self.local = threading.local()
+        self.thread_brokers = []
+
+
+
+    def refresh_queues(self):
+        """
+        Start taking care of new queues, and forget about deleted ones
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        queues = self.broker.list_queues()
+
+        for queue in queues:
+            if queue in self.schedule:
+                continue
+            log.info('Janitor found queue {}'.format(queue))
+            self.watchers[queue] = folder_watcher(os.path.join(self.broker.root, queue, 'work'), poll=self.poll)
+            self.stats.setdefault(queue, {'cleans':0, 'skipped':0, 'errors':0, 'last_clean':0, 'last_duration':0})
+            self.schedule[queue] = self.get_due(queue)
+
+        for queue in set(self.schedule) - set(queues):
+            log.info('Janitor lost queue {}'.format(queue))
+            self.watchers.pop(queue).close()
+            del self.schedule[queue]
+            self.expiries.pop(queue, None)
+            for brokerObj in [self.broker] + self.thread_brokers:
+                brokerObj.queue_settings.pop(queue, None)
+
+
+    def get_due(self, queue):
+        """
+        Get the time a queue should be cleaned next
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            an epoch time
+        """
+
+        # when the clean interval has passed since anyone cleaned the queue
+        due = self.broker.last_cleaned(queue) + self.broker.get_settings(queue)['clean_interval']
+
+        # or right after the next consumed message expires
+        expiry = self.broker.next_expiry(queue)
+        self.expiries[queue] = expiry
+        if expiry is not None:
+            due = min(due, expiry + 1)
+
+        return max(due, self.attempted.get(queue, 0) + min_clean_gap)
+
+
+    def get_thread_broker(self):
+        """
+        Get the broker object of the current thread in the pool, creating it the first time
+
+        Args:
+            None
+
+        Returns:
+            a broker object for the same root as the janitor's
+        """
+
+        if not hasattr(self.local, 'broker'):
+            self.local.broker = type(self.broker)(self.broker.root, backend=self.broker.backend, codec=self.broker.codec)
+            with self.lock:
+                self.thread_brokers.append(self.local.broker)
+        return self.local.broker
+
+
+    def clean(self, queue):
+        """
+        Clean a queue and schedule the next cleaning. Runs in the thread pool
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            None
+        """
+
+        # a queue that is due because a consumed message expired is cleaned if nobody has cleaned it since then,
+        # even if the clean interval has not passed (clean compares whole seconds, see broker.clean_expired)
+        started = time.time()
+        with self.lock:
+            expiry = self.expiries.get(queue)
+        since = expiry + 1 if expiry is not None and expiry + 1 <= started else None
+
+        cleaned = failed = False
+        try:
+            cleaned = self.get_thread_broker().clean(queue, force=self.force, since=since)
+        except Exception as e:
+            log.warning('Janitor failed to clean {}: {}'.format(queue, e))
+            failed = True
+
+        with self.lock:
+            queue_stats = self.stats[queue]
+            queue_stats['errors'] += failed
+            if cleaned:
+                queue_stats['cleans'] += 1
+                queue_stats['last_clean'] = time.time()
+                queue_stats['last_duration'] = time.time() - started
+            elif not failed:
+                # someone else cleaned it recently, or is cleaning it
+                queue_stats['skipped'] += 1
+            self.attempted[queue] = time.time()
+
+            if queue in self.schedule:
+                try:
+                    self.schedule[queue] = self.get_due(queue)
+                except (FileNotFoundError, IOError, OSError):
+                    # the queue was deleted while it was cleaned
+                    pass
+            self.running.discard(queue)
+
+        self.write_stats()
+
+
+    def get_stats(self):
+        """
+        Get the janitor's statistics for all queues, together with the counters its broker objects keep
+
+        Args:
+            None
+
+        Returns:
+            a dict with queue names as keys and dicts of counters as values
+        """
+
+        with self.lock:
+            stats = {}
+            for queue, queue_stats in self.stats.items():
+                stats[queue] = dict(queue_stats)
+                for brokerObj in [self.broker] + self.thread_brokers:
+                    for counter, value in brokerObj.get_stats(queue).items():
+                        if counter != 'compression_ratio':
+                            stats[queue][counter] = stats[queue].get(counter, 0) + value
+                if stats[queue].get('compressed_bytes_out'):
+                    stats[queue]['compression_ratio'] = stats[queue]['compressed_bytes_in'] / stats[queue]['compressed_bytes_out']
+                stats[queue]['next_clean'] = self.schedule.get(queue)
+            return stats
+
+
+    def write_stats(self):
+        """
+        Write the statistics to the stats file, if one was given
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        if not self.stats_path:
+            return
+
+        stats = self.get_stats()
+        tmp_path = '{}.{}.intermediate'.format(self.stats_path, threading.current_thread().ident)
+        with open(tmp_path, 'w') as stats_handle:
+            json.dump(stats, stats_handle, indent=4, sort_keys=True)
+        os.rename(tmp_path, self.stats_path)
+
+
+
+    def run(self, timeout=None):
+        """
+        Clean the queues as they become due, until stopped
+
+        Args:
+            timeout:    stop after this many seconds, None to run until stop is called
+
+        Returns:
+            None
+        """
+
+        log.info('Janitor starting in {}'.format(self.broker.root))
+
+        self.pool = ThreadPool(self.threads)
+        self.stopped = False
+        next_refresh = 0
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        try:
+            while not self.stopped:
+
+                now = time.time()
+                if timeout is not None and now >= deadline:
+                    break
+
+                if now >= next_refresh:
+                    with self.lock:
+                        self.refresh_queues()
+                    next_refresh = now + refresh_interval
+
+                with self.lock:
+
+                    # consumed messages have arrived in these queues, they could expire before the current schedule.
+                    # listing a work folder is not free, so it is done at most once per min_clean_gap for each queue
+                    for queue in list(self.changed):
+                        if queue not in self.schedule or queue in self.running:
+                            self.changed.discard(queue)
+                        elif self.checked.get(queue, 0) + min_clean_gap <= now:
+                            self.schedule[queue] = self.get_due(queue)
+                            self.checked[queue] = now
+                            self.changed.discard(queue)
+
+                    # start cleaning the queues that are due
+                    for queue, due in self.schedule.items():
+                        if due <= now and queue not in self.running:
+                            self.running.add(queue)
+                            self.pool.apply_async(self.clean, (queue,))
+
+                    waiting = [due for queue, due in self.schedule.items() if queue not in self.running]
+
+                # sleep until the next queue is due, or something happens in a work folder
+                sleep = min(waiting + [next_refresh, now + max_sleep]) - now
+                self.wait(max(sleep, 0))
+
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.write_stats()
+
+        log.info('Janitor stopped')
+
+
+    def wait(self, timeout):
+        """
+        Wait until something happens in one of the watched work folders
+
+        Args:
+            timeout:    the maximum number of seconds to wait
+
+        Returns:
+            None
+        """
+
+        watchers = dict((watcher.fileno(), queue) for queue, watcher in self.watchers.items() if watcher.fileno() is not None)
+        if not watchers:
+            time.sleep(timeout)
+            return
+
+        try:
+            ready = select.select(list(watchers), [], [], timeout)[0]
+        except (select.error, OSError):
+            # interrupted by a signal
+            return
+
+        with self.lock:
+            for fd in ready:
+                self.watchers[watchers[fd]].drain()
+                self.changed.add(watchers[fd])
+
+
+    def stop(self):
+        """
+        Stop the janitor after the cleanings in progress are done
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self.stopped = True
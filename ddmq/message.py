@@ -6,6 +6,7 @@ You define a message by supplying selected arguments, for example
 
 >>> msg = message(queue='queue_name', message='Hello World!')
 >>> print(msg)
+blob = None
 filename = None
 id = None
 message = Hello World!
@@ -13,24 +14,49 @@ priority = None
 queue = queue_name
 queue_number = None
 requeue = None
+requeue_counter = None
+requeue_limit = None
 timeout = None
 
+Messages read from files are created with from_bytes, which doesn't decode
+the file contents until one of the message's fields is used. The fields are
+stored in __slots__ instead of a __dict__, to keep large batches of messages
+small.
+
 """
 
 import json
-import logging as log
 import os
+import collections
+
+try:
+    from .codec import encode, decode, decode_header
+except (ValueError, ImportError):
+    from codec import encode, decode, decode_header
+
+# lightweight record of a published message, returned by broker.publish_many
+receipt = collections.namedtuple('receipt', ['queue', 'id', 'filename'])
 
-class message:
+# the fields the broker needs when consuming a message, they are encoded first so they can be decoded without the rest (see codec.decode_header)
+header_fields = ('timeout', 'blob')
+
+# the fields of a message, in the order they are encoded
+fields = header_fields + ('filename', 'id', 'message', 'priority', 'queue', 'queue_number', 'requeue', 'requeue_counter', 'requeue_limit')
+field_set = frozenset(fields)
+
+class message(object):
     """
     Class to represent a single message
     """
 
+    # _raw holds the encoded message until it is decoded, _extra any fields this version doesn't know about
+    __slots__ = fields + ('_raw', '_extra')
+
 
-    def __init__(self, queue=None, message=None, timeout=None, id=None, priority=None, queue_number=None, filename=None, requeue=None, requeue_counter=None, requeue_limit=None):
+    def __init__(self, queue=None, message=None, timeout=None, id=None, priority=None, queue_number=None, filename=None, requeue=None, requeue_counter=None, requeue_limit=None, blob=None):
         """
         Initialize a message with the given parameters
-        
+
         Args:
             queue:          name of the queue the message belongs to
             message:        the message text itself
@@ -41,13 +67,14 @@ class message:
             filename:       file name of the file containing this message
             requeue:        if True, the message will be requeued with default priority after it expires. If set to an int, that will be used as a custom requeuing priority
             counter         counts the number of times the message has been placed in queue. A list where the first number tells how many times the message has been processed and the second number defines how many times it should be processed at most (the default None means infinite)
+            blob:           if the message text is stored in a separate blob file, a dict with its size and type (see blob.py)
 
         Returns:
             None
         """
 
-        log.debug('Initializing message object')
-
+        self._raw = None
+        self._extra = None
         self.message = message
         self.queue = queue
         self.timeout = timeout
@@ -58,49 +85,194 @@ class message:
         self.requeue = requeue
         self.requeue_counter = requeue_counter
         self.requeue_limit = requeue_limit
+        self.blob = blob
+
+
+    def __getattr__(self, name):
+        """
+        Called for fields that have not been set yet. Decodes the message if that has not been done, fields missing from the encoded message are None
+        """
+
+        if name not in field_set:
+            raise AttributeError(name)
+
+        if self._raw is not None:
+            self.decode()
+            try:
+                return object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return None
+
+
+    def __getstate__(self):
+        """Get the state of the message when pickled"""
+        return self.to_dict()
+
+
+    def __setstate__(self, package):
+        """Restore the state of a pickled message"""
+        self._raw = None
+        self._extra = None
+        self.update(package)
+
+
+    @classmethod
+    def from_dict(cls, package):
+        """
+        Create a message object from a dict with its fields
+
+        Args:
+            package:    a dict with the fields of the message
+
+        Returns:
+            a message object
+        """
+
+        new_msg = cls.__new__(cls)
+        new_msg._raw = None
+        new_msg._extra = None
+        new_msg.update(package)
+        return new_msg
 
 
     @classmethod
-    def json2msg(self, package):
-        """Converty a JSON object to a message object"""
+    def from_bytes(cls, data):
+        """
+        Create a message object from the encoded message, e.g. the contents of a message file. The data is not decoded until one of the fields is used
 
-        log.debug('Creating a message object from a JSON string')
+        Args:
+            data:   the encoded message, as bytes (or str, if JSON encoded)
 
-        # if the package is a string, convert to dict
-        if type(package) is str:
-            package = json.loads(package)
+        Returns:
+            a message object
+        """
 
-        # create a new empty message and update its values
-        new_msg = message()
-        new_msg.__dict__.update(package)
+        new_msg = cls.__new__(cls)
+        new_msg._raw = data
+        new_msg._extra = None
         return new_msg
 
 
+    def decode(self):
+        """
+        Decode the data the message was created from, if not done already. Fields that have been set since the message was created are kept
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        raw = self._raw
+        if raw is None:
+            return
+        self._raw = None
+
+        package = decode(raw)
+
+        for key in fields:
+            try:
+                object.__getattribute__(self, key)
+            except AttributeError:
+                object.__setattr__(self, key, package.get(key))
+
+        if len(package) > len(fields) or not field_set.issuperset(package):
+            self._extra = dict((key, val) for key, val in package.items() if key not in field_set)
+
+
+    def decode_header(self):
+        """
+        Decode only the header fields (timeout and blob) of the data the message was created from, leaving the rest, e.g. a large message text, to be decoded when it is used. The whole message is decoded if the header fields can't be decoded on their own
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        raw = self._raw
+        if raw is None:
+            return
+
+        package = decode_header(raw, header_fields)
+        if package is None:
+            self.decode()
+            return
+
+        for key, val in package.items():
+            try:
+                object.__getattribute__(self, key)
+            except AttributeError:
+                object.__setattr__(self, key, val)
+
+
+    def to_dict(self):
+        """
+        Get the fields of the message as a dict
+
+        Args:
+            None
+
+        Returns:
+            a dict with the fields of the message
+        """
+
+        self.decode()
+        package = dict((key, getattr(self, key)) for key in fields)
+        if self._extra:
+            package.update(self._extra)
+        return package
+
+
+    def to_bytes(self, codec='json'):
+        """
+        Encode the message, e.g. to be written to a message file
+
+        Args:
+            codec:  name of the codec to encode the message with (see codec.py)
+
+        Returns:
+            the encoded message, as bytes
+        """
+        return encode(self.to_dict(), codec)
+
+
+    @classmethod
+    def json2msg(cls, package):
+        """Converty a JSON object (or a dict) to a message object"""
+
+        # if the package is a string, decode it when needed
+        if isinstance(package, (str, bytes)):
+            return cls.from_bytes(package)
+        return cls.from_dict(package)
+
+
     def msg2json(self):
         """Convert a message object to a JSON object"""
+        return json.dumps(self.to_dict())
 
-        log.debug('Creating a JSON string from a message object')
 
-        return json.dumps(self.__dict__)
-
-    
     def update(self, package):
         """Update a message object with the parameters supplied by the package (dict)"""
 
-        log.debug('Updating a message object')
-
-        self.__dict__.update(package)
+        self.decode()
+        for key, val in package.items():
+            if key in field_set:
+                setattr(self, key, val)
+            else:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = val
 
 
     def __repr__(self):
         """Print the values of a message object"""
 
-        log.debug('Printing a message object')
-
-        # go throguh the variables and collect their names and values
+        # go throguh the fields and collect their names and values
         text = ""
-        for key,val in sorted(self.__dict__.items()):
+        for key,val in sorted(self.to_dict().items()):
             text += '{} = {}{}'.format(key,val,os.linesep)
         return text.rstrip()
-
-
@@ -0,0 +1,806 @@
+#! /usr/bin/env python
+"""
+Defines the segment_backend class, a storage backend that keeps the messages
+of a queue in a few append-only log files instead of one file per message.
+Select it by creating a broker with backend='segment', or by setting
+backend: segment in the root's ddmq.yaml. Queues remember which backend they
+were created with in their own ddmq.yaml file.
+
+The files in a queue folder using the segment backend are
+
+    ddmq.yaml                       the queue's settings, as usual
+    segment.<priority>.log          one log per priority level, one message per line
+    work/ddmq.lock                  lock file, all operations hold an fcntl lock on it
+    work/segment.offsets            how far into each log messages have been consumed
+    work/segment.work.log           consumed messages, with their expiry time
+    work/segment.acks.log           work file names of consumed messages that have been acked or requeued
+
+Only the logs are kept in the queue folder itself, so consumers waiting for
+messages are woken up by publishers but not by each other.
+
+Messages are encoded with the queue's codec and compressed according to its
+settings, like with the other backends. JSON encoded messages are written to
+the logs as they are, other codecs and compressed messages are base64 encoded
+since they could contain line breaks. The queue's durability setting applies
+to the message logs, the work logs are not synced (just like the renames of
+consumed messages aren't with the files backend).
+
+When all messages in a log have been consumed the log is removed. The work
+and acks logs are compacted when the queue is cleaned. Each backend object
+keeps the consumed messages of the queues it has used in memory, and only
+reads what other processes have appended to the work and acks logs since.
+
+>>> b = ddmq.broker('../temp/ddmq', create=True, backend='segment')
+>>> b.publish('queue_name', 'Hello World!')
+>>> b.consume('queue_name').message
+'Hello World!'
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+try:
+    FileNotFoundError
+except NameError:
+    FileNotFoundError = IOError
+
+
+# import standard modules
+import os
+import json
+import time
+import base64
+import fnmatch
+import errno
+import logging as log
+
+try:
+    from .message import message
+    from .codec import encode, decode, tagged_codec, is_compressed
+except (ValueError, ImportError):
+    from message import message
+    from codec import encode, decode, tagged_codec, is_compressed
+
+# the number of bytes to read at a time from a log
+read_size = 65536
+
+# fdatasync is not available on all systems
+try:
+    fdatasync = os.fdatasync
+except AttributeError:
+    fdatasync = os.fsync
+
+
+
+class segment_backend:
+    """
+    Class to store queues as append-only segment logs
+    """
+
+    # the logs are closed after each write, so waiting consumers only have to watch for closed files
+    watch_modify = False
+
+    def __init__(self, broker):
+        """
+        Initialize a segment backend for a broker object
+
+        Args:
+            broker:     the broker object using the backend, used to look up queue settings
+
+        Returns:
+            None
+        """
+
+        log.debug('Initializing segment backend')
+
+        # fcntl is only available on unix-like systems
+        import fcntl
+        self.fcntl = fcntl
+        self.broker = broker
+
+        # the consumed messages of each queue, as read from its work and acks logs, see sync_work
+        self.work = {}
+
+
+
+    def get_path(self, queue, filename):
+        """
+        Get the path to one of a queue's files
+        """
+        return os.path.join(self.broker.root, queue, filename)
+
+
+    def get_work_file(self, queue, filename):
+        """
+        Get the path to one of a queue's files in the work folder
+        """
+        return os.path.join(self.broker.root, queue, 'work', filename)
+
+
+    def get_log_path(self, queue, priority):
+        """
+        Get the path to the log of a priority level. The priority is zero-padded so the logs sort in priority order
+        """
+        return self.get_path(queue, 'segment.{:010d}.log'.format(priority))
+
+
+    def lock(self, queue):
+        """
+        Take an exclusive lock on a queue, waiting until it is available
+
+        Args:
+            queue:  name of the queue to lock
+
+        Returns:
+            the file descriptor holding the lock, to be passed to unlock
+        """
+
+        fd = os.open(self.get_work_file(queue, 'ddmq.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            self.fcntl.lockf(fd, self.fcntl.LOCK_EX)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+
+    def unlock(self, fd):
+        """
+        Release a lock taken by lock
+        """
+        try:
+            self.fcntl.lockf(fd, self.fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+    def append(self, path, lines, durability='none'):
+        """
+        Append lines to a log in a single write. If the last write to the log was cut short (e.g. by a crash) a newline is added first, so the partial line doesn't swallow the first new one
+
+        Args:
+            path:       path to the log
+            lines:      a list of str to append, without newlines
+            durability: the queue's durability setting, 'file' to sync the log to disk after writing and 'dir' to also sync the folder if the log is new
+
+        Returns:
+            the offset of the first line in the log, and the size of the log after writing
+        """
+
+        data = ''.join('{}\n'.format(line) for line in lines).encode('utf-8')
+
+        fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            size = os.fstat(fd).st_size
+            first = size
+            if size:
+                os.lseek(fd, size-1, os.SEEK_SET)
+                if os.read(fd, 1) != b'\n':
+                    data = b'\n' + data
+                    first += 1
+            os.write(fd, data)
+            if durability != 'none':
+                fdatasync(fd)
+        finally:
+            os.close(fd)
+
+        if durability == 'dir' and not size:
+            self.broker.sync_folder(os.path.dirname(path))
+
+        return first, size + len(data)
+
+
+    def read_lines(self, path, offset=0):
+        """
+        Read the complete lines in a log from an offset onwards
+
+        Args:
+            path:   path to the log
+            offset: the offset to start reading at
+
+        Returns:
+            a list of (offset, line) tuples, with the lines as str without newlines, and the offset after the last complete line
+        """
+
+        try:
+            with open(path, 'rb') as log_handle:
+                log_handle.seek(offset)
+                data = log_handle.read()
+        except (FileNotFoundError, IOError, OSError):
+            return [], offset
+
+        lines = []
+        start = 0
+        end = data.rfind(b'\n') + 1
+        while start < end:
+            newline = data.index(b'\n', start)
+            if newline > start:
+                lines.append((offset + start, data[start:newline].decode('utf-8')))
+            start = newline + 1
+
+        return lines, offset + end
+
+
+    def encode_record(self, queue, package, codec=None):
+        """
+        Encode a message as a line of a log, with the given codec or the queue's, compressed according to the queue's settings. JSON is written as it is, other codecs and compressed messages are base64 encoded
+
+        Args:
+            queue:      name of the queue, whose settings must be loaded
+            package:    a dict with the fields of the message
+            codec:      the codec to use, None for the queue's
+
+        Returns:
+            the line, as a str
+        """
+
+        data = self.broker.compress(queue, encode(package, codec or self.broker.get_codec(queue)))
+        if data[:1] == b'{':
+            return data.decode('utf-8')
+        return base64.b64encode(data).decode('ascii')
+
+
+    def decode_record(self, queue, record):
+        """
+        Decode a message from a line of a log, see encode_record. Compressed messages are decompressed through the broker, so it is counted in the queue's statistics
+
+        Args:
+            queue:  name of the queue
+            record: the line, as a str
+
+        Returns:
+            a dict with the fields of the message, and the codec it was encoded with (None for JSON)
+        """
+
+        if record[:1] == '{':
+            return decode(record), None
+
+        data = base64.b64decode(record)
+        if is_compressed(data):
+            data = self.broker.decompress(queue, data)
+        return decode(data), tagged_codec(data)
+
+
+    def read_offsets(self, queue):
+        """
+        Read how far into each log messages have been consumed
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            a dict with the log file names as keys and byte offsets as values
+        """
+
+        try:
+            with open(self.get_work_file(queue, 'segment.offsets'), 'r') as offsets_handle:
+                return json.load(offsets_handle)
+        except (FileNotFoundError, IOError, OSError, ValueError):
+            return {}
+
+
+    def write_file(self, path, data):
+        """
+        Replace the contents of a file atomically, by writing to an intermediate file and renaming it into place
+        """
+
+        with open(path+'.intermediate', 'wb') as file_handle:
+            file_handle.write(data.encode('utf-8'))
+        os.rename(path+'.intermediate', path)
+
+
+    def list_logs(self, queue):
+        """
+        List the logs of a queue, in priority order
+        """
+        return sorted(fnmatch.filter(os.listdir(os.path.join(self.broker.root, queue)), 'segment.[0-9]*.log'))
+
+
+    def get_claim_key(self, claim):
+        """
+        Get the work file name of a consumed message, which is what it is acked with. The expiry time is part of it, so a message that has expired and been consumed again can't be acked by its previous consumer
+        """
+        return '{}.{}'.format(claim['expiry'], claim['filename'])
+
+
+    def parse_claim(self, line):
+        """
+        Decode a line of the work log. The message itself is kept encoded until it is needed
+
+        Args:
+            line:   the line, as a str
+
+        Returns:
+            a dict with the expiry time, the file name and the record (see encode_record) of the message
+        """
+
+        claim = json.loads(line)
+
+        # claims written by older versions have the message's fields
+        if 'msg' in claim:
+            return {'expiry':claim['expiry'], 'filename':claim['msg']['filename'], 'record':json.dumps(claim['msg'])}
+        return claim
+
+
+    def sync_work(self, queue):
+        """
+        Bring the backend's copy of a queue's consumed messages up to date, reading only what has been appended to the work and acks logs since the last time. Everything is read again if the work log has been replaced (compacted) since
+
+        Args:
+            queue:  name of the queue, which must be locked by the caller
+
+        Returns:
+            a dict with the consumed messages not yet acked or requeued (claims, by their offset in the work log), their offsets by work file name (keys), and how far into which files the logs have been read
+        """
+
+        work_path = self.get_work_file(queue, 'segment.work.log')
+        acks_path = self.get_work_file(queue, 'segment.acks.log')
+        try:
+            work_stat = os.stat(work_path)
+        except (FileNotFoundError, OSError):
+            work_stat = None
+
+        state = self.work.get(queue)
+        if state is None or work_stat is None or work_stat.st_ino != state['work_ino'] or work_stat.st_size < state['work_offset']:
+            state = self.work[queue] = {'work_ino':work_stat and work_stat.st_ino, 'work_offset':0, 'acks_ino':None, 'acks_offset':0, 'claims':{}, 'keys':{}}
+        if work_stat is None:
+            return state
+
+        # consumed messages, which always come before their acks
+        if work_stat.st_size > state['work_offset']:
+            lines, state['work_offset'] = self.read_lines(work_path, state['work_offset'])
+            for offset, line in lines:
+                try:
+                    claim = self.parse_claim(line)
+                except (ValueError, KeyError, TypeError):
+                    log.warning('Skipping corrupted line in segment log: {}'.format(line[:100]))
+                    continue
+                state['claims'][offset] = claim
+                state['keys'][self.get_claim_key(claim)] = offset
+
+        # the acks log is removed when the work log is compacted
+        try:
+            acks_stat = os.stat(acks_path)
+        except (FileNotFoundError, OSError):
+            return state
+        if acks_stat.st_ino != state['acks_ino'] or acks_stat.st_size < state['acks_offset']:
+            state['acks_ino'] = acks_stat.st_ino
+            state['acks_offset'] = 0
+
+        if acks_stat.st_size > state['acks_offset']:
+            lines, state['acks_offset'] = self.read_lines(acks_path, state['acks_offset'])
+            for offset, line in lines:
+                try:
+                    key = json.loads(line)
+                except ValueError:
+                    log.warning('Skipping corrupted line in segment log: {}'.format(line[:100]))
+                    continue
+                self.forget_claim(state, key)
+
+        return state
+
+
+    def forget_claim(self, state, key):
+        """
+        Remove an acked or requeued message from the backend's copy of the consumed messages
+
+        Args:
+            state:  the queue's consumed messages, see sync_work
+            key:    the work file name of the message, or its id for acks logged by older versions
+
+        Returns:
+            None
+        """
+
+        if key in state['keys']:
+            del state['claims'][state['keys'].pop(key)]
+        elif '.ddmq' not in key:
+            for claim_key in [claim_key for claim_key in state['keys'] if claim_key.endswith('.ddmq{}'.format(key))]:
+                del state['claims'][state['keys'].pop(claim_key)]
+
+
+    def log_acks(self, queue, state, keys):
+        """
+        Append the work file names of acked or requeued messages to the acks log, and remove them from the backend's copy of the consumed messages
+
+        Args:
+            queue:  name of the queue, which must be locked by the caller
+            state:  the queue's consumed messages, as returned by sync_work
+            keys:   a list of work file names
+
+        Returns:
+            None
+        """
+
+        if not keys:
+            return
+
+        first, end = self.append(self.get_work_file(queue, 'segment.acks.log'), [json.dumps(key) for key in keys])
+        for key in keys:
+            self.forget_claim(state, key)
+
+        # skip reading back what was just written, if nothing else was written since the last read
+        if first == state['acks_offset'] and state['acks_ino'] is not None:
+            state['acks_offset'] = end
+
+
+    def read_work(self, queue):
+        """
+        Read the consumed messages that have not been acked or requeued yet
+
+        Args:
+            queue:  name of the queue, which must be locked by the caller
+
+        Returns:
+            a list of claims, each a dict with the expiry time, the file name and the record of the message
+        """
+        return list(self.sync_work(queue)['claims'].values())
+
+
+    def get_work_filename(self, expiry, package):
+        """
+        Construct the file name a consumed message would have had in the work folder with the files backend, so it can be acked the same way
+        """
+        return '{}.{}'.format(expiry, package['filename'])
+
+
+    def get_work_key(self, filename):
+        """
+        Get the key of a consumed message from its work file name, see get_claim_key
+        """
+        return os.path.basename(filename)
+
+
+
+    def create_queue(self, queue):
+        """
+        Initialize the files of a new queue
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            None
+        """
+        open(self.get_work_file(queue, 'ddmq.lock'), 'a').close()
+
+
+    def publish(self, queue, packages):
+        """
+        Publish messages to a queue
+
+        Args:
+            queue:      name of the queue
+            packages:   a list of dicts with the fields of the message objects to publish
+
+        Returns:
+            None
+        """
+
+        # group the messages by priority
+        logs = {}
+        for package in packages:
+            logs.setdefault(package['priority'], []).append(self.encode_record(queue, package))
+
+        durability = self.broker.queue_settings[queue]['durability']
+        fd = self.lock(queue)
+        try:
+            for priority, lines in logs.items():
+                self.append(self.get_log_path(queue, priority), lines, durability)
+        finally:
+            self.unlock(fd)
+
+
+    def consume(self, queue, n):
+        """
+        Consume messages from a queue, in priority order
+
+        Args:
+            queue:  name of the queue
+            n:      the maximum number of messages to consume
+
+        Returns:
+            a list of message objects
+        """
+
+        settings = self.broker.queue_settings[queue]
+        messages = []
+        claims = []
+
+        fd = self.lock(queue)
+        try:
+            state = self.sync_work(queue)
+            offsets = self.read_offsets(queue)
+            changed = False
+            now = int(time.time())
+
+            for log_name in self.list_logs(queue):
+                log_path = self.get_path(queue, log_name)
+                offset = offsets.get(log_name, 0)
+
+                with open(log_path, 'rb') as log_handle:
+                    log_handle.seek(offset)
+
+                    # read until there are enough complete lines
+                    data = b''
+                    while data.count(b'\n') < n - len(messages):
+                        chunk = log_handle.read(read_size)
+                        if not chunk:
+                            break
+                        data += chunk
+
+                    # only use as many complete lines as needed
+                    end = 0
+                    lines = 0
+                    while lines < n - len(messages):
+                        newline = data.find(b'\n', end)
+                        if newline < 0:
+                            break
+                        end = newline + 1
+                        lines += 1
+
+                    records = data[:end].decode('utf-8').splitlines()
+                    at_end = offset + end >= os.fstat(log_handle.fileno()).st_size
+
+                # the log has been fully consumed, remove it
+                if at_end:
+                    os.remove(log_path)
+                    offsets.pop(log_name, None)
+                elif end:
+                    offsets[log_name] = offset + end
+                changed = changed or at_end or end
+
+                for record in records:
+                    if not record:
+                        continue
+                    try:
+                        package = self.decode_record(queue, record)[0]
+                    except (ValueError, KeyError, TypeError):
+                        log.warning('Skipping corrupted line in segment log: {}'.format(record[:100]))
+                        continue
+                    expiry = now + (package['timeout'] or settings['message_timeout'])
+                    claims.append({'expiry':expiry, 'filename':package['filename'], 'record':record})
+                    msg = message.from_dict(package)
+                    msg.filename = self.get_work_filename(expiry, package)
+                    messages.append(msg)
+
+                if len(messages) >= n:
+                    break
+
+            # keep track of the consumed messages before moving the offsets forward
+            if claims:
+                lines = [json.dumps(claim) for claim in claims]
+                first, end = self.append(self.get_work_file(queue, 'segment.work.log'), lines)
+
+                # add them to the backend's copy right away, unless something else was written to the log since the last read
+                if first == state['work_offset'] and state['work_ino'] is not None:
+                    for claim, line in zip(claims, lines):
+                        state['claims'][first] = claim
+                        state['keys'][self.get_claim_key(claim)] = first
+                        first += len(line.encode('utf-8')) + 1
+                    state['work_offset'] = end
+            if changed:
+                self.write_file(self.get_work_file(queue, 'segment.offsets'), json.dumps(offsets))
+        finally:
+            self.unlock(fd)
+
+        return messages
+
+
+    def ack(self, queue, filenames):
+        """
+        Acknowledge consumed messages, removing them from the queue
+
+        Args:
+            queue:      name of the queue
+            filenames:  a list of work file names of the messages
+
+        Returns:
+            a list of the file names that were acked
+        """
+
+        acked = []
+        fd = self.lock(queue)
+        try:
+            state = self.sync_work(queue)
+            for filename in filenames:
+                if self.get_work_key(filename) in state['keys']:
+                    acked.append(filename)
+                else:
+                    print("Warning: message missing, {} in {}".format(filename, os.path.join(self.broker.root, queue)))
+
+            self.log_acks(queue, state, [self.get_work_key(filename) for filename in acked])
+        finally:
+            self.unlock(fd)
+
+        return acked
+
+
+    def requeue(self, queue, filenames, requeue=True):
+        """
+        Requeue consumed messages, or remove them
+
+        Args:
+            queue:      name of the queue
+            filenames:  a list of work file names of the messages
+            requeue:    True to requeue the messages, False to remove them, None to let the message's (or queue's) requeue setting decide
+
+        Returns:
+            a list of the file names that were requeued or removed
+        """
+
+        settings = self.broker.queue_settings[queue]
+        done = []
+
+        fd = self.lock(queue)
+        try:
+            state = self.sync_work(queue)
+            requeued = []
+            for filename in filenames:
+                offset = state['keys'].get(self.get_work_key(filename))
+                if offset is None:
+                    print("Warning: message missing, {} in {}".format(filename, os.path.join(self.broker.root, queue)))
+                    continue
+                package, codec = self.decode_record(queue, state['claims'][offset]['record'])
+
+                # let the options in this function call override the ones in the message
+                requeue_msg = requeue
+                if requeue_msg is None:
+                    requeue_msg = package['requeue'] or settings['requeue']
+
+                if requeue_msg:
+                    requeued.append((self.broker.requeue_package(queue, package), codec))
+                done.append(filename)
+
+            for package, codec in requeued:
+                self.append(self.get_log_path(queue, package['priority']), [self.encode_record(queue, package, codec)], settings['durability'])
+            self.log_acks(queue, state, [self.get_work_key(filename) for filename in done])
+        finally:
+            self.unlock(fd)
+
+        return done
+
+
+    def clean(self, queue):
+        """
+        Requeue (or remove) expired messages, and compact the work and acks logs
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            a list of the work file names of the messages that were removed, so their blobs can be removed
+        """
+
+        settings = self.broker.queue_settings[queue]
+        now = int(time.time())
+        removed = []
+
+        fd = self.lock(queue)
+        try:
+            pending = []
+            requeued = []
+            for claim in self.read_work(queue):
+
+                if claim['expiry'] >= now:
+                    pending.append(json.dumps(claim))
+                    continue
+
+                # requeue if it should be, unless the requeue limit has been reached
+                package, codec = self.decode_record(queue, claim['record'])
+                if package['requeue'] and (not package['requeue_limit'] or package['requeue_counter'] < package['requeue_limit']):
+                    requeued.append((self.broker.requeue_package(queue, package), codec))
+                else:
+                    removed.append(self.get_claim_key(claim))
+
+            for package, codec in requeued:
+                self.append(self.get_log_path(queue, package['priority']), [self.encode_record(queue, package, codec)], settings['durability'])
+
+            # replace the work log with the messages still pending, which makes the acks unnecessary
+            self.write_file(self.get_work_file(queue, 'segment.work.log'), ''.join('{}\n'.format(claim) for claim in pending))
+            self.remove(self.get_work_file(queue, 'segment.acks.log'))
+            self.work.pop(queue, None)
+        finally:
+            self.unlock(fd)
+
+        return removed
+
+
+    def next_expiry(self, queue):
+        """
+        Get the earliest expiry time of the consumed messages in a queue, or None if there are none
+        """
+
+        fd = self.lock(queue)
+        try:
+            expiries = [claim['expiry'] for claim in self.read_work(queue)]
+        finally:
+            self.unlock(fd)
+
+        if not expiries:
+            return None
+        return min(expiries)
+
+
+    def list(self, queue):
+        """
+        List the messages in a queue
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            2 lists of file names, the messages waiting in the queue and the messages consumed but not yet acked
+        """
+
+        fd = self.lock(queue)
+        try:
+            offsets = self.read_offsets(queue)
+            messages = []
+            for log_name in self.list_logs(queue):
+                lines = self.read_lines(self.get_path(queue, log_name), offsets.get(log_name, 0))[0]
+                messages += [self.decode_record(queue, record)[0]['filename'] for offset, record in lines]
+
+            work_messages = [self.get_claim_key(claim) for claim in self.read_work(queue)]
+        finally:
+            self.unlock(fd)
+
+        return messages, work_messages
+
+
+    def purge(self, queue):
+        """
+        Remove all messages from a queue
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            the number of messages removed from the queue, and from the work log
+        """
+
+        fd = self.lock(queue)
+        try:
+            messages = 0
+            offsets = self.read_offsets(queue)
+            for log_name in self.list_logs(queue):
+                log_path = self.get_path(queue, log_name)
+                messages += len(self.read_lines(log_path, offsets.get(log_name, 0))[0])
+                self.remove(log_path)
+            work_messages = self.read_work(queue)
+
+            for filename in ['segment.offsets', 'segment.work.log', 'segment.acks.log']:
+                self.remove(self.get_work_file(queue, filename))
+            self.work.pop(queue, None)
+        finally:
+            self.unlock(fd)
+
+        return messages, len(work_messages)
+
+
+    def delete(self, queue):
+        """
+        Remove all files the backend has created in a queue folder
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            None
+        """
+
+        self.purge(queue)
+        for filename in ['ddmq.lock', 'segment.offsets.intermediate', 'segment.work.log.intermediate']:
+            self.remove(self.get_work_file(queue, filename))
+
+
+    def remove(self, path):
+        """
+        Remove a file if it exists
+        """
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,201 @@
+#! /usr/bin/env python
+"""
+Defines the server class, an optional helper process that runs ddmq commands
+sent to it over a Unix socket. The ddmq command sends them with the forward
+function in client.py. Starting a new Python process and creating a
+broker object for every command takes much longer than the command itself,
+so a helper that keeps its broker objects, cached settings and queue indexes
+between commands makes scripts calling ddmq many times a lot faster.
+
+The helper is only an accelerator. It reads and writes the same files as any
+other client, and if no helper is running the command-line interface just
+runs the command itself.
+
+$ ddmq serve --socket /tmp/ddmq.sock &
+$ export DDMQ_SOCKET=/tmp/ddmq.sock
+$ ddmq publish /tmp/ddmq queue_name "Hello World!"
+
+The protocol is one JSON object per connection in each direction. The client
+sends the command-line arguments and its working directory, and the server
+answers with the command's exit status and what it printed. The status is
+null if the helper refused the command before running it (e.g. since it
+reads from stdin), and the client runs it itself.
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+
+# import standard modules
+import os
+import json
+import errno
+import socket
+import logging as log
+
+try:
+    from .client import forward, is_running
+except (ValueError, ImportError):
+    from client import forward, is_running
+
+# the number of seconds to wait for a connected client to send its command
+client_timeout = 10
+
+# the number of seconds between checks if the server has been stopped
+accept_timeout = 1
+
+
+
+class server(object):
+    """
+    Class to run commands sent over a Unix socket, one at a time
+    """
+
+    def __init__(self, path, handler):
+        """
+        Initialize a server object. The socket is not created until the server is run
+
+        Args:
+            path:       path to the socket to listen on
+            handler:    function running a command, called with the command-line arguments (without the program name). Returns a tuple of the exit status (None to refuse the command) and what the command printed to stdout and stderr
+
+        Returns:
+            None
+        """
+
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError(errno.EAFNOSUPPORT, "Unix sockets are not supported on this system")
+
+        self.path = os.path.abspath(path)
+        self.handler = handler
+        self.listener = None
+        self.running = False
+
+
+    def bind(self):
+        """
+        Create the socket, replacing a socket left behind by a helper that is no longer running
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        if os.path.exists(self.path):
+            if is_running(self.path):
+                raise OSError(errno.EADDRINUSE, "A ddmq helper is already running", self.path)
+            log.info('Removing stale socket {}'.format(self.path))
+            os.remove(self.path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # commands are run with the helper's permissions, so only its owner may connect
+        old_umask = os.umask(0o177)
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+
+        self.listener.listen(64)
+        self.listener.settimeout(accept_timeout)
+
+
+    def run(self):
+        """
+        Run commands sent to the socket until stopped
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        self.bind()
+        self.running = True
+        log.info('Listening on {}'.format(self.path))
+
+        try:
+            while self.running:
+                try:
+                    connection = self.listener.accept()[0]
+                except socket.timeout:
+                    continue
+                try:
+                    self.handle(connection)
+                except socket.error as e:
+                    log.warning('Lost connection to client: {}'.format(e))
+                finally:
+                    connection.close()
+        finally:
+            self.close()
+
+
+    def handle(self, connection):
+        """
+        Read a command from a client, run it and send back the result
+
+        Args:
+            connection: the socket connected to the client
+
+        Returns:
+            None
+        """
+
+        connection.settimeout(client_timeout)
+        request = connection.makefile('rb').readline()
+        connection.settimeout(None)
+
+        # e.g. is_running checking if the server is up
+        if not request:
+            return
+
+        try:
+            request = json.loads(request.decode('utf-8'))
+            argv = [str(arg) for arg in request['argv']]
+            os.chdir(request['cwd'])
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            log.warning('Invalid request: {}'.format(e))
+            return
+
+        log.debug('Running {}'.format(' '.join(argv)))
+        status, stdout, stderr = self.handler(argv)
+        connection.sendall(json.dumps({'status':status, 'stdout':stdout, 'stderr':stderr}).encode('utf-8'))
+
+
+    def stop(self):
+        """
+        Stop the server after the command it is running, if any, has finished
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self.running = False
+
+
+    def close(self):
+        """
+        Close the socket and remove its file
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
@@ -0,0 +1,439 @@
+#! /usr/bin/env python
+"""
+Defines the sqlite_backend class, a storage backend that keeps the messages
+of a queue in a SQLite database (ddmq.sqlite in the queue folder) instead of
+one file per message. Select it by creating a broker with backend='sqlite',
+or by setting backend: sqlite in the root's ddmq.yaml. Queues remember which
+backend they were created with in their own ddmq.yaml file.
+
+The database is used in WAL mode, which lets consumers read while a publisher
+is writing, but it needs the queue folder to be on a local file system (not
+NFS or similar). All messages are kept in a single table, where messages that
+have been consumed get an expiry time, the same way they get the expiry time
+prepended to their file name in the work folder with the files backend.
+
+>>> b = ddmq.broker('../temp/ddmq', create=True, backend='sqlite')
+>>> b.publish('queue_name', 'Hello World!')
+>>> b.consume('queue_name').message
+'Hello World!'
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+
+
+# import standard modules
+import os
+import time
+import errno
+import sqlite3
+import threading
+import contextlib
+import logging as log
+
+try:
+    from .message import message
+    from .codec import encode, decode, tagged_codec, is_compressed
+except (ValueError, ImportError):
+    from message import message
+    from codec import encode, decode, tagged_codec, is_compressed
+
+# waiting messages have no expiry time, consumed ones are sorted by it so expired messages are found without a full scan
+schema = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    priority INTEGER NOT NULL,
+    queue_number INTEGER NOT NULL,
+    expiry INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS waiting ON messages (priority, queue_number) WHERE expiry IS NULL;
+CREATE INDEX IF NOT EXISTS consumed ON messages (expiry) WHERE expiry IS NOT NULL;
+"""
+
+# the number of seconds to wait for another process to finish writing before giving up
+busy_timeout = 60
+
+
+
+class sqlite_backend:
+    """
+    Class to store queues in SQLite databases
+    """
+
+    # the database is written in place, so waiting consumers have to watch for modified files
+    watch_modify = True
+
+    def __init__(self, broker):
+        """
+        Initialize a SQLite backend for a broker object
+
+        Args:
+            broker:     the broker object using the backend, used to look up queue settings
+
+        Returns:
+            None
+        """
+
+        log.debug('Initializing sqlite backend')
+
+        self.broker = broker
+
+        # sqlite connections can't be shared between threads or forked processes, so each thread gets its own
+        self.local = threading.local()
+
+
+
+    def get_path(self, queue):
+        """
+        Get the path to a queue's database
+        """
+        return os.path.join(self.broker.root, queue, 'ddmq.sqlite')
+
+
+    def connect(self, queue):
+        """
+        Get the database connection for a queue, opening it the first time it is requested in this thread and process
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            a sqlite3 connection object
+        """
+
+        connections = getattr(self.local, 'connections', None)
+        if connections is None or self.local.pid != os.getpid():
+            connections = self.local.connections = {}
+            self.local.pid = os.getpid()
+
+        try:
+            return connections[queue]
+        except KeyError:
+            pass
+
+        log.debug('Opening database {}'.format(self.get_path(queue)))
+
+        # transactions are started explicitly
+        db = sqlite3.connect(self.get_path(queue), timeout=busy_timeout, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+
+        # in WAL mode, NORMAL can lose the last transactions in a power loss but never corrupts the database
+        if self.broker.get_settings(queue)['durability'] == 'none':
+            db.execute('PRAGMA synchronous=NORMAL')
+        else:
+            db.execute('PRAGMA synchronous=FULL')
+
+        db.executescript(schema)
+        connections[queue] = db
+        return db
+
+
+    def close(self, queue):
+        """
+        Close this thread's connection to a queue's database, if open
+        """
+
+        connections = getattr(self.local, 'connections', {})
+        db = connections.pop(queue, None)
+        if db is not None and self.local.pid == os.getpid():
+            db.close()
+
+
+    @contextlib.contextmanager
+    def transaction(self, queue):
+        """
+        Context manager that runs a block of statements in a write transaction on a queue's database. The transaction takes the write lock right away, so two consumers can't select the same messages
+        """
+
+        db = self.connect(queue)
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+
+    def get_work_filename(self, expiry, package):
+        """
+        Construct the file name a consumed message would have had in the work folder with the files backend, so it can be acked the same way
+        """
+        return '{}.{}'.format(expiry, package['filename'])
+
+
+    def parse_work_filename(self, filename):
+        """
+        Get the expiry time and id from a work file name. The expiry time is part of the key, so a message that has expired and been consumed again can't be acked by its previous consumer
+        """
+        filename = os.path.basename(filename)
+        return int(filename.split('.')[0]), filename.split('.ddmq')[-1]
+
+
+    def get_row(self, queue, package, codec=None):
+        """
+        Get the column values for a waiting message, encoded with the given codec or the queue's
+        """
+        priority, queue_number, id = self.broker.parse_filename(package['filename'])
+
+        # JSON encoded messages are stored as text, so they can be read in the sqlite3 shell
+        data = self.broker.compress(queue, encode(package, codec or self.broker.get_codec(queue)))
+        if data[:1] == b'{':
+            data = data.decode('utf-8')
+        return (package['id'], package['priority'], queue_number, data)
+
+
+    def decode_row(self, queue, data):
+        """
+        Decode a message stored in the database. Compressed messages are decompressed through the broker, so it is counted in the queue's statistics
+
+        Args:
+            queue:  name of the queue
+            data:   the data column of the message's row
+
+        Returns:
+            a dict with the fields of the message, and the codec it was encoded with (None for JSON)
+        """
+
+        # JSON is stored as text
+        if isinstance(data, type(u'')):
+            return decode(data), None
+
+        data = bytes(data)
+        if is_compressed(data):
+            data = self.broker.decompress(queue, data)
+        return decode(data), tagged_codec(data)
+
+
+
+    def create_queue(self, queue):
+        """
+        Create the database of a new queue
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            None
+        """
+        self.connect(queue)
+
+
+    def publish(self, queue, packages):
+        """
+        Publish messages to a queue
+
+        Args:
+            queue:      name of the queue
+            packages:   a list of dicts with the fields of the message objects to publish
+
+        Returns:
+            None
+        """
+
+        with self.transaction(queue) as db:
+            db.executemany('INSERT INTO messages (id, priority, queue_number, data) VALUES (?, ?, ?, ?)', [self.get_row(queue, package) for package in packages])
+
+
+    def consume(self, queue, n):
+        """
+        Consume messages from a queue, in priority order
+
+        Args:
+            queue:  name of the queue
+            n:      the maximum number of messages to consume
+
+        Returns:
+            a list of message objects
+        """
+
+        settings = self.broker.queue_settings[queue]
+        messages = []
+        now = int(time.time())
+
+        with self.transaction(queue) as db:
+            rows = db.execute('SELECT id, data FROM messages WHERE expiry IS NULL ORDER BY priority, queue_number LIMIT ?', (n,)).fetchall()
+
+            for id, data in rows:
+                package = self.decode_row(queue, data)[0]
+                expiry = now + (package['timeout'] or settings['message_timeout'])
+                db.execute('UPDATE messages SET expiry = ? WHERE id = ?', (expiry, id))
+
+                msg = message.from_dict(package)
+                msg.filename = self.get_work_filename(expiry, package)
+                messages.append(msg)
+
+        return messages
+
+
+    def ack(self, queue, filenames):
+        """
+        Acknowledge consumed messages, removing them from the queue
+
+        Args:
+            queue:      name of the queue
+            filenames:  a list of work file names of the messages
+
+        Returns:
+            a list of the file names that were acked
+        """
+
+        acked = []
+        with self.transaction(queue) as db:
+            for filename in filenames:
+                expiry, id = self.parse_work_filename(filename)
+                if db.execute('DELETE FROM messages WHERE id = ? AND expiry = ?', (id, expiry)).rowcount:
+                    acked.append(filename)
+                else:
+                    print("Warning: message missing, {} in {}".format(filename, self.get_path(queue)))
+
+        return acked
+
+
+    def requeue(self, queue, filenames, requeue=True):
+        """
+        Requeue consumed messages, or remove them
+
+        Args:
+            queue:      name of the queue
+            filenames:  a list of work file names of the messages
+            requeue:    True to requeue the messages, False to remove them, None to let the message's (or queue's) requeue setting decide
+
+        Returns:
+            a list of the file names that were requeued or removed
+        """
+
+        settings = self.broker.queue_settings[queue]
+        done = []
+
+        with self.transaction(queue) as db:
+            for filename in filenames:
+                expiry, id = self.parse_work_filename(filename)
+                row = db.execute('SELECT data FROM messages WHERE id = ? AND expiry = ?', (id, expiry)).fetchone()
+                if not row:
+                    print("Warning: message missing, {} in {}".format(filename, self.get_path(queue)))
+                    continue
+                package, codec = self.decode_row(queue, row[0])
+
+                # let the options in this function call override the ones in the message
+                requeue_msg = requeue
+                if requeue_msg is None:
+                    requeue_msg = package['requeue'] or settings['requeue']
+
+                if requeue_msg:
+                    self.put_back(db, queue, package, codec)
+                else:
+                    db.execute('DELETE FROM messages WHERE id = ?', (id,))
+                done.append(filename)
+
+        return done
+
+
+    def put_back(self, db, queue, package, codec=None):
+        """
+        Put a consumed message back in the queue, with the requeue priority and an increased counter
+
+        Args:
+            db:         the database connection, in a transaction
+            queue:      name of the queue
+            package:    dict with the fields of the consumed message
+            codec:      the codec the message was encoded with, if not JSON, so e.g. bytes messages can be encoded the same way again
+
+        Returns:
+            None
+        """
+
+        package = self.broker.requeue_package(queue, package)
+        id, priority, queue_number, data = self.get_row(queue, package, codec)
+        db.execute('UPDATE messages SET priority = ?, queue_number = ?, expiry = NULL, data = ? WHERE id = ?', (priority, queue_number, data, id))
+
+
+    def clean(self, queue):
+        """
+        Requeue (or remove) expired messages
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            a list of the work file names of the messages that were removed, so their blobs can be removed
+        """
+
+        removed = []
+        with self.transaction(queue) as db:
+            for id, expiry, data in db.execute('SELECT id, expiry, data FROM messages WHERE expiry < ?', (int(time.time()),)).fetchall():
+
+                # requeue if it should be, unless the requeue limit has been reached
+                package, codec = self.decode_row(queue, data)
+                if package['requeue'] and (not package['requeue_limit'] or package['requeue_counter'] < package['requeue_limit']):
+                    self.put_back(db, queue, package, codec)
+                else:
+                    db.execute('DELETE FROM messages WHERE id = ?', (id,))
+                    removed.append(self.get_work_filename(expiry, package))
+
+        return removed
+
+
+    def next_expiry(self, queue):
+        """
+        Get the earliest expiry time of the consumed messages in a queue, or None if there are none
+        """
+        return self.connect(queue).execute('SELECT MIN(expiry) FROM messages WHERE expiry IS NOT NULL').fetchone()[0]
+
+
+    def list(self, queue):
+        """
+        List the messages in a queue
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            2 lists of file names, the messages waiting in the queue and the messages consumed but not yet acked
+        """
+
+        db = self.connect(queue)
+        messages = [self.decode_row(queue, data)[0]['filename'] for data, in db.execute('SELECT data FROM messages WHERE expiry IS NULL ORDER BY priority, queue_number')]
+        work_messages = [self.get_work_filename(expiry, self.decode_row(queue, data)[0]) for expiry, data in db.execute('SELECT expiry, data FROM messages WHERE expiry IS NOT NULL ORDER BY expiry')]
+        return messages, work_messages
+
+
+    def purge(self, queue):
+        """
+        Remove all messages from a queue
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            the number of messages removed that were waiting in the queue, and that were consumed
+        """
+
+        with self.transaction(queue) as db:
+            removed = db.execute('DELETE FROM messages WHERE expiry IS NULL').rowcount
+            removed_work = db.execute('DELETE FROM messages').rowcount
+
+        return removed, removed_work
+
+
+    def delete(self, queue):
+        """
+        Remove the database of a queue
+
+        Args:
+            queue:  name of the queue
+
+        Returns:
+            None
+        """
+
+        self.close(queue)
+        for suffix in ['', '-wal', '-shm', '-journal']:
+            try:
+                os.remove(self.get_path(queue)+suffix)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
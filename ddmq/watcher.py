@@ -0,0 +1,281 @@
+#! /usr/bin/env python
+"""
+Defines the folder_watcher class which lets a client wait for new files to
+show up in a folder, instead of polling it in a loop. On Linux it uses inotify
+through ctypes, so no extra modules are needed. On other systems, or if inotify
+is not available, it falls back to sleeping with an increasing delay between
+the checks.
+
+>>> w = folder_watcher('../temp/ddmq/queue_name')
+>>> w.wait(10)   # returns when a file is written or moved into the folder, or after 10 seconds
+True
+
+"""
+
+# if python2
+from __future__ import print_function
+from __future__ import division
+
+
+# import standard modules
+import os
+import time
+import errno
+import struct
+import logging as log
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# the delays used when polling, in seconds
+min_poll_delay = 0.01
+max_poll_delay = 1.0
+
+
+
+def load_inotify():
+    """
+    Load the inotify functions from libc, if available
+
+    Args:
+        None
+
+    Returns:
+        the libc object, or None if inotify is not available
+    """
+
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (ImportError, OSError, AttributeError):
+        return None
+
+# the libc object, loaded the first time a watcher is created since ctypes is slow to import (None if inotify is not available)
+libc = None
+libc_loaded = False
+
+
+
+def get_libc():
+    """
+    Get the libc object with the inotify functions, loading it the first time
+
+    Args:
+        None
+
+    Returns:
+        the libc object, or None if inotify is not available
+    """
+
+    global libc, libc_loaded
+    if not libc_loaded:
+        libc = load_inotify()
+        libc_loaded = True
+    return libc
+
+
+
+class folder_watcher:
+    """
+    Class to wait for files to be written or moved into a folder
+    """
+
+    def __init__(self, path, poll=False, subfolders=False, modify=False):
+        """
+        Initialize a watcher for the specified folder. Events that happen after the watcher is created will wake up the next call to wait, so create it before checking the folder the first time.
+
+        Args:
+            path:       path to the folder to watch
+            poll:       if True, don't use inotify even if it is available
+            subfolders: if True, also wake up when subfolders are created in the folder, so they can be watched using add
+            modify:     if True, also wake up when a file in the folder is modified in place, for backends that keep files open (e.g. SQLite databases)
+
+        Returns:
+            None
+        """
+
+        log.debug('Initializing watcher for {}'.format(path))
+
+        self.path = path
+        self.fd = None
+        self.delay = min_poll_delay
+        self.watched = {}
+
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        if subfolders:
+            mask |= IN_CREATE
+        if modify:
+            mask |= IN_MODIFY
+
+        if not poll and get_libc():
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                wd = libc.inotify_add_watch(fd, path.encode('utf-8'), mask)
+                if wd >= 0:
+                    self.fd = fd
+                    self.watched[wd] = path
+                else:
+                    os.close(fd)
+
+        if self.fd is None:
+            log.debug('inotify not available, polling {}'.format(path))
+
+
+    def __del__(self):
+        """
+        Close the inotify file descriptor when the watcher is garbage collected
+        """
+        self.close()
+
+
+    def add(self, path):
+        """
+        Watch another folder as well, e.g. a subfolder of the first one. Does nothing when polling.
+
+        Args:
+            path:   path to the folder to watch
+
+        Returns:
+            True if the folder was not watched before, so the caller should check it before waiting
+        """
+
+        if self.fd is None or path in self.watched.values():
+            return False
+
+        wd = libc.inotify_add_watch(self.fd, path.encode('utf-8'), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            # the folder could have been removed already
+            return False
+
+        self.watched[wd] = path
+        return True
+
+
+    def fileno(self):
+        """
+        Get the inotify file descriptor, so the watcher can be used with select or an event loop. None if polling.
+        """
+        return self.fd
+
+
+    def wait(self, timeout=None):
+        """
+        Wait until a file is written or moved into the folder. When polling, this will just sleep for the current delay, which doubles for each call until reset is called.
+
+        Args:
+            timeout:    the maximum number of seconds to wait, None to wait forever
+
+        Returns:
+            True if something might have happened in the folder, False if the timeout was reached
+        """
+
+        # fall back to polling
+        if self.fd is None:
+            delay = self.next_delay()
+            if timeout is not None:
+                delay = min(delay, timeout)
+            time.sleep(max(delay, 0))
+            return True
+
+        # only needed when waiting, so it isn't imported just to start the command-line interface
+        import select
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except (select.error, OSError) as e:
+            # interrupted by a signal, let the caller check the folder again
+            if e.args[0] == errno.EINTR:
+                return True
+            raise
+
+        if not ready:
+            return False
+
+        self.drain()
+        return True
+
+
+    def next_delay(self):
+        """
+        Get the number of seconds to sleep before checking the folder again when polling. The delay doubles for each call until reset is called
+
+        Args:
+            None
+
+        Returns:
+            the delay in seconds
+        """
+
+        delay = self.delay
+        self.delay = min(self.delay * 2, max_poll_delay)
+        return delay
+
+
+    def drain(self):
+        """
+        Read and discard all pending events, forgetting about folders that have been removed so they can be watched again if they are recreated
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        if self.fd is None:
+            return
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                return
+
+            # struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[len]; }
+            offset = 0
+            while offset + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                if mask & IN_IGNORED:
+                    self.watched.pop(wd, None)
+                offset += 16 + length
+
+
+    def reset(self):
+        """
+        Reset the polling delay, to be called when a file was found
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self.delay = min_poll_delay
+
+
+    def close(self):
+        """
+        Stop watching the folder
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
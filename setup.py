@@ -25,7 +25,7 @@ setuptools.setup(
     ],
 
     entry_points={
-        'console_scripts': ['ddmq = ddmq.cli:main',
+        'console_scripts': ['ddmq = ddmq.client:main',
         ],
     }
 )